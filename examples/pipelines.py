@@ -14,12 +14,11 @@ import os
 import os.path as op
 import logging
 
-import pandas as pd
 from hansel import Crumb
 from invoke import task
 from boyle.files.search  import recursive_glob
 
-from pypes.run import run_debug, run_wf
+from pypes.run import run_debug, run_wf, run_shards
 
 
 log = logging.getLogger()
@@ -153,7 +152,7 @@ def dcm2nii(ctx, input_crumb_path, output_dir, regex='fnmatch', ncpus=3):
 @task
 def clinical_pype(ctx, wf_name="spm_anat_preproc", base_dir="",
                   cache_dir="", output_dir="", settings_file='',
-                  plugin="MultiProc", n_cpus=4):
+                  plugin="MultiProc", n_cpus=4, n_shards=1, shards=""):
     """ Run the basic pipeline.
 
     Parameters
@@ -171,6 +170,13 @@ def clinical_pype(ctx, wf_name="spm_anat_preproc", base_dir="",
     plugin: str
 
     n_cpus: int
+
+    n_shards: int
+        If > 1 the subjects will be split in `n_shards` workflows run in separate processes.
+
+    shards: str
+        Comma separated indices of the shards to run in this host.
+        Default: all of them.
     """
     from pypes.datasets import clinical_crumb_workflow
 
@@ -179,13 +185,21 @@ def clinical_pype(ctx, wf_name="spm_anat_preproc", base_dir="",
 
     atlas_file = HAMM_MNI
 
-    wf = clinical_crumb_workflow(wf_name     = wf_name,
-                                 data_crumb  = data_crumb,
-                                 cache_dir   = op.abspath(op.expanduser(cache_dir)) if cache_dir else '',
-                                 output_dir  = op.abspath(op.expanduser(output_dir)) if output_dir else '',
-                                 config_file = settings_file,
-                                 params={'atlas_file': atlas_file},
-                                 )
+    wf_kwargs = dict(wf_name     = wf_name,
+                     data_crumb  = data_crumb,
+                     cache_dir   = op.abspath(op.expanduser(cache_dir)) if cache_dir else '',
+                     output_dir  = op.abspath(op.expanduser(output_dir)) if output_dir else '',
+                     config_file = settings_file,
+                     params={'atlas_file': atlas_file},
+                    )
+
+    if n_shards > 1:
+        shard_list = [int(idx) for idx in shards.split(',')] if shards else None
+        run_shards(clinical_crumb_workflow, n_shards, shards=shard_list,
+                   plugin=plugin, n_cpus=n_cpus, **wf_kwargs)
+        return
+
+    wf = clinical_crumb_workflow(**wf_kwargs)
 
     if n_cpus > 1:
         run_wf(wf, plugin=plugin, n_cpus=n_cpus)
@@ -467,10 +481,13 @@ def plot_ica_results(ctx, ica_result, application, mask_file='', mode='+-', zsco
 
 
 @task
-def motion_stats_sheet(ctx, motion_file_cr, crumb_fields, out_path):
+def motion_stats_sheet(ctx, motion_file_cr, crumb_fields, out_path, qc_db=""):
     """ Create in `out_path` an Excel spreadsheet with some of the motion statistics obtained from the
     `statistics_files` output of the nipype.RapidArt found in the hansel.Crumb `motion_file_cr`.
 
+    The statistics are kept in the cohort QC store `qc_db`, only the files that changed since the
+    last call are read again.
+
     Parameters
     ----------
     motion_file_cr: str
@@ -479,6 +496,10 @@ def motion_stats_sheet(ctx, motion_file_cr, crumb_fields, out_path):
 
     out_path: str
 
+    qc_db: str
+        Path to the SQLite QC store. Default: `out_path` with the '.sqlite' extension.
+        It should be on a local disk, see `pypes.qc`.
+
     Examples
     --------
     >>> inv motion_stats_sheet \
@@ -486,45 +507,79 @@ def motion_stats_sheet(ctx, motion_file_cr, crumb_fields, out_path):
     >>> --crumb-fields "['group', 'patient_id', 'session']" \
     >>> --out-path "/home/hansel/data/motion_stats.xls"
     """
-    import json
     from collections import OrderedDict
 
     from hansel import Crumb
 
-    def get_motion_record(mtn_file_cr, crumb_fields):
-        """ Return an OrderedDict of the information found in the `mtn_file_cr` and also
-        `crumb_fields` Crumb argument values."""
-        stats = json.load(open(str(mtn_file_cr)))
+    from pypes.qc import MotionQCStore, rapidart_summary
+
+    # process the input
+    motion_file_cr = Crumb(motion_file_cr)
+    crumb_fields   = [crf.strip() for crf in crumb_fields[1:-1].replace("'", "").split(',')]
+
+    if not qc_db:
+        qc_db = op.splitext(out_path)[0] + '.sqlite'
 
-        outliers = stats[1]
-        motion_norm = stats[3]['motion_norm']
+    # update the motion records of the new or modified files
+    store = MotionQCStore(qc_db)
+    for stats_file in motion_file_cr.ls():
+        args = OrderedDict((fn, stats_file[fn][0]) for fn in crumb_fields)
+        if not store.is_current(args, str(stats_file)):
+            store.add(args, rapidart_summary(str(stats_file)), source=str(stats_file))
 
-        #outliers_hdr = list(outliers.keys())
-        motion_hdr   = ['{}_motion_norm'.format(k) for k in motion_norm.keys()]
+    # save it into an excel file
+    store.export(out_path)
 
-        mtn_record = OrderedDict()
-        for fn in crumb_fields:
-            mtn_record[fn] = mtn_file_cr[fn][0]
 
-        mtn_record.update(outliers)
+@task
+def motion_qc_sheet(ctx, qc_file_cr, crumb_fields, out_path, qc_db=""):
+    """ Create in `out_path` an Excel spreadsheet with the motion QC measures of the
+    `motion_qc.json` files of the fMRI cleanup workflow found in the hansel.Crumb `qc_file_cr`.
+    They are saved with the `fmri_cleanup.motion_stats` setting.
 
-        for hdr, fn in zip(motion_hdr, motion_norm):
-            mtn_record[hdr] = motion_norm[fn]
+    The measures are added to the cohort QC store `qc_db` by this process only, the files
+    that did not change since the last call are skipped.
 
-        return mtn_record
+    Parameters
+    ----------
+    qc_file_cr: str
+
+    crumb_fields: list of str
+
+    out_path: str
+
+    qc_db: str
+        Path to the SQLite QC store. Default: `out_path` with the '.sqlite' extension.
+        It should be on a local disk, see `pypes.qc`.
+
+    Examples
+    --------
+    >>> inv motion_qc_sheet \
+    >>> --qc-file-cr "/home/hansel/data/out/{group}/{patient_id}/{session}/rest/motion_stats/motion_qc.json" \
+    >>> --crumb-fields "['group', 'patient_id', 'session']" \
+    >>> --out-path "/home/hansel/data/motion_qc.xls"
+    """
+    from collections import OrderedDict
+
+    from hansel import Crumb
+
+    from pypes.qc import MotionQCStore
 
     # process the input
-    motion_file_cr = Crumb(motion_file_cr)
-    crumb_fields   = [crf.strip() for crf in crumb_fields[1:-1].replace("'", "").split(',')]
+    qc_file_cr   = Crumb(qc_file_cr)
+    crumb_fields = [crf.strip() for crf in crumb_fields[1:-1].replace("'", "").split(',')]
 
-    # create the motion records
-    motionstats = [get_motion_record(stats_file, crumb_fields) for stats_file in motion_file_cr.ls()]
+    if not qc_db:
+        qc_db = op.splitext(out_path)[0] + '.sqlite'
 
-    # create a pandas Dataframe out of it
-    df = pd.DataFrame.from_records(motionstats, columns=motionstats[0].keys())
+    # add the measures of the new or modified files
+    store = MotionQCStore(qc_db)
+    for qc_file in qc_file_cr.ls():
+        args = OrderedDict((fn, qc_file[fn][0]) for fn in crumb_fields)
+        store.add_qc_file(str(qc_file), args=args)
 
     # save it into an excel file
-    df.to_excel(out_path)
+    store.export(out_path)
 
 
 @task
@@ -6,12 +6,12 @@ import os.path as op
 
 import nipype.interfaces.spm     as spm
 import nipype.pipeline.engine    as pe
-from   nipype.algorithms.misc    import Gunzip
 from   nipype.interfaces.utility import IdentityInterface, Function
 
 from .utils import biasfield_correct, spm_segment
 
 from   ..interfaces.nilearn import math_img
+from   ..interfaces.files import Gunzip
 from   ..config  import setup_node, check_atlas_file
 from   ..preproc import (spm_apply_deformations,
                          get_bounding_box,)
@@ -123,7 +123,8 @@ def spm_anat_preprocessing(wf_name="spm_anat_preproc"):
                          name="tissues")
 
     brain_mask = setup_node(Function(function=math_img,
-                                     input_names=["formula", "out_file", "gm", "wm", "csf"],
+                                     input_names=["formula", "out_file", "gm", "wm", "csf",
+                                                  "image_settings"],
                                      output_names=["out_file"],
                                      imports=['from pypes.interfaces.nilearn import ni2file']),
                             name='brain_mask')
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+The `pypes` command line.
+"""
+import argparse
+import logging
+
+
+def _worker(args):
+    from .jobqueue import run_worker
+
+    run_worker(args.queue_dir,
+               n_jobs=args.n_jobs,
+               lease_secs=args.lease_secs,
+               poll_secs=args.poll_secs,
+               idle_exit=args.idle_exit)
+
+
+def _telemetry(args):
+    from .telemetry import summarize
+
+    print(summarize(args.log_files, top=args.top))
+
+
+def main(argv=None):
+    """ Entry point of the `pypes` command."""
+    parser = argparse.ArgumentParser(prog='pypes')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log debug messages.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    worker = commands.add_parser('worker', help='Run the jobs of a pypes job queue folder.')
+    worker.add_argument('queue_dir', help='Path to the queue folder.')
+    worker.add_argument('-j', '--n-jobs', type=int, default=1,
+                        help='Number of jobs to run at the same time.')
+    worker.add_argument('--lease-secs', type=float, default=120,
+                        help='Seconds a job is leased without a heartbeat.')
+    worker.add_argument('--poll-secs', type=float, default=2,
+                        help='Seconds to wait for new jobs when the queue is empty.')
+    worker.add_argument('--idle-exit', type=float, default=0,
+                        help='Exit after this number of seconds without jobs, 0 to never exit.')
+    worker.set_defaults(func=_worker)
+
+    telemetry = commands.add_parser('telemetry', help='Summarize workflow telemetry logs.')
+    telemetry.add_argument('log_files', nargs='+', help='Paths to the telemetry JSON-lines files.')
+    telemetry.add_argument('-n', '--top', type=int, default=10,
+                           help='Number of slowest nodes and subjects to list.')
+    telemetry.set_defaults(func=_telemetry)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -148,6 +148,9 @@ class Config(object):
 # the global configuration registry
 PYPES_CFG = Config()
 
+# the node settings that are resource profiles for the scheduler, not interface inputs
+RESOURCE_KEYS = ('n_procs', 'mem_gb')
+
 
 def node_settings(node_name):
     global PYPES_CFG
@@ -217,6 +220,12 @@ def setup_node(interface, name, settings=None, overwrite=True, **kwargs):
     settings: dict
         Dictionary with values for the pe.Node inputs.
         These will have higher priority than the ones in the global Configuration.
+        The 'n_procs' and 'mem_gb' items are the resource profile of the node,
+        see `pypes.resources`. The threads of the node interface are limited
+        to 'n_procs'.
+        The FSL and AFNI output types follow the `intermediate_format`
+        configuration setting, see `set_output_type`, and so does the
+        `image_settings` input of the nodes that have one, see `set_image_settings`.
 
     overwrite: bool
         If True will overwrite the settings of the node if they are already defined.
@@ -243,14 +252,26 @@ def setup_node(interface, name, settings=None, overwrite=True, **kwargs):
         node_class = JoinNode
     else:
         node_class = Node
-    node = node_class(interface=interface, name=name, **kwargs)
 
     params = _get_params_for(name)
     if settings is not None:
         params.update(settings)
 
+    for key in RESOURCE_KEYS:
+        if key in params:
+            kwargs.setdefault(key, params.pop(key))
+
+    node = node_class(interface=interface, name=name, **kwargs)
+
     _set_node_inputs(node, params, overwrite=overwrite)
 
+    set_output_type(node, params)
+    set_image_settings(node, params)
+
+    if kwargs.get('n_procs') is not None:
+        from .utils.environ import set_node_threads
+        set_node_threads(node, kwargs['n_procs'])
+
     return node
 
 
@@ -287,3 +308,105 @@ def check_atlas_file():
                                 'or give an existing atlas image.'.format(atlas_file))
     return True, atlas_file
 
+
+
+# the policies for the format of the intermediate images, see `intermediate_format`
+INTERMEDIATE_FORMATS = ('nii.gz', 'nii', 'sink')
+
+
+def intermediate_format():
+    """ Return the `intermediate_format` configuration setting, the policy
+    for the format of the images written by the workflow nodes:
+
+    - 'nii.gz': the format each node chooses, usually gzip compressed, default.
+    - 'nii': uncompressed NIfTI files, also in the output folder.
+    - 'sink': uncompressed NIfTI files in the work folder, the datasink
+      compresses them in the output folder.
+
+    The gzip compression level is the `compress_level` configuration setting,
+    default: 1, the fastest, and the `compress_threads` setting is the number
+    of threads that compress each file.
+
+    Returns
+    -------
+    fmt: str
+
+    Raises
+    ------
+    ValueError
+        If the setting is not any of INTERMEDIATE_FORMATS.
+    """
+    fmt = get_config_setting('intermediate_format', default='nii.gz')
+    if fmt not in INTERMEDIATE_FORMATS:
+        raise ValueError('Expected any of {} for `intermediate_format`, '
+                         'got {}.'.format(INTERMEDIATE_FORMATS, fmt))
+    return fmt
+
+
+def compress_intermediates():
+    """ Return True if the intermediate images can be gzip compressed."""
+    return intermediate_format() == 'nii.gz'
+
+
+def compress_at_sink():
+    """ Return True if the datasinks must compress the NIfTI files."""
+    return intermediate_format() == 'sink'
+
+
+def compress_level():
+    """ Return the `compress_level` configuration setting, the gzip
+    compression level of the images written by pypes, from 0 to 9."""
+    return int(get_config_setting('compress_level', default=1))
+
+
+def compress_threads():
+    """ Return the `compress_threads` configuration setting, the number of
+    threads that compress each NIfTI file written by the pypes Function
+    nodes, default: 1. See `pypes.utils.pgzip`."""
+    return int(get_config_setting('compress_threads', default=1))
+
+
+def intermediate_file(file_path, fmt=None):
+    """ Return `file_path` without its '.gz' extension if the intermediate
+    images must not be compressed with the `intermediate_format` `fmt`,
+    by default the configuration setting."""
+    if fmt is None:
+        fmt = intermediate_format()
+    if file_path.endswith('.gz') and fmt != 'nii.gz':
+        return file_path[:-3]
+    return file_path
+
+
+def image_settings():
+    """ Return the `intermediate_format` and `compress_level` configuration
+    settings as a dict, the value for the `image_settings` input of the nodes
+    that write images, so the settings are in the node hash and reach the
+    processes that run the nodes. See `set_image_settings`."""
+    return {'intermediate_format': intermediate_format(),
+            'compress_level':      compress_level()}
+
+
+def set_image_settings(node, params=None):
+    """ Set the `image_settings` input of `node`, if it has one, to the
+    current `image_settings`, unless it is given in the node `params`."""
+    params = params or {}
+    if 'image_settings' in params or not hasattr(node.inputs, 'image_settings'):
+        return
+
+    node.inputs.image_settings = image_settings()
+
+
+def set_output_type(node, params=None):
+    """ Set the output type of the FSL and AFNI interface of `node` to
+    uncompressed NIfTI if the intermediate images must not be compressed,
+    unless it is given in the node `params`."""
+    if compress_intermediates():
+        return
+
+    params = params or {}
+    for name in ('output_type', 'outputtype'):
+        if name in params or not hasattr(node.inputs, name):
+            continue
+
+        if getattr(node.inputs, name) == 'NIFTI_GZ':
+            setattr(node.inputs, name, 'NIFTI')
@@ -2,21 +2,214 @@
 """
 A nipype.SelectFiles node based on hansel.Crumb
 """
+import os
 import os.path as op
-from warnings import warn
+import json
+import time
+import tempfile
+from   collections import OrderedDict
+from   fnmatch import fnmatch
+from   string  import Formatter
+from   warnings import warn
 
 from hansel import Crumb
 
 from nipype.interfaces.base import (traits,
                                     DynamicTraitedSpec,
-                                    Undefined, BaseInterfaceInputSpec)
+                                    Undefined, BaseInterfaceInputSpec,
+                                    isdefined)
 from nipype.interfaces.io import IOBase, add_traits
+from nipype.interfaces.utility import IdentityInterface
 from nipype.utils.filemanip import list_to_filename
 from nipype.utils.misc import human_order_sorted
 
 from ._utils import get_values_map_keys
 
 
+class CrumbIndex(object):
+    """ A persistent index of the directory listings needed to unfold hansel.Crumb paths.
+
+    The listing of each folder is stored in a JSON file together with the
+    modification time of the folder. The listing is reused while the folder
+    mtime does not change, so unfolding a crumb over an unchanged tree costs
+    one `os.stat` per folder instead of one `os.listdir`.
+
+    The file is only rewritten by `save`, through a temporary file renamed
+    over it, which is safe on NFS mounts. The concurrent writers, e.g., the
+    shards of `pypes.run.run_shards`, merge their listings with the ones saved
+    meanwhile. The crumbs with arguments that do not fill whole path parts
+    are unfolded by hansel directly.
+
+    Parameters
+    ----------
+    index_file: str
+        Path to the JSON index file. It will be created by `save` if it does not exist.
+
+    readonly: bool
+        If True the listings are read from `index_file` but `save` does nothing,
+        e.g., for the `DataCrumb` nodes that run at the same time.
+    """
+    # listings of folders modified less than these seconds ago are not stored,
+    # a coarse mtime resolution (e.g., NFS) could hide a later change.
+    settle_time = 2.0
+
+    def __init__(self, index_file, readonly=False):
+        self.index_file = op.abspath(index_file)
+        self.readonly   = readonly
+        self._listings  = {}
+        self._stored    = None
+        self._new       = {}
+
+    def _load(self):
+        """ Return the listings stored in `index_file`: path -> [mtime, dirs, files]."""
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        """ Add the new settled listings to `index_file`."""
+        if self.readonly or not self._new:
+            return
+
+        stored = self._load()
+        stored.update(self._new)
+
+        index_dir = op.dirname(self.index_file)
+        os.makedirs(index_dir, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=index_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(stored, f)
+            os.replace(tmp_file, self.index_file)
+        except Exception:
+            if op.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+
+        self._stored = stored
+        self._new    = {}
+
+    def listdir(self, path):
+        """ Return a 2-tuple with the sorted lists of folder names and file names in `path`.
+        Return None if `path` is not an existing folder.
+        """
+        if path in self._listings:
+            return self._listings[path]
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        if self._stored is None:
+            self._stored = self._load()
+
+        entry = self._stored.get(path)
+        if entry is not None and entry[0] == stat.st_mtime_ns:
+            listing = (entry[1], entry[2])
+        else:
+            try:
+                entries = list(os.scandir(path))
+            except NotADirectoryError:
+                return None
+
+            listing = (sorted(e.name for e in entries if e.is_dir()),
+                       sorted(e.name for e in entries if not e.is_dir()))
+
+            if time.time() - stat.st_mtime > self.settle_time:
+                self._new[path] = [stat.st_mtime_ns, listing[0], listing[1]]
+
+        self._listings[path] = listing
+        return listing
+
+    @staticmethod
+    def _path_parts(crumb):
+        """ Return the `crumb` path parts as (part, arg name, arg regex), with
+        None as arg name for the fixed parts, or None if any argument does
+        not fill a whole part."""
+        parts = []
+        for part in crumb.path.split(op.sep)[1:]:
+            items = list(Formatter().parse(part))
+            if len(items) == 1 and not items[0][0] and items[0][1] is not None:
+                parts.append((part, items[0][1], items[0][2]))
+            elif any(item[1] is not None for item in items):
+                return None
+            else:
+                parts.append((part, None, None))
+        return parts
+
+    def values_map(self, crumb):
+        """ Return a list of lists of 2-tuples with the values of the open arguments
+        of `crumb` that fill it to an existing path.
+        This is the same as `crumb.values_map(check_exists=True)` for the last argument.
+
+        Parameters
+        ----------
+        crumb: hansel.Crumb
+            An absolute crumb path.
+
+        Returns
+        -------
+        values_map: list of lists of 2-tuples
+        """
+        if not crumb.isabs():
+            raise ValueError('Expected a Crumb with an absolute path, got {}.'.format(crumb))
+
+        parts = self._path_parts(crumb)
+        if parts is None:
+            # the arguments within a path part are left to hansel
+            return sorted(crumb.values_map(check_exists=True))
+
+        ignore   = crumb._ignore
+        re_args  = crumb._re_args if crumb._re_args is not None else ()
+        last     = len(parts)
+        branches = [('', [])]
+        for depth, (part, arg_name, arg_regex) in enumerate(parts, 1):
+            nu_branches = []
+            for path, record in branches:
+                listing = self.listdir(path if path else op.sep)
+                if listing is None:
+                    continue
+
+                dirs, files = listing
+                names = dirs + files if depth == last else dirs
+                if arg_name is None:
+                    if part in names:
+                        nu_branches.append((op.join(path, part) if path else op.sep + part, record))
+                    continue
+
+                names = [name for name in names if not any(fnmatch(name, ign) for ign in ignore)]
+                if arg_regex:
+                    names = crumb._match_filter(arg_regex, names, *re_args)
+
+                nu_branches.extend([(op.join(path, name) if path else op.sep + name,
+                                     record + [(arg_name, name)])
+                                    for name in names])
+            branches = nu_branches
+
+        return sorted(record for _, record in branches)
+
+    def joint_value_map(self, crumb, arg_names):
+        """ Return a sorted list of tuples of 2-tuples with the values of the crumb
+        arguments `arg_names` that lead to existing paths, as `hansel.utils.joint_value_map`.
+        """
+        values_map = set()
+        for record in self.values_map(crumb):
+            values = dict(record)
+            values_map.add(tuple((arg_name, values[arg_name]) for arg_name in arg_names))
+        return sorted(values_map)
+
+    def unfold(self, crumb):
+        """ Return a sorted list of the existing paths that `crumb` can be unfolded into."""
+        return sorted(crumb.replace(**dict(record)).path for record in self.values_map(crumb))
+
+    def exists(self, crumb):
+        """ Return True if `crumb` can be filled to at least one existing path."""
+        return bool(self.values_map(crumb))
+
+
 class DataCrumbInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
     sort_filelist = traits.Bool(True, usedefault=True,
                                 desc='Sort the filelist that matches the template. Crumb always sort its outputs.')
@@ -28,6 +221,8 @@ class DataCrumbInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
                                       "matches the template. Either a boolean that applies to all "
                                       "output fields or a list of output field names to coerce to "
                                       " a list"))
+    index_file = traits.Str(desc=("Path to a CrumbIndex file used, read-only, to resolve the crumb paths. "
+                                  "If not set, the file system will be listed directly."))
 
 
 class DataCrumb(IOBase):
@@ -122,7 +317,13 @@ class DataCrumb(IOBase):
         if not ocrumb.isabs():
             raise ValueError('Expected a Crumb with an absolute path, got {}.'.format(ocrumb))
 
-        if not ocrumb.exists():
+        index = None
+        if isdefined(self.inputs.index_file) and self.inputs.index_file:
+            # the nodes of all the subjects run at once, only the build saves the index
+            index = CrumbIndex(self.inputs.index_file, readonly=True)
+
+        crumb_exists = index.exists(ocrumb) if index is not None else ocrumb.exists()
+        if not crumb_exists:
             raise IOError('Expected an existing Crumb path, got {}.'.format(ocrumb))
 
         # loop over all the ouput items and fill them with the info in templates
@@ -134,7 +335,10 @@ class DataCrumb(IOBase):
             if list(focrumb.open_args()):
                 raise ValueError('Expected a full specification of the Crumb path by now, got {}.'.format(focrumb))
 
-            filelist = [cr.path for cr in focrumb.unfold()]
+            if index is not None:
+                filelist = index.unfold(focrumb)
+            else:
+                filelist = [cr.path for cr in focrumb.unfold()]
             # Handle the case where nothing matched
             if not filelist:
                 msg = "No files were found unfolding %s crumb path: %s" % (
@@ -159,3 +363,76 @@ class DataCrumb(IOBase):
                 outputs[arg_name] = focrumb[arg_name][0]
 
         return outputs
+
+
+def crumb_file_table(crumb, templates, arg_names, index=None, sort_filelist=True):
+    """ Unfold `crumb` once and resolve all the file `templates` for each
+    combination of the crumb arguments `arg_names`.
+
+    Parameters
+    ----------
+    crumb: hansel.Crumb
+        An absolute crumb path.
+
+    templates : dict[str] -> list of 2-tuples
+        Mapping from field names to list of crumb arguments in `crumb`
+        that must be replaced to complete the file crumb path.
+        The values can be fnmatch patterns.
+
+    arg_names: list of str
+        The crumb arguments that identify each subject/session,
+        usually the ones not present in `templates`.
+
+    index: CrumbIndex
+        If given, the file system will be listed through this index.
+
+    sort_filelist: bool
+        If True will sort the list of files of each field.
+
+    Returns
+    -------
+    table: OrderedDict[tuple of str] -> dict[str] -> list of str
+        For each tuple of values of `arg_names`, a dict with the list of
+        files for each field in `templates`.
+    """
+    if index is not None:
+        values_map = index.values_map(crumb)
+    else:
+        values_map = crumb.values_map(check_exists=True)
+
+    table = OrderedDict()
+    for record in sorted(values_map):
+        values = dict(record)
+        key = tuple(values[arg_name] for arg_name in arg_names)
+        files = table.setdefault(key, {field: [] for field in templates})
+        for field, template in templates.items():
+            if all(fnmatch(values[arg], val) for arg, val in template):
+                files[field].append(crumb.replace(**values).path)
+
+    if sort_filelist:
+        for files in table.values():
+            for field in files:
+                files[field] = human_order_sorted(files[field])
+
+    return table
+
+
+class DataCrumbTable(IdentityInterface):
+    """ The pass-through counterpart of DataCrumb for already resolved files.
+
+    It has the same fields as the DataCrumb for `crumb` and `templates`, but
+    its values are set from a `crumb_file_table` through the iterables of
+    the input node. Being an IdentityInterface, nipype removes it from the
+    execution graph, so no node is run to select the files of each subject.
+    """
+    def __init__(self, crumb, templates, **inputs):
+        files_args = get_values_map_keys(templates)
+
+        self._crumb     = crumb
+        self._templates = templates
+        self._infields  = [name for name in list(crumb.all_args()) if name not in files_args]
+        self._outfields = list(templates)
+
+        super(DataCrumbTable, self).__init__(fields=self._infields + self._outfields,
+                                             mandatory_inputs=False,
+                                             **inputs)
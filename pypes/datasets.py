@@ -194,7 +194,8 @@ def _clinical_wf_setup(wf_name):
     return OrderedDict(attach_functions[wf_name]), wf_params, files_crumb_args
 
 
-def cobre_crumb_workflow(wf_name, data_crumb, output_dir, cache_dir='', config_file='', params=None):
+def cobre_crumb_workflow(wf_name, data_crumb, output_dir, cache_dir='', config_file='', params=None,
+                         **kwargs):
     """ Returns a workflow for the COBRE database.
 
     Parameters
@@ -224,6 +225,9 @@ def cobre_crumb_workflow(wf_name, data_crumb, output_dir, cache_dir='', config_f
         crumb_replaces
 
         atlas_file
+
+    kwargs: keyword arguments
+        Extra arguments for `pypes.io.build_crumb_workflow`, e.g., `batch_select`.
     """
     attach_funcs, cfg_params, file_templates = _cobre_wf_setup(wf_name)
 
@@ -243,12 +247,14 @@ def cobre_crumb_workflow(wf_name, data_crumb, output_dir, cache_dir='', config_f
                               data_crumb=data_crumb,
                               in_out_kwargs=file_templates,
                               output_dir=output_dir,
-                              cache_dir=cache_dir,)
+                              cache_dir=cache_dir,
+                              **kwargs)
 
     return wf
 
 
-def clinical_crumb_workflow(wf_name, data_crumb, output_dir, cache_dir='', config_file='', params=None):
+def clinical_crumb_workflow(wf_name, data_crumb, output_dir, cache_dir='', config_file='', params=None,
+                            **kwargs):
     """ Returns a workflow for the a clinical database.
 
     Parameters
@@ -281,6 +287,9 @@ def clinical_crumb_workflow(wf_name, data_crumb, output_dir, cache_dir='', confi
         atlas_file
 
         raise_on_filenotfound
+
+    kwargs: keyword arguments
+        Extra arguments for `pypes.io.build_crumb_workflow`, e.g., `batch_select`.
     """
     attach_funcs, cfg_params, file_templates = _clinical_wf_setup(wf_name)
 
@@ -300,7 +309,8 @@ def clinical_crumb_workflow(wf_name, data_crumb, output_dir, cache_dir='', confi
                               data_crumb=data_crumb,
                               in_out_kwargs=file_templates,
                               output_dir=output_dir,
-                              cache_dir=cache_dir,)
+                              cache_dir=cache_dir,
+                              **kwargs)
 
     return wf
 
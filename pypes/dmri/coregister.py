@@ -5,9 +5,9 @@ Nipype workflows to co-register anatomical MRI to diffusion MRI.
 import nipype.pipeline.engine as pe
 from   nipype.interfaces.fsl     import MultiImageMaths
 from   nipype.interfaces.utility import IdentityInterface, Select, Split
-from   nipype.algorithms.misc import Gunzip
 
 from .._utils  import flatten_list
+from ..interfaces.files import Gunzip
 from ..config  import setup_node, check_atlas_file
 from ..preproc import spm_coregister
 
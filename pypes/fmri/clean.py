@@ -4,20 +4,21 @@ Nipype workflow to clean up resting-state functional MRI.
 """
 import nipype.pipeline.engine as pe
 import os.path as op
-from   nipype.algorithms.misc import Gunzip
 from   nipype.interfaces import fsl
 from   nipype.interfaces.nipy.preprocess import Trim, ComputeMask
 from   nipype.interfaces.utility import Function, Select, IdentityInterface
 from   pypes.interfaces.nilearn import mean_img, smooth_img
 
-from   .filter import bandpass_filter
+from   .filter import bandpass_filter, clean_fmri
 from   .nuisance import rest_noise_filter_wf
 from   .._utils import format_pair_list, flatten_list
+from   ..interfaces.files import Gunzip
 from   ..config import setup_node, get_config_setting
 from   ..preproc import (auto_spm_slicetime,
                          nipy_motion_correction,
                          spm_coregister,
                          )
+from   ..preproc.motion_stats import motion_power_stats_wf
 from   ..utils  import (remove_ext,
                         extend_trait_list,
                         get_input_node,
@@ -34,11 +35,17 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
     - Trim first 6 volumes of the rs-fMRI file.
     - Slice Timing correction.
     - Motion and nuisance correction.
+    - Motion statistics, QC and censor mask, with the `fmri_cleanup.motion_stats` setting,
+      see `pypes.preproc.motion_stats.motion_power_stats_wf`.
     - Calculate brain mask in fMRI space.
     - Bandpass frequency filtering for resting-state fMRI.
     - Smoothing.
     - Tissue maps co-registration to fMRI space.
 
+    With the `fmri_cleanup.fused` setting the nuisance regression and the
+    bandpass filter are done in one pass by the `clean` node, see
+    `pypes.fmri.filter.clean_fmri`.
+
     Parameters
     ----------
     wf_name: str
@@ -68,6 +75,7 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
 
     rest_output.nuis_corrected: traits.File
         The nuisance corrected fMRI file.
+        With `fmri_cleanup.fused` only if `clean.save_steps` is True.
 
     rest_output.motion_params: traits.File
         The affine transformation file.
@@ -95,8 +103,31 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
 
     rest_output.motion_regressors: traits.File
 
+    The motion statistics outputs are only connected with `fmri_cleanup.motion_stats`,
+    or `fmri_cleanup.fused` and `fmri_cleanup.censor`.
+
+    rest_output.fd_power, rest_output.fd_jenkinson: traits.File
+        The framewise displacement of Power et al., 2012 and Jenkinson et al., 2002.
+
+    rest_output.friston24: traits.File
+        The Friston 24 motion parameters.
+
+    rest_output.censor_mask: traits.File
+        Boolean vector, True for the volumes censored by their FD and DVARS.
+        With `fmri_cleanup.fused` and `fmri_cleanup.censor` the `clean` node
+        leaves them out of the nuisance regression.
+
+    rest_output.power_params, rest_output.motion_stats: traits.File
+        The Power and motion parameters summary text files.
+
+    rest_output.motion_qc: traits.File
+        The motion QC measures JSON file, see `pypes.qc.save_motion_qc`.
+
     rest_output.compcor_regressors: traits.File
 
+    rest_output.compcor_variance: traits.File
+        The explained variance ratio of the CompCor components.
+
     rest_output.art_displacement_files
         One image file containing the voxel-displacement timeseries.
 
@@ -144,6 +175,7 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
                   "tissues_brain_mask",
                   "motion_regressors",
                   "compcor_regressors",
+                  "compcor_variance",
                   "gsr_regressors",
                   "nuis_corrected",
                   "art_displacement_files",
@@ -151,7 +183,14 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
                   "art_norm_files",
                   "art_outlier_files",
                   "art_plot_files",
-                  "art_statistic_files",]
+                  "art_statistic_files",
+                  "fd_power",
+                  "fd_jenkinson",
+                  "friston24",
+                  "censor_mask",
+                  "power_params",
+                  "motion_stats",
+                  "motion_qc",]
 
     # input identities
     rest_input = setup_node(IdentityInterface(fields=in_fields, mandatory_inputs=True),
@@ -164,7 +203,8 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
     realign = setup_node(nipy_motion_correction(), name='realign')
 
     # average
-    average = setup_node(Function(function=mean_img, input_names=["in_file"], output_names=["out_file"],
+    average = setup_node(Function(function=mean_img, input_names=["in_file", "image_settings"],
+                                  output_names=["out_file"],
                                   imports=['from pypes.interfaces.nilearn import ni2file']),
                          name='average_epi')
 
@@ -186,23 +226,62 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
     gm_select    = setup_node(Select(index=[0]),    name="gm_sel")
     wmcsf_select = setup_node(Select(index=[1, 2]), name="wmcsf_sel")
 
+    # with the fused cleaning the nuisance regressors are regressed by the `clean` node
+    fused = get_config_setting('fmri_cleanup.fused', default=False)
+
+    # motion statistics of the parameters of the nipy realigner, needed for the censor mask
+    censor = fused and get_config_setting('fmri_cleanup.censor', default=False)
+    if censor or get_config_setting('fmri_cleanup.motion_stats', default=False):
+        motion_stats = motion_power_stats_wf(params_format='nipy')
+    else:
+        motion_stats = None
+
     # noise filter
-    noise_wf   = rest_noise_filter_wf()
+    noise_wf   = rest_noise_filter_wf(regress=not fused)
     wm_select  = setup_node(Select(index=[1]), name="wm_sel")
     csf_select = setup_node(Select(index=[2]), name="csf_sel")
 
-    # bandpass filtering
-    bandpass = setup_node(Function(input_names=['files',
-                                                'lowpass_freq',
-                                                'highpass_freq',
-                                                'tr'],
-                                   output_names=['out_files'],
-                                   function=bandpass_filter),
-                          name='bandpass')
+    if fused:
+        # censoring, detrending, nuisance regression, bandpass filtering and standardization in one pass
+        clean = setup_node(Function(input_names=['in_file',
+                                                 'mask_file',
+                                                 'confound_files',
+                                                 'censor_file',
+                                                 'detrend_poly',
+                                                 'lowpass_freq',
+                                                 'highpass_freq',
+                                                 'tr',
+                                                 'method',
+                                                 'padding',
+                                                 'order',
+                                                 'standardize',
+                                                 'save_steps',
+                                                 'image_settings'],
+                                    output_names=['out_file',
+                                                  'nuis_corrected'],
+                                    function=clean_fmri),
+                           name='clean')
+        clean.inputs.method = get_config_setting('fmri_cleanup.bandpass', default='fft')
+        time_filter, time_filtered = clean, 'out_file'
+    else:
+        # bandpass filtering
+        bandpass = setup_node(Function(input_names=['files',
+                                                    'lowpass_freq',
+                                                    'highpass_freq',
+                                                    'tr',
+                                                    'padding',
+                                                    'method',
+                                                    'order',
+                                                    'image_settings'],
+                                       output_names=['out_files'],
+                                       function=bandpass_filter),
+                              name='bandpass')
+        bandpass.inputs.method = get_config_setting('fmri_cleanup.bandpass', default='fft')
+        time_filter, time_filtered = bandpass, 'out_files'
 
     # smooth
     smooth = setup_node(Function(function=smooth_img,
-                                 input_names=["in_file", "fwhm"],
+                                 input_names=["in_file", "fwhm", "image_settings"],
                                  output_names=["out_file"],
                                  imports=['from pypes.interfaces.nilearn import ni2file']),
                          name="smooth")
@@ -254,13 +333,11 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
                 (realign,       noise_wf,   [("par_file",             "rest_noise_input.motion_params",)]),
 
                 # temporal filtering
-                (noise_wf,    bandpass,    [("rest_noise_output.nuis_corrected", "files")]),
-                #(realign,     bandpass,    [("out_file", "files")]),
-                (stc_wf,      bandpass,    [("stc_output.time_repetition", "tr")]),
-                (rest_input,  bandpass,    [("lowpass_freq",               "lowpass_freq"),
+                (stc_wf,      time_filter, [("stc_output.time_repetition", "tr")]),
+                (rest_input,  time_filter, [("lowpass_freq",               "lowpass_freq"),
                                             ("highpass_freq",              "highpass_freq"),
                                            ]),
-                (bandpass,     smooth,     [("out_files", "in_file")]),
+                (time_filter, smooth,      [(time_filtered,                "in_file")]),
 
                 # output
                 (epi_mask,    rest_output, [("brain_mask", "epi_brain_mask")]),
@@ -273,8 +350,8 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
                                            ]),
                 (noise_wf,    rest_output, [("rest_noise_output.motion_regressors",      "motion_regressors"),
                                             ("rest_noise_output.compcor_regressors",     "compcor_regressors"),
+                                            ("rest_noise_output.compcor_variance",       "compcor_variance"),
                                             ("rest_noise_output.gsr_regressors",         "gsr_regressors"),
-                                            ("rest_noise_output.nuis_corrected",         "nuis_corrected"),
                                             ("rest_noise_output.tsnr_file",              "tsnr_file"),
                                             ("rest_noise_output.art_displacement_files", "art_displacement_files"),
                                             ("rest_noise_output.art_intensity_files",    "art_intensity_files"),
@@ -284,10 +361,47 @@ def fmri_cleanup_wf(wf_name="fmri_cleanup"):
                                             ("rest_noise_output.art_statistic_files",    "art_statistic_files"),
                                            ]),
                 (average,     rest_output, [("out_file",  "avg_epi")]),
-                (bandpass,    rest_output, [("out_files", "time_filtered")]),
-                (smooth,      rest_output, [("out_file",  "smooth")]),
+                (time_filter, rest_output, [(time_filtered, "time_filtered")]),
+                (smooth,      rest_output, [("out_file",    "smooth")]),
               ])
 
+    if motion_stats is not None:
+        wf.connect([
+                    (realign,      motion_stats, [("out_file", "inputspec.motion_correct"),
+                                                  ("par_file", "inputspec.movement_parameters"),
+                                                 ]),
+                    (tissue_mask,  motion_stats, [("out_file", "inputspec.mask")]),
+
+                    (motion_stats, rest_output,  [("outputspec.FD_1D",         "fd_power"),
+                                                  ("outputspec.FDJ_1D",        "fd_jenkinson"),
+                                                  ("outputspec.friston24_1D",  "friston24"),
+                                                  ("outputspec.censor_mask",   "censor_mask"),
+                                                  ("outputspec.power_params",  "power_params"),
+                                                  ("outputspec.motion_params", "motion_stats"),
+                                                  ("outputspec.qc_file",       "motion_qc"),
+                                                 ]),
+                   ])
+
+    if fused:
+        wf.connect([
+                    (realign,     clean,       [("out_file",                              "in_file")]),
+                    (tissue_mask, clean,       [("out_file",                              "mask_file")]),
+                    (noise_wf,    clean,       [("rest_noise_output.nuisance_regressors", "confound_files")]),
+                   ])
+
+        # the censored volumes are left out of the nuisance regression
+        if censor:
+            wf.connect([(motion_stats, clean, [("outputspec.censor_mask", "censor_file")])])
+
+        # the image before the temporal filter, for QC
+        if get_config_setting('clean.save_steps', default=False):
+            wf.connect([(clean, rest_output, [("nuis_corrected", "nuis_corrected")])])
+    else:
+        wf.connect([
+                    (noise_wf,    bandpass,    [("rest_noise_output.nuis_corrected",      "files")]),
+                    (noise_wf,    rest_output, [("rest_noise_output.nuis_corrected",      "nuis_corrected")]),
+                   ])
+
     return wf
 
 
@@ -356,6 +470,25 @@ def attach_fmri_cleanup_wf(main_wf, wf_name="fmri_cleanup"):
     datasink.inputs.regexp_substitutions = extend_trait_list(datasink.inputs.regexp_substitutions,
                                                              regexp_subst)
 
+    # the ids in the motion statistics files
+    motion_stats_input = cleanup_wf.get_node('gen_motion_stats.inputspec')
+    if motion_stats_input is not None:
+        motion_stats_input.inputs.scan_id = rest_fbasename
+        infosrc = main_wf.get_node('infosrc')
+        if infosrc is not None and hasattr(infosrc.inputs, 'subject_id'):
+            main_wf.connect([(infosrc, cleanup_wf, [("subject_id", "gen_motion_stats.inputspec.subject_id")])])
+
+        main_wf.connect([(cleanup_wf, datasink, [
+                                                 ("rest_output.fd_power",     "rest.motion_stats.@fd_power"),
+                                                 ("rest_output.fd_jenkinson", "rest.motion_stats.@fd_jenkinson"),
+                                                 ("rest_output.friston24",    "rest.motion_stats.@friston24"),
+                                                 ("rest_output.censor_mask",  "rest.motion_stats.@censor_mask"),
+                                                 ("rest_output.power_params", "rest.motion_stats.@power_params"),
+                                                 ("rest_output.motion_stats", "rest.motion_stats.@motion_params"),
+                                                 ("rest_output.motion_qc",    "rest.motion_stats.@motion_qc"),
+                                                ]),
+                        ])
+
     # input and output anat workflow to main workflow connections
     main_wf.connect([(in_files,   cleanup_wf, [("rest", "rest_input.in_file")]),
 
@@ -372,6 +505,7 @@ def attach_fmri_cleanup_wf(main_wf, wf_name="fmri_cleanup"):
                                                 ("rest_output.anat",                   "rest.@anat"),
                                                 ("rest_output.motion_regressors",      "rest.@motion_regressors"),
                                                 ("rest_output.compcor_regressors",     "rest.@compcor_regressors"),
+                                                ("rest_output.compcor_variance",       "rest.@compcor_variance"),
                                                 ("rest_output.gsr_regressors",         "rest.@gsr_regressors"),
                                                 ("rest_output.motion_params",          "rest.@motion_params"),
                                                 ("rest_output.motion_corrected",       "rest.@motion_corrected"),
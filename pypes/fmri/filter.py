@@ -2,11 +2,194 @@
 """
 fMRI timeseries filtering helpers.
 """
+import numpy as np
 
 
-def bandpass_filter(files, lowpass_freq=0.1, highpass_freq=0.01, tr=2):
+PADDING_MODES = {'zero':   'constant',
+                 'mirror': 'reflect',
+                }
+
+
+def pad_timecourses(timecourses, padding=None):
+    """ Return the rows of `timecourses` with half their length added at both
+    ends, zeros if `padding` is 'zero' or their mirror image if 'mirror',
+    and the length added at each end."""
+    if not padding:
+        return timecourses, 0
+
+    pad = timecourses.shape[1] // 2
+    return np.pad(timecourses, ((0, 0), (pad, pad)), mode=PADDING_MODES[padding]), pad
+
+
+def fft_bandpass_weights(timepoints, tr, lowpass_freq=0.1, highpass_freq=0.01):
+    """ Return the weights of the `np.fft.rfft` frequencies of a time series
+    of `timepoints` for the ideal bandpass filter of `bandpass_filter`.
+
+    Parameters
+    ----------
+    timepoints: int
+        Length of the time series.
+
+    tr: float
+        The repetition time in seconds.
+
+    lowpass_freq: float
+        Cutoff frequency for the low pass filter (in Hz).
+
+    highpass_freq: float
+        Cutoff frequency for the high pass filter (in Hz).
+
+    Returns
+    -------
+    weights: np.ndarray
+        Array of shape (timepoints // 2 + 1, ).
+    """
+    fs = 1./tr
+
+    F = np.zeros((timepoints))
+
+    lowidx = int(timepoints / 2) + 1
+    if lowpass_freq > 0:
+        lowidx = int(np.round(float(lowpass_freq) / fs * timepoints))
+
+    highidx = 0
+    if highpass_freq > 0:
+        highidx = int(np.round(float(highpass_freq) / fs * timepoints))
+    F[highidx:lowidx] = 1
+    F = ((F + F[::-1]) > 0).astype(float)
+
+    # the real part of the inverse FFT of a real series filtered by F
+    # is its inverse FFT filtered by the conjugate symmetric part of F
+    F = (F + np.roll(F[::-1], 1)) / 2
+    return F[:timepoints // 2 + 1]
+
+
+def fft_bandpass(timecourses, tr, lowpass_freq=0.1, highpass_freq=0.01, padding=None):
+    """ Return the rows of `timecourses` filtered with the ideal bandpass
+    filter of `fft_bandpass_weights`, along the time axis only.
+
+    Parameters
+    ----------
+    timecourses: np.ndarray
+        Array of shape (n_voxels, timepoints).
+
+    tr: float
+
+    lowpass_freq: float
+
+    highpass_freq: float
+
+    padding: str
+        Choices: None, 'zero', 'mirror'.
+        If set, half the length of the time series is added at both of
+        its ends before filtering, zeros or its mirror image.
+
+    Returns
+    -------
+    filtered: np.ndarray
+        Array of the same shape and data type as `timecourses`.
+    """
+    timepoints = timecourses.shape[1]
+    timecourses, pad = pad_timecourses(timecourses, padding)
+
+    n_fft   = timecourses.shape[1]
+    weights = fft_bandpass_weights(n_fft, tr, lowpass_freq=lowpass_freq, highpass_freq=highpass_freq)
+
+    spectrum  = np.fft.rfft(timecourses, axis=1)
+    spectrum *= weights
+    filtered  = np.fft.irfft(spectrum, n=n_fft, axis=1)
+    return filtered[:, pad:pad + timepoints].astype(timecourses.dtype)
+
+
+def butterworth_sos(tr, lowpass_freq=0.1, highpass_freq=0.01, order=5):
+    """ Return the second-order sections of a Butterworth bandpass filter.
+
+    Parameters
+    ----------
+    tr: float
+        The repetition time in seconds.
+
+    lowpass_freq: float
+        Cutoff frequency for the low pass filter (in Hz).
+        No low pass if it is 0 or above the Nyquist frequency.
+
+    highpass_freq: float
+        Cutoff frequency for the high pass filter (in Hz).
+        No high pass if it is 0.
+
+    order: int
+        Order of the filter.
+
+    Returns
+    -------
+    sos: np.ndarray or None
+        None if there is nothing to filter.
+    """
+    from scipy.signal import butter
+
+    nyquist = 0.5 / tr
+
+    cutoffs = []
+    if highpass_freq > 0:
+        cutoffs.append(highpass_freq / nyquist)
+    if 0 < lowpass_freq < nyquist:
+        cutoffs.append(lowpass_freq / nyquist)
+
+    if not cutoffs:
+        return None
+
+    if len(cutoffs) == 2:
+        btype = 'bandpass'
+    else:
+        btype = 'highpass' if highpass_freq > 0 else 'lowpass'
+
+    return butter(order, cutoffs if len(cutoffs) == 2 else cutoffs[0], btype=btype, output='sos')
+
+
+def butterworth_bandpass(timecourses, sos, padding=None):
+    """ Return the rows of `timecourses` filtered forward and backward, with
+    zero phase, with the second-order sections `sos` of `butterworth_sos`.
+
+    Parameters
+    ----------
+    timecourses: np.ndarray
+        Array of shape (n_voxels, timepoints).
+
+    sos: np.ndarray
+
+    padding: str
+        Choices: None, 'zero', 'mirror'. See `pad_timecourses`.
+        If None, the scipy.signal.sosfiltfilt default padding.
+
+    Returns
+    -------
+    filtered: np.ndarray
+        Array of the same shape and data type as `timecourses`.
+    """
+    from scipy.signal import sosfiltfilt
+
+    timepoints = timecourses.shape[1]
+    if not padding:
+        return sosfiltfilt(sos, timecourses, axis=1).astype(timecourses.dtype)
+
+    padded, pad = pad_timecourses(timecourses, padding)
+    filtered = sosfiltfilt(sos, padded, axis=1, padtype=None)
+    return filtered[:, pad:pad + timepoints].astype(timecourses.dtype)
+
+
+def bandpass_filter(files, lowpass_freq=0.1, highpass_freq=0.01, tr=2, padding=None,
+                    mask_file=None, method='fft', order=5, n_threads=None, chunk_size=10000,
+                    image_settings=None):
     """Bandpass filter the input files
 
+    The time series of the voxels are filtered in float32, in slabs of
+    whole slices of about `chunk_size` voxels run by `n_threads` threads.
+    Each slab is read from the image file and its filtered time series are
+    written to a memory-mapped array in the working directory, so only the
+    slabs being filtered are in memory. The gzipped images are read from
+    their `pypes.imgcache.cached_file` copy, or from a temporary uncompressed
+    copy if the image cache is not enabled.
+
     Parameters
     ----------
     files: list of str
@@ -20,8 +203,36 @@ def bandpass_filter(files, lowpass_freq=0.1, highpass_freq=0.01, tr=2):
 
     tr: float
         The repetition time in seconds. The inverse of sampling rate (in Hz).
+
+    padding: str
+        Choices: None, 'zero', 'mirror'. See `fft_bandpass`.
+
+    mask_file: str
+        Path to a 3D mask. If set, the voxels out of it are 0 in the output.
+        Otherwise, the voxels whose time series is not only zeros are filtered.
+
+    method: str
+        Choices: 'fft', 'butterworth'.
+        - 'fft': the ideal filter of `fft_bandpass`.
+        - 'butterworth': the zero phase Butterworth filter of `butterworth_bandpass`.
+
+    order: int
+        Order of the Butterworth filter.
+
+    n_threads: int
+        Number of threads to filter the slabs of voxels and to compress the output.
+        Default: the threads of the node, see `pypes.utils.environ.node_threads`.
+
+    chunk_size: int
+        Number of voxels in each slab, at least one slice.
+
+    image_settings: dict
+        The format of the output images, see `pypes.config.image_settings`.
     """
     import os
+    import tempfile
+    from   functools import partial
+    from   concurrent.futures import ThreadPoolExecutor
 
     import nibabel as nb
     import numpy as np
@@ -29,33 +240,287 @@ def bandpass_filter(files, lowpass_freq=0.1, highpass_freq=0.01, tr=2):
                                           list_to_filename,
                                           split_filename)
 
-    fs = 1./tr
+    from   pypes.fmri.filter import (fft_bandpass,
+                                     fft_bandpass_weights,
+                                     butterworth_bandpass,
+                                     butterworth_sos)
+    from   pypes.imgcache import cached_file, ImageCache, GZIPPED_EXT
+    from   pypes.config import intermediate_file
+    from   pypes.utils.files import save_nifti
+    from   pypes.utils.environ import node_threads
+
+    image_settings = image_settings or {}
+    if n_threads is None:
+        n_threads = node_threads()
+
+    if method == 'butterworth':
+        sos = butterworth_sos(tr, lowpass_freq=lowpass_freq, highpass_freq=highpass_freq, order=order)
+        filter_block = partial(butterworth_bandpass, sos=sos, padding=padding)
+    elif method == 'fft':
+        filter_block = partial(fft_bandpass, tr=tr, lowpass_freq=lowpass_freq,
+                               highpass_freq=highpass_freq, padding=padding)
+    else:
+        raise ValueError("Expected 'fft' or 'butterworth' for `method`, got {}.".format(method))
+
+    mask = None
+    if mask_file:
+        mask = np.asanyarray(nb.load(mask_file).dataobj) > 0
 
     out_files = []
     for filename in filename_to_list(files):
         path, name, ext = split_filename(filename)
-        out_file = os.path.join(os.getcwd(), name + '_bandpassed' + ext)
-
-        img = nb.load(filename)
-        timepoints = img.shape[-1]
-        F = np.zeros((timepoints))
-
-        lowidx = int(timepoints / 2) + 1
-        if lowpass_freq > 0:
-            lowidx = np.round(float(lowpass_freq) / fs * timepoints)
-
-        highidx = 0
-        if highpass_freq > 0:
-            highidx = np.round(float(highpass_freq) / fs * timepoints)
-        F[highidx:lowidx] = 1
-        F = ((F + F[::-1]) > 0).astype(int)
-        data = img.get_data()
-        if np.all(F == 1):
-            filtered_data = data
-        else:
-            filtered_data = np.real(np.fft.ifftn(np.fft.fftn(data) * F))
-        img_out = nb.Nifti1Image(filtered_data, img.affine, img.header)
-        img_out.to_filename(out_file)
+        out_file = intermediate_file(os.path.join(os.getcwd(), name + '_bandpassed' + ext),
+                                     image_settings.get('intermediate_format'))
+
+        with tempfile.TemporaryDirectory(dir=os.getcwd()) as tmp_dir:
+            # the slabs are read from an uncompressed file, a gzipped one would be inflated for each slab
+            img_file = cached_file(filename)
+            if img_file.endswith(GZIPPED_EXT):
+                img_file = ImageCache(tmp_dir, max_bytes=0).get(filename)
+
+            img = nb.load(img_file, keep_file_open=True)
+            timepoints = img.shape[-1]
+
+            if method == 'butterworth':
+                do_filter = sos is not None
+            else:
+                weights = fft_bandpass_weights(timepoints, tr, lowpass_freq=lowpass_freq,
+                                               highpass_freq=highpass_freq)
+                do_filter = padding or not np.all(weights == 1)
+
+            filtered = np.memmap(os.path.join(tmp_dir, 'bandpassed.dat'), dtype=np.float32,
+                                 mode='w+', shape=img.shape, order='F')
+
+            def filter_slab(dataobj, filtered, slices):
+                # the voxel time series are the rows of the C ordered slab
+                slab = np.ascontiguousarray(dataobj[:, :, slices], dtype=np.float32)
+                timecourses = slab.reshape(-1, timepoints)
+
+                if mask is not None:
+                    in_mask = mask[:, :, slices].reshape(-1)
+                    timecourses[~in_mask] = 0
+                else:
+                    in_mask = np.any(timecourses != 0, axis=1)
+
+                if do_filter and in_mask.any():
+                    timecourses[in_mask] = filter_block(timecourses[in_mask])
+                filtered[:, :, slices] = slab
+
+            # the slabs have different voxels, the FFT and the SciPy filters release the GIL
+            n_slices = max(1, chunk_size // (img.shape[0] * img.shape[1]))
+            with ThreadPoolExecutor(max_workers=max(1, int(n_threads))) as pool:
+                list(pool.map(partial(filter_slab, img.dataobj, filtered),
+                              [slice(start, start + n_slices)
+                               for start in range(0, img.shape[2], n_slices)]))
+
+            header = img.header.copy()
+            header.set_data_dtype(np.float32)
+            img_out = nb.Nifti1Image(filtered, img.affine, header)
+            save_nifti(img_out, out_file,
+                       compresslevel=image_settings.get('compress_level'),
+                       n_threads=n_threads)
+            del img_out, filtered, img
+
         out_files.append(out_file)
 
     return list_to_filename(out_files)
+
+
+def clean_timecourses(timecourses, confounds=None, censor=None, detrend_poly=0,
+                      filter_block=None, standardize=False, regressed=None, chunk_size=10000):
+    """ Clean the voxel time courses in place: regress out a constant, the
+    polynomial trends and the `confounds`, fitting only the volumes not
+    censored, then filter them in time and standardize them.
+
+    Parameters
+    ----------
+    timecourses: np.ndarray
+        Array of shape (timepoints, n_voxels).
+
+    confounds: np.ndarray
+        Array of shape (timepoints, n_confounds).
+
+    censor: np.ndarray of bool
+        True for the volumes to censor. As with spike regressors, they are
+        not used in the fit and they are 0 after the regression.
+        See `pypes.preproc.censor.censor_mask`.
+
+    detrend_poly: int
+        Number of Legendre polynomials to regress out, besides the constant.
+
+    filter_block: function
+        Filter of the rows of an array of shape (n_voxels, timepoints),
+        e.g., a partial of `fft_bandpass` or `butterworth_bandpass`.
+
+    standardize: bool
+        If True, scale the time courses to unit variance over the volumes
+        not censored.
+
+    regressed: np.ndarray
+        If given, the time courses after the regression, before filtering,
+        are also saved in it. Same shape as `timecourses`.
+
+    chunk_size: int
+        Number of voxels to clean at a time.
+
+    Returns
+    -------
+    timecourses: np.ndarray
+    """
+    from scipy.special import legendre
+
+    timepoints = timecourses.shape[0]
+
+    regressors = [np.ones((timepoints, 1))]
+    for idx in range(detrend_poly):
+        regressors.append(legendre(idx + 1)(np.linspace(-1, 1, timepoints))[:, None])
+    if confounds is not None and confounds.size:
+        regressors.append(confounds.reshape(timepoints, -1))
+    X = np.hstack(regressors)
+
+    kept = np.ones(timepoints, dtype=bool) if censor is None else ~np.asarray(censor, dtype=bool)
+    pinv_X = np.linalg.pinv(X[kept]).astype(np.float32)
+    X      = X.astype(np.float32)
+
+    for start in range(0, timecourses.shape[1], chunk_size):
+        Y = timecourses[:, start:start + chunk_size]
+        Y -= np.dot(X, np.dot(pinv_X, Y[kept]))
+        Y[~kept] = 0
+
+        if regressed is not None:
+            regressed[:, start:start + chunk_size] = Y
+
+        if filter_block is not None:
+            Y[:] = filter_block(Y.T).T
+
+        if standardize:
+            std = Y[kept].std(axis=0)
+            std[std == 0] = 1
+            Y -= Y[kept].mean(axis=0)
+            Y /= std
+
+    return timecourses
+
+
+def unmask_timecourses(timecourses, mask, img):
+    """ Return a float32 4D image like `img` with the (timepoints, n_voxels)
+    `timecourses` of the voxels of the boolean `mask` array and zeros out of it."""
+    import nibabel as nb
+
+    data = np.zeros(mask.shape + (timecourses.shape[0], ), dtype=np.float32)
+    data[mask] = timecourses.T
+
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    return nb.Nifti1Image(data, img.affine, header)
+
+
+def clean_fmri(in_file, mask_file, confound_files=None, censor_file=None, detrend_poly=0,
+               lowpass_freq=0.1, highpass_freq=0.01, tr=2, method='fft', padding=None, order=5,
+               standardize=False, save_steps=False, image_settings=None):
+    """ Clean the fMRI image `in_file` in one pass: the voxel time courses
+    within `mask_file` are read once and censored, detrended, regressed
+    on the confounds, bandpass filtered and standardized in memory.
+    See `clean_timecourses`.
+
+    Parameters
+    ----------
+    in_file: str
+        Path to the realigned 4D fMRI image.
+
+    mask_file: str
+        Path to the brain mask. The voxels out of it are 0 in the output.
+
+    confound_files: list of str
+        Paths to the text files with the confounds, one column per confound.
+
+    censor_file: str
+        Path to the censor mask .npy file.
+
+    detrend_poly: int
+        Number of Legendre polynomials to regress out, besides the constant.
+
+    lowpass_freq, highpass_freq, tr, method, padding, order:
+        See `bandpass_filter`.
+
+    standardize: bool
+        If True, scale the time courses to unit variance.
+
+    save_steps: bool
+        If True, also save the image after the regression, before filtering.
+
+    image_settings: dict
+        The format of the output images, see `pypes.config.image_settings`.
+
+    Returns
+    -------
+    out_file: str
+        Path to the cleaned image.
+
+    nuis_corrected: str
+        Path to the image after the regression, if `save_steps` is True.
+        Empty otherwise.
+    """
+    import os.path as op
+    from   functools import partial
+
+    import nibabel as nb
+    import numpy as np
+    from   nipype.utils.filemanip import filename_to_list, split_filename
+
+    from   pypes.config import intermediate_file
+    from   pypes.utils.files import save_nifti
+    from   pypes.preproc.denoise import masked_timecourses
+    from   pypes.fmri.filter import (clean_timecourses,
+                                     unmask_timecourses,
+                                     fft_bandpass,
+                                     butterworth_bandpass,
+                                     butterworth_sos)
+
+    timecourses, _ = masked_timecourses(in_file, [mask_file])
+    timepoints = timecourses.shape[0]
+
+    confounds = None
+    if confound_files:
+        confounds = np.hstack([np.loadtxt(confound_file, ndmin=2).reshape(timepoints, -1)
+                               for confound_file in filename_to_list(confound_files)])
+
+    censor = np.load(censor_file).astype(bool) if censor_file else None
+
+    filter_block = None
+    if method == 'butterworth':
+        sos = butterworth_sos(tr, lowpass_freq=lowpass_freq, highpass_freq=highpass_freq, order=order)
+        if sos is not None:
+            filter_block = partial(butterworth_bandpass, sos=sos, padding=padding)
+    elif method == 'fft':
+        filter_block = partial(fft_bandpass, tr=tr, lowpass_freq=lowpass_freq,
+                               highpass_freq=highpass_freq, padding=padding)
+    else:
+        raise ValueError("Expected 'fft' or 'butterworth' for `method`, got {}.".format(method))
+
+    regressed = np.empty_like(timecourses) if save_steps else None
+    clean_timecourses(timecourses,
+                      confounds=confounds,
+                      censor=censor,
+                      detrend_poly=detrend_poly,
+                      filter_block=filter_block,
+                      standardize=standardize,
+                      regressed=regressed)
+
+    img  = nb.load(in_file)
+    mask = np.asanyarray(nb.load(mask_file).dataobj) > 0
+
+    image_settings = image_settings or {}
+    fmt = image_settings.get('intermediate_format')
+    compresslevel = image_settings.get('compress_level')
+
+    _, name, ext = split_filename(in_file)
+    nuis_corrected = ''
+    if save_steps:
+        nuis_corrected = intermediate_file(op.abspath(name + '_filtermotart_cleaned' + ext), fmt)
+        save_nifti(unmask_timecourses(regressed, mask, img), nuis_corrected, compresslevel=compresslevel)
+        del regressed
+
+    out_file = intermediate_file(op.abspath(name + '_filtermotart_cleaned_bandpassed' + ext), fmt)
+    save_nifti(unmask_timecourses(timecourses, mask, img), out_file, compresslevel=compresslevel)
+    return out_file, nuis_corrected
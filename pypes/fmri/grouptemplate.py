@@ -5,10 +5,10 @@ fMRI group template registration nipype workflow.
 import os.path as op
 
 import nipype.pipeline.engine    as pe
-from   nipype.interfaces         import io
 from   nipype.interfaces.utility import IdentityInterface
 
 from   ..preproc import spm_create_group_template_wf, spm_warp_to_mni
+from   ..interfaces.files import GzipDataSink, sink_compression
 from   ..config  import setup_node
 from   .._utils  import format_pair_list
 from   ..utils   import (get_datasink,
@@ -72,9 +72,10 @@ def attach_spm_fmri_grouptemplate_wf(main_wf, wf_name='spm_epi_grouptemplate'):
 
     # the group template datasink
     base_outdir  = datasink.inputs.base_directory
-    grp_datasink = pe.Node(io.DataSink(parameterization=False,
-                                       base_directory=base_outdir,),
-                                       name='{}_grouptemplate_datasink'.format(fmri_fbasename))
+    grp_datasink = pe.Node(GzipDataSink(parameterization=False,
+                                        base_directory=base_outdir,
+                                        **sink_compression()),
+                                        name='{}_grouptemplate_datasink'.format(fmri_fbasename))
     grp_datasink.inputs.container = '{}_grouptemplate'.format(fmri_fbasename)
 
     # the list of the average EPIs from all the subjects
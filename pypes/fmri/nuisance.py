@@ -7,11 +7,14 @@ import nipype.pipeline.engine       as pe
 from   nipype.algorithms.rapidart   import ArtifactDetect
 from   nipype.interfaces.utility    import Function, IdentityInterface, Merge
 from   nipype.algorithms.confounds  import TSNR
-from   nipype.interfaces            import fsl
 
 from   ..config  import setup_node, _get_params_for
 from   ..utils   import selectindex, rename
-from   ..preproc import motion_regressors, extract_noise_components, create_regressors
+from   ..preproc import (motion_regressors,
+                        create_regressors,
+                        global_signal_regressors,
+                        CompCorInterface,
+                        NuisanceRegressionInterface)
 
 
 def rapidart_fmri_artifact_detection():
@@ -25,9 +28,17 @@ def rapidart_fmri_artifact_detection():
     return art
 
 
-def rest_noise_filter_wf(wf_name='rest_noise_removal'):
+def rest_noise_filter_wf(wf_name='rest_noise_removal', regress=True):
     """ Create a resting-state fMRI noise removal node.
 
+    Parameters
+    ----------
+    wf_name: str
+
+    regress: bool
+        If False, only the regressors are calculated, 'nuisance_regressors',
+        to be regressed by a later node, e.g., `pypes.fmri.filter.clean_fmri`.
+
     Nipype Inputs
     -------------
     rest_noise_input.in_file
@@ -48,15 +59,22 @@ def rest_noise_filter_wf(wf_name='rest_noise_removal'):
 
     rest_noise_output.motion_corrected
         The fMRI motion corrected image.
+        Only with the `rest_filter.sequential` setting.
 
     rest_noise_output.nuis_corrected
         The resulting nuisance corrected image.
-        This will be the same as 'motion_corrected' if compcor
-        is disabled.
+        By default all the regressors are regressed at once, with the
+        `rest_filter.sequential` setting the motion, CompCor and GSR
+        regressors are regressed one after the other and this will be
+        the same as 'motion_corrected' if compcor and gsr are disabled.
 
     rest_noise_output.motion_regressors
         Motion regressors file.
 
+    rest_noise_output.nuisance_regressors
+        The list of all the regressors files.
+        Not with the `rest_filter.sequential` setting.
+
     rest_noise_output.compcor_regressors
         CompCor regressors file.
 
@@ -101,7 +119,9 @@ def rest_noise_filter_wf(wf_name='rest_noise_removal'):
                   "motion_corrected",
                   "nuis_corrected",
                   "motion_regressors",
+                  "nuisance_regressors",
                   "compcor_regressors",
+                  "compcor_variance",
                   "gsr_regressors",
                   "art_displacement_files",
                   "art_intensity_files",
@@ -145,44 +165,21 @@ def rest_noise_filter_wf(wf_name='rest_noise_removal'):
                                       function=create_regressors),
                              name='motart_parameters')
 
-    motion_filter = setup_node(fsl.GLM(out_f_name='F_mcart.nii.gz',
-                                       out_pf_name='pF_mcart.nii.gz',
-                                       demean=True),
-                               name='motion_filter')
-
     # Noise confound regressors
-    compcor_pars = setup_node(Function(input_names=['realigned_file',
-                                                    'mask_file',
-                                                    'num_components',
-                                                    'extra_regressors'],
-                                         output_names=['out_files'],
-                                         function=extract_noise_components,),
-                              name='compcor_pars')
-    #compcor_pars = setup_node(ACompCor(), name='compcor_pars')
-    #compcor_pars.inputs.components_file = 'noise_components.txt'
-
-    compcor_filter = setup_node(fsl.GLM(out_f_name='F.nii.gz',
-                                        out_pf_name='pF.nii.gz',
-                                        demean=True),
-                                name='compcor_filter')
+    compcor_pars = setup_node(CompCorInterface(), name='compcor_pars')
 
     # Global signal regression
     gsr_pars = setup_node(Function(input_names=['realigned_file',
                                                 'mask_file',
-                                                'num_components',
-                                                'extra_regressors'],
-                                    output_names=['out_files'],
-                                    function=extract_noise_components, ),
+                                                'derivatives',
+                                                'squares'],
+                                    output_names=['out_file'],
+                                    function=global_signal_regressors, ),
                             name='gsr_pars')
 
-    gsr_filter = setup_node(fsl.GLM(out_f_name='F_gsr.nii.gz',
-                                    out_pf_name='pF_gsr.nii.gz',
-                                    demean=True),
-                            name='gsr_filter')
-
-    # output identities
+    # output identities, some of them depend on the enabled filters
     rest_noise_output = setup_node(IdentityInterface(fields=out_fields,
-                                                     mandatory_inputs=True),
+                                                     mandatory_inputs=False),
                                     name="rest_noise_output")
 
     # Connect the nodes
@@ -205,16 +202,9 @@ def rest_noise_filter_wf(wf_name='rest_noise_removal'):
                                              ]),
                 (motion_regs,   motart_pars, [("out_files",     "motion_params")]),
 
-                # motion filtering
-                (rest_noise_input, motion_filter, [("in_file",                            "in_file"),
-                                                   (("in_file", rename, "_filtermotart"), "out_res_name"),
-                                                  ]),
-                (motart_pars,      motion_filter, [(("out_files", selectindex, [0]),      "design")]),
-
                 # output
                 (tsnr,             rest_noise_output, [("tsnr_file",            "tsnr_file")]),
                 (motart_pars,      rest_noise_output, [("out_files",            "motion_regressors")]),
-                (motion_filter,    rest_noise_output, [("out_res",              "motion_corrected")]),
                 (art,              rest_noise_output, [("displacement_files",   "art_displacement_files"),
                                                        ("intensity_files",      "art_intensity_files"),
                                                        ("norm_files",           "art_norm_files"),
@@ -224,52 +214,97 @@ def rest_noise_filter_wf(wf_name='rest_noise_removal'):
                                                       ]),
                 ])
 
-    last_filter = motion_filter
-
-    # compcor filter
-    if filters['compcor_csf'] or filters['compcor_wm']:
+    use_compcor = filters['compcor_csf'] or filters['compcor_wm']
+    if use_compcor:
         wf.connect([
-                    # calculate compcor regressor and parameters file
-                    (motart_pars,      compcor_pars,      [(("out_files", selectindex, [0]), "extra_regressors"),]),
-                    (motion_filter,    compcor_pars,      [("out_res",                       "realigned_file"),]),
-
-                    # the compcor filter
-                    (motion_filter,    compcor_filter,    [("out_res",                        "in_file"),
-                                                           (("out_res", rename, "_cleaned"),  "out_res_name"),
+                    (compcor_pars,     rest_noise_output, [("components_file", "compcor_regressors"),
+                                                           ("variance_file",   "compcor_variance"),
                                                           ]),
-                    (compcor_pars,     compcor_filter,    [(("out_files", selectindex, [0]),  "design")]),
-                    #(compcor_pars,     compcor_filter,    [("components_file",  "design")]),
-                    (rest_noise_input, compcor_filter,    [("brain_mask",                     "mask")]),
+                   ])
 
-                    # output
-                    (compcor_pars,     rest_noise_output, [("out_files",   "compcor_regressors")]),
-                    #(compcor_pars,     rest_noise_output, [("components_file",   "compcor_regressors")]),
-                    ])
-        last_filter = compcor_filter
-
-    # global signal regression
     if filters['gsr']:
         wf.connect([
-            # calculate gsr regressors parameters file
-            (last_filter,       gsr_pars, [("out_res",      "realigned_file")]),
-            (rest_noise_input,  gsr_pars, [("brain_mask",   "mask_file")]),
-
-            # the output file name
-            (rest_noise_input, gsr_filter,  [("brain_mask", "mask")]),
-            (last_filter,       gsr_filter, [("out_res",                        "in_file"),
-                                             (("out_res", rename, "_gsr"),      "out_res_name"),
-                                            ]),
-            (gsr_pars,          gsr_filter, [(("out_files", selectindex, [0]),  "design")]),
-
-            # output
-            (gsr_pars,   rest_noise_output, [("out_files",   "gsr_regressors")]),
-        ])
-        last_filter = gsr_filter
+                    (rest_noise_input, gsr_pars,          [("brain_mask",   "mask_file")]),
+                    (gsr_pars,         rest_noise_output, [("out_file",     "gsr_regressors")]),
+                   ])
+
+    if regress and filters.get('sequential', False):
+        # regress the motion, CompCor and GSR regressors one after the other,
+        # calculating the CompCor and GSR regressors from the residuals of the previous filter
+        motion_filter = setup_node(NuisanceRegressionInterface(), name='motion_filter')
+        wf.connect([
+                    (rest_noise_input, motion_filter,     [("in_file",                            "in_file"),
+                                                           (("in_file", rename, "_filtermotart"), "out_file"),
+                                                           ("brain_mask",                         "mask_file"),
+                                                          ]),
+                    (motart_pars,      motion_filter,     [(("out_files", selectindex, [0]),      "design_files")]),
+                    (motion_filter,    rest_noise_output, [("out_file",                           "motion_corrected")]),
+                   ])
+        last_filter = motion_filter
+
+        if use_compcor:
+            compcor_filter = setup_node(NuisanceRegressionInterface(), name='compcor_filter')
+            wf.connect([
+                        # calculate compcor regressor and parameters file
+                        (motart_pars,      compcor_pars,   [(("out_files", selectindex, [0]),   "extra_regressors"),]),
+                        (last_filter,      compcor_pars,   [("out_file",                        "realigned_file"),]),
+
+                        # the compcor filter
+                        (last_filter,      compcor_filter, [("out_file",                        "in_file"),
+                                                            (("out_file", rename, "_cleaned"),  "out_file"),
+                                                           ]),
+                        (compcor_pars,     compcor_filter, [("components_file",                 "design_files")]),
+                        (rest_noise_input, compcor_filter, [("brain_mask",                      "mask_file")]),
+                       ])
+            last_filter = compcor_filter
+
+        if filters['gsr']:
+            gsr_filter = setup_node(NuisanceRegressionInterface(), name='gsr_filter')
+            wf.connect([
+                        # calculate gsr regressors parameters file
+                        (last_filter,      gsr_pars,   [("out_file",                    "realigned_file")]),
+
+                        # the gsr filter
+                        (last_filter,      gsr_filter, [("out_file",                    "in_file"),
+                                                        (("out_file", rename, "_gsr"),  "out_file"),
+                                                       ]),
+                        (gsr_pars,         gsr_filter, [("out_file",                    "design_files")]),
+                        (rest_noise_input, gsr_filter, [("brain_mask",                  "mask_file")]),
+                       ])
+            last_filter = gsr_filter
+
+    else:
+        # regress all the regressors at once, calculated from the input image
+        designs = [(motart_pars, ("out_files", selectindex, [0]))]
+        if use_compcor:
+            wf.connect([(rest_noise_input, compcor_pars, [("in_file", "realigned_file")])])
+            designs.append((compcor_pars, "components_file"))
+
+        if filters['gsr']:
+            wf.connect([(rest_noise_input, gsr_pars, [("in_file", "realigned_file")])])
+            designs.append((gsr_pars, "out_file"))
+
+        design_merge = setup_node(Merge(len(designs)), name="design_merge")
+        for idx, (node, field) in enumerate(designs, 1):
+            wf.connect([(node, design_merge, [(field, "in{}".format(idx))])])
+        wf.connect([(design_merge, rest_noise_output, [("out", "nuisance_regressors")])])
+
+        if regress:
+            nuisance_filter = setup_node(NuisanceRegressionInterface(), name='nuisance_filter')
+            wf.connect([
+                        (rest_noise_input, nuisance_filter, [("in_file",                                    "in_file"),
+                                                             (("in_file", rename, "_filtermotart_cleaned"), "out_file"),
+                                                             ("brain_mask",                                 "mask_file"),
+                                                            ]),
+                        (design_merge,     nuisance_filter, [("out",                                        "design_files")]),
+                       ])
+            last_filter = nuisance_filter
 
     # connect the final nuisance correction output node
-    wf.connect([
-                (last_filter, rest_noise_output, [("out_res",     "nuis_corrected")]),
-                ])
+    if regress:
+        wf.connect([
+                    (last_filter, rest_noise_output, [("out_file",     "nuis_corrected")]),
+                    ])
 
     if filters['compcor_csf'] and filters['compcor_wm']:
         mask_merge = setup_node(Merge(2), name="mask_merge")
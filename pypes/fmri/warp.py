@@ -4,11 +4,11 @@ Nipype workflows to process resting-state functional MRI.
 """
 import nipype.pipeline.engine    as pe
 import os.path as op
-from   nipype.algorithms.misc    import Gunzip
 from   nipype.interfaces         import spm, fsl
 from   nipype.interfaces.utility import Function, Merge, IdentityInterface
 
 from   .._utils  import format_pair_list
+from   ..interfaces.files import Gunzip
 from   ..config  import setup_node, get_config_setting
 from   ..preproc import (spm_normalize,
                          get_bounding_box,
@@ -4,12 +4,11 @@ Nipype interfaces to perform signal decomposition.
 """
 
 import nipype.pipeline.engine    as pe
-from   nipype.interfaces         import io
 from   nipype.interfaces.utility import IdentityInterface, Function
 
 from   .._utils import _check_list
 from   ..config import setup_node, get_config_setting
-from   ..interfaces import CanICAInterface
+from   ..interfaces import CanICAInterface, GzipDataSink, sink_compression
 from   ..interfaces.nilearn.image import concat_3D_imgs
 from   ..utils import (get_trait_value,
                        get_datasink, )
@@ -49,8 +48,9 @@ def attach_canica(main_wf, wf_name="canica", **kwargs):
     datasink = get_datasink(main_wf, name='datasink')
 
     base_outdir  = datasink.inputs.base_directory
-    ica_datasink = pe.Node(io.DataSink(parameterization=False,
-                                       base_directory=base_outdir,),
+    ica_datasink = pe.Node(GzipDataSink(parameterization=False,
+                                        base_directory=base_outdir,
+                                        **sink_compression()),
                            name="{}_datasink".format(wf_name))
 
     # the list of the subjects files
@@ -113,8 +113,9 @@ def attach_concat_canica(main_wf, wf_name="canica", **kwargs):
     datasink = get_datasink(main_wf, name='datasink')
 
     base_outdir  = datasink.inputs.base_directory
-    ica_datasink = pe.Node(io.DataSink(parameterization=False,
-                                       base_directory=base_outdir,),
+    ica_datasink = pe.Node(GzipDataSink(parameterization=False,
+                                        base_directory=base_outdir,
+                                        **sink_compression()),
                            name="ica_datasink".format(wf_name))
     ica_datasink.inputs.container = 'ica_{}'.format(wf_name)
 
@@ -126,7 +127,7 @@ def attach_concat_canica(main_wf, wf_name="canica", **kwargs):
 
     # concat images
     concat = setup_node(Function(function=concat_3D_imgs,
-                                 input_names=["in_files"],
+                                 input_names=["in_files", "image_settings"],
                                  output_names=["out_file"],
                                  imports=['from pypes.interfaces.nilearn import ni2file']),
                         name="concat")
@@ -22,6 +22,7 @@ from ..interfaces import (plot_all_components,
                           plot_multi_slices,
                           plot_overlays)
 from ..utils import fetch_one_file
+from ..imgcache import cached_file
 
 
 def plot_connectivity_matrix(connectivity_matrix, label_names):
@@ -279,12 +280,12 @@ class MIALABICAResultsPlotter(ICAResultsPlotter):
     def _load_components(self):
         """ Return components image file and check shape match."""
         compsf = self._fetch_components_file()
-        comps_img = niimg.load_img(compsf)
+        comps_img = niimg.load_img(cached_file(compsf))
         return comps_img
 
     def _load_loadings(self):
         loadf = fetch_one_file(self.ica_dir, self._tcs_fname)
-        loads = niimg.load_img(loadf).get_data()
+        loads = niimg.load_img(cached_file(loadf)).get_data()
         return loads
 
     def _fetch_components_file(self):
@@ -331,13 +332,13 @@ class MIALABICAResultsPlotter(ICAResultsPlotter):
         """ Return the volume in `index` 4th dimension index of `img_file`.
         If the image is 3D and idx is zero will return the container of `img_file`.
         """
-        imgs = check_niimg(img_file, ensure_ndim=4, atleast_4d=True)
+        imgs = check_niimg(cached_file(img_file), ensure_ndim=4, atleast_4d=True)
         return _index_img(imgs, index)
 
     def load_mask(self):
         """ Return the mask image. """
         mask_file = fetch_one_file(self.ica_dir, self._mask_fname, pat_type='re.match')
-        return niimg.load_img(mask_file)
+        return niimg.load_img(cached_file(mask_file))
 
     def load_subject_data(self, masked=False, **kwargs):
         """ Generator of the input data volumes in the order it was inserted in GIFT ICA.
@@ -596,7 +597,7 @@ class GIFTICAResultsPlotter(MIALABICAResultsPlotter):
         """ Return the timecourses image file and checks if the shape is correct."""
         # load the timecourses file
         tcsf = fetch_one_file(self.ica_dir, self._tcs_fname, pat_type='re.match')
-        tcs = niimg.load_img(tcsf).get_data()
+        tcs = niimg.load_img(cached_file(tcsf)).get_data()
         return tcs
 
     def _fetch_components_file(self):
@@ -639,7 +640,7 @@ class GIFTGroupICAResultsPlotter(MIALABICAResultsPlotter):
         """ Return the timecourses image file and checks if the shape is correct."""
         # load the timecourses file
         tcsf = fetch_one_file(self.ica_dir, self._tcs_fname)
-        tcs = niimg.load_img(tcsf).get_data()
+        tcs = niimg.load_img(cached_file(tcsf)).get_data()
         return tcs
 
     def _fetch_components_file(self):
@@ -10,6 +10,8 @@ import nilearn.image as niimg
 from   sklearn.metrics.pairwise import pairwise_distances
 from   boyle.nifti.utils import nifti_out, thr_img, icc_img_to_zscore
 
+from   ..imgcache import cached_niimgs
+
 
 @nifti_out
 def spatial_map(icc, thr, mode='+'):
@@ -121,8 +123,8 @@ def spatial_maps_goodness_of_fit(rsn_imgs, spatial_maps, mask_file, rsn_thr=4.0)
 
     Extracted from Zhou et al., 2010, Brain.
     """
-    rsn_img = niimg.load_img(rsn_imgs)
-    spm_img = niimg.load_img(spatial_maps)
+    rsn_img = niimg.load_img(cached_niimgs(rsn_imgs))
+    spm_img = niimg.load_img(cached_niimgs(spatial_maps))
 
     n_rsns = rsn_img.shape[-1]
     n_ics  =  spm_img.shape[-1]
@@ -154,7 +156,7 @@ def spatial_maps_goodness_of_fit(rsn_imgs, spatial_maps, mask_file, rsn_thr=4.0)
 
         if mask_file is not None:
             # rsn_out = niimg.math_img('mask * img', mask=rsn_brain_mask, img=rsn_out)
-            rsn_brain_mask = niimg.resample_to_img(mask_file, rsn,
+            rsn_brain_mask = niimg.resample_to_img(cached_niimgs(mask_file), rsn,
                                                    interpolation='nearest')
             rsn_out = rsn_brain_mask.get_data() * rsn_out
 
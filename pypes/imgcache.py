@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+A cache of the decompressed copies of the gzipped NIfTI images.
+
+nibabel can not memory-map the '.nii.gz' files, so each read of one
+inflates all of it again. The helpers that read big images ask the cache
+for an uncompressed copy instead, that is inflated once and then
+memory-mapped by every read, in any of the worker processes.
+
+The cache is enabled with the `image_cache_gb` configuration setting, the
+total size of the copies in GB, e.g.:
+
+    image_cache_gb: 20
+
+The copies are kept in the `image_cache_dir` folder, by default the
+'image_cache' folder of the workflow, '{wf.base_dir}/{wf.name}/image_cache'.
+Each copy is keyed by the path, the size and the modification time of its
+image, so a changed image is never read from an old copy.
+The least recently used copies are removed when the total size is exceeded,
+except the ones used in the last `image_cache_grace_secs`, 60 by default,
+which could be about to be opened by nibabel.
+The `pypes worker` processes of the Queue plugin do not share the
+configuration of the workflow process, the job scripts pass them these
+settings in the `IMAGE_CACHE_VAR` environment variable, see `cache_settings`.
+
+Within a process, the images written by the `ni2file` decorated functions
+can also be handed off in memory to the next `ni2file` function that reads
+them, if their files did not change. This is enabled with the
+`image_handoff_mb` configuration setting, the total size of the images
+kept in memory in MB. The small chains of these functions run in one node
+for each subject, e.g., `pypes.pet.utils.pvc_mask_imgs`, so they hand off
+their images within the worker process of that node.
+"""
+import os
+import os.path as op
+import gzip
+import json
+import shutil
+import hashlib
+import tempfile
+from   collections import OrderedDict
+
+from   .config import get_config_setting, update_config
+
+
+CACHE_DIR   = 'image_cache'
+CACHED_EXT  = '.nii'
+GZIPPED_EXT = '.nii.gz'
+
+# the image cache settings of the nodes run in other processes, see `cache_settings`
+IMAGE_CACHE_VAR = 'PYPES_IMAGE_CACHE'
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+class ImageCache(object):
+    """ A folder with the decompressed copies of gzipped NIfTI images,
+    with least recently used eviction by total size.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Path to the cache folder. It will be created if it does not exist.
+
+    max_bytes: int
+        Total size of the copies.
+
+    grace_secs: float
+        The copies used less than these seconds ago are not evicted, even if
+        the total size is exceeded. nibabel opens the files on the first data
+        access, so a path given by `get` can be opened a while later.
+    """
+    def __init__(self, cache_dir, max_bytes, grace_secs=60):
+        self.cache_dir  = op.abspath(cache_dir)
+        self.max_bytes  = int(max_bytes)
+        self.grace_secs = grace_secs
+
+    def _prefix(self, file_path):
+        return _digest(file_path) + '_'
+
+    def cached_path(self, file_path):
+        """ Return the path to the copy of `file_path` in the cache,
+        whether it exists or not."""
+        file_path = op.abspath(file_path)
+        stat = os.stat(file_path)
+        version = _digest('{}:{}'.format(stat.st_size, stat.st_mtime_ns))
+        return op.join(self.cache_dir, self._prefix(file_path) + version + CACHED_EXT)
+
+    def get(self, file_path):
+        """ Return the path to the decompressed copy of the gzipped
+        `file_path`, decompressing it if it is not in the cache."""
+        file_path = op.abspath(file_path)
+        cached    = self.cached_path(file_path)
+
+        if op.exists(cached):
+            # the modification time of the copies is their last use
+            try:
+                os.utime(cached)
+                return cached
+            except FileNotFoundError:
+                pass
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._remove_old_versions(file_path, cached)
+
+        # decompress in a temporary file, so the other processes never see a partial copy
+        fd, tmp_file = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f_out, gzip.open(file_path, 'rb') as f_in:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            os.replace(tmp_file, cached)
+        except BaseException:
+            if op.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+
+        self.evict(keep=cached)
+        return cached
+
+    def _remove_old_versions(self, file_path, cached):
+        prefix = self._prefix(file_path)
+        for name in os.listdir(self.cache_dir):
+            path = op.join(self.cache_dir, name)
+            if name.startswith(prefix) and name.endswith(CACHED_EXT) and path != cached:
+                _remove(path)
+
+    def entries(self):
+        """ Return the path, size and last use time of the copies in the
+        cache, from the least to the most recently used."""
+        if not op.isdir(self.cache_dir):
+            return []
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(CACHED_EXT):
+                continue
+
+            path = op.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def total_bytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=''):
+        """ Remove the least recently used copies until the total size is
+        within `max_bytes`, except `keep` and the ones used within `grace_secs`.
+        The processes that have them open or memory-mapped can still read them."""
+        entries = self.entries()
+        total   = sum(size for _, size, _ in entries)
+        # the last use times are the modification times set by the same file system
+        in_use  = max((last_use for _, _, last_use in entries), default=0) - self.grace_secs
+        for path, size, last_use in entries:
+            if total <= self.max_bytes or last_use > in_use:
+                break
+            if path == keep:
+                continue
+            _remove(path)
+            total -= size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            _remove(path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def cache_settings():
+    """ Return the `image_cache_gb`, `image_cache_dir` and
+    `image_cache_grace_secs` configuration settings as a dict.
+    The ones not in the configuration are taken from the JSON in the
+    `IMAGE_CACHE_VAR` environment variable, if it is set."""
+    env_settings = json.loads(os.environ.get(IMAGE_CACHE_VAR) or '{}')
+    defaults = OrderedDict([('image_cache_gb',         0),
+                            ('image_cache_dir',        ''),
+                            ('image_cache_grace_secs', 60),
+                           ])
+    return OrderedDict((name, get_config_setting(name, default=env_settings.get(name, default)))
+                       for name, default in defaults.items())
+
+
+def image_cache():
+    """ Return the `ImageCache` of the `cache_settings`, None if it is not enabled."""
+    settings = cache_settings()
+    if not settings['image_cache_gb'] or not settings['image_cache_dir']:
+        return None
+    return ImageCache(settings['image_cache_dir'],
+                      max_bytes=float(settings['image_cache_gb']) * 1024**3,
+                      grace_secs=float(settings['image_cache_grace_secs']))
+
+
+def default_cache_dir(wf):
+    """ Return the image cache folder of `wf`: '{wf.base_dir}/{wf.name}/image_cache'."""
+    return op.join(wf.base_dir or os.getcwd(), wf.name, CACHE_DIR)
+
+
+def setup_image_cache(wf):
+    """ Set the `image_cache_dir` configuration setting to the
+    `default_cache_dir` of `wf`, if the cache is enabled and the setting
+    is not given."""
+    if get_config_setting('image_cache_gb', default=0) and not get_config_setting('image_cache_dir'):
+        update_config({'image_cache_dir': default_cache_dir(wf)})
+
+
+def cached_file(file_path):
+    """ Return the path to an uncompressed, memory-mappable, copy of
+    `file_path` if it is a gzipped NIfTI image and the cache is enabled,
+    otherwise `file_path`."""
+    if not isinstance(file_path, str) or not file_path.endswith(GZIPPED_EXT):
+        return file_path
+
+    cache = image_cache()
+    if cache is None:
+        return file_path
+    return cache.get(file_path)
+
+
+def cached_niimgs(imgs):
+    """ Return the niimg-like `imgs`, a file path, an image or a list of
+    them, with the file paths replaced by their `cached_file`."""
+    if isinstance(imgs, (list, tuple)):
+        return [cached_niimgs(img) for img in imgs]
+    return cached_file(imgs)
+
+
+# the images written in this process: path -> (size, modification time, image)
+_HANDOFF_IMGS = OrderedDict()
+
+
+def handoff_bytes():
+    """ Return the `image_handoff_mb` configuration setting in bytes,
+    0 if the in-process image handoff is not enabled."""
+    return int(float(get_config_setting('image_handoff_mb', default=0)) * 1024**2)
+
+
+def _file_version(file_path):
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def register_img(file_path, img):
+    """ Keep the in-memory nibabel `img` just saved in `file_path` for the
+    next reads of `file_path` in this process, see `registered_img`.
+    The least recently registered images are dropped to keep the total
+    size within `handoff_bytes`."""
+    import numpy as np
+
+    max_bytes = handoff_bytes()
+    if not max_bytes or not isinstance(img.dataobj, np.ndarray) or img.dataobj.nbytes > max_bytes:
+        return
+
+    file_path = op.abspath(file_path)
+    _HANDOFF_IMGS.pop(file_path, None)
+    _HANDOFF_IMGS[file_path] = _file_version(file_path) + (img, )
+
+    total = sum(entry[2].dataobj.nbytes for entry in _HANDOFF_IMGS.values())
+    while total > max_bytes:
+        _, (_, _, old_img) = _HANDOFF_IMGS.popitem(last=False)
+        total -= old_img.dataobj.nbytes
+
+
+def registered_img(file_path):
+    """ Return a copy of the image registered for `file_path` in this
+    process if the file did not change since, otherwise None.
+    The copy can be changed in place without changing the registered one."""
+    file_path = op.abspath(file_path)
+    entry = _HANDOFF_IMGS.get(file_path)
+    if entry is None:
+        return None
+
+    if not op.exists(file_path) or _file_version(file_path) != entry[:2]:
+        del _HANDOFF_IMGS[file_path]
+        return None
+
+    img = entry[2]
+    return img.__class__(img.dataobj.copy(), img.affine, img.header)
+
+
+def handoff_niimgs(imgs):
+    """ Return the niimg-like `imgs`, a file path, an image or a list or
+    tuple of them, with the existing file paths replaced by their
+    `registered_img`, or by their `cached_file` if there is none."""
+    if isinstance(imgs, (list, tuple)):
+        return type(imgs)(handoff_niimgs(img) for img in imgs)
+
+    if not isinstance(imgs, str) or not op.isfile(imgs):
+        return imgs
+
+    img = registered_img(imgs)
+    if img is not None:
+        return img
+    return cached_file(imgs)
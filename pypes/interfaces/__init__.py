@@ -1,6 +1,10 @@
 
 from .nilearn.canica import CanICAInterface
 
+from .files import (Gunzip,
+                    GzipDataSink,
+                    sink_compression)
+
 from .nilearn.plot import (plot_all_components,
                            plot_ica_components,
                            plot_multi_slices,
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Nipype interfaces to compress and decompress the image files following the
+`intermediate_format` configuration setting, see `pypes.config`.
+"""
+import os.path as op
+
+from nipype.algorithms.misc import Gunzip as NipypeGunzip
+from nipype.interfaces.base import traits
+from nipype.interfaces.io   import DataSink, DataSinkInputSpec
+
+
+def _is_gzipped(file_path):
+    return file_path.lower().endswith('.gz')
+
+
+class Gunzip(NipypeGunzip):
+    """ The nipype Gunzip interface that passes through the input file
+    if it is not compressed, instead of failing.
+    So the nodes before SPM can always be there, whatever the
+    `intermediate_format` of the images.
+    """
+    def _gen_output_file_name(self):
+        if not _is_gzipped(self.inputs.in_file):
+            return op.abspath(self.inputs.in_file)
+        return super(Gunzip, self)._gen_output_file_name()
+
+    def _run_interface(self, runtime):
+        if not _is_gzipped(self.inputs.in_file):
+            return runtime
+        return super(Gunzip, self)._run_interface(runtime)
+
+
+class GzipDataSinkInputSpec(DataSinkInputSpec):
+    compress = traits.Bool(False, usedefault=True,
+                           desc='If True, the uncompressed NIfTI files are gzip '
+                                'compressed in the output folder.')
+    compresslevel = traits.Range(low=0, high=9, value=1, usedefault=True,
+                                 desc='The gzip compression level.')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='Number of threads to compress each file.')
+
+
+class GzipDataSink(DataSink):
+    """ The nipype DataSink that can gzip compress the uncompressed NIfTI
+    files it copies, for the 'sink' `intermediate_format`.
+    The compressed files replace the copies in the output folder.
+    Each file is compressed by `num_threads` threads, see `pypes.utils.pgzip`.
+    """
+    input_spec = GzipDataSinkInputSpec
+
+    def _list_outputs(self):
+        from ..utils import gzip_file
+
+        outputs = super(GzipDataSink, self)._list_outputs()
+        if not self.inputs.compress:
+            return outputs
+
+        out_files = []
+        for out_file in outputs['out_file']:
+            if out_file.endswith('.nii') and op.isfile(out_file):
+                out_file = gzip_file(out_file,
+                                     compresslevel=self.inputs.compresslevel,
+                                     n_threads=self.inputs.num_threads,
+                                     remove=True)
+            out_files.append(out_file)
+
+        outputs['out_file'] = out_files
+        return outputs
+
+
+def sink_compression():
+    """ Return the `GzipDataSink` inputs that follow the `intermediate_format`,
+    `compress_level` and `compress_threads` configuration settings."""
+    from ..config import compress_at_sink, compress_level, compress_threads
+
+    return dict(compress=compress_at_sink(),
+                compresslevel=compress_level(),
+                num_threads=compress_threads())
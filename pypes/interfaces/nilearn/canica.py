@@ -2,6 +2,7 @@
 """
 Nipype interfaces to canica and dictlearning in nilearn.decomposition
 """
+import os
 import os.path as op
 
 import numpy as np
@@ -10,7 +11,16 @@ from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, Traite
 from nipype.interfaces.utility import InputMultiPath, OutputMultiPath, traits
 from nilearn.decomposition import CanICA, DictLearning
 
-from ...utils import get_trait_value
+from ...config import intermediate_file
+from ...utils import get_trait_value, save_nifti
+
+
+def cpu_count(n_jobs):
+    """ Return the number of CPUs of the joblib `n_jobs` value:
+    -1 means all the CPUs, -2 all the CPUs but one, and so on."""
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return max(1, n_jobs)
 
 
 class CanICAInputSpec(BaseInterfaceInputSpec):
@@ -52,6 +62,8 @@ class CanICAInputSpec(BaseInterfaceInputSpec):
     n_jobs = traits.Int(desc="The number of CPUs to use to do the computation. -1 means 'all CPUs', "
                              "-2 'all CPUs but one', and so on.",
                         default_value=1, usedefault=True)
+    image_settings = traits.Dict(desc="The format of the components image, "
+                                      "see pypes.config.image_settings.")
 
 
 class CanICAOutputSpec(TraitedSpec):
@@ -123,7 +135,9 @@ class CanICAInterface(BaseInterface):
         self._estimator_name = algorithm
         self._confounds = confounds
 
-        self._reconstructed_img_file = '{}_resting_state.nii.gz'.format(self._estimator_name)
+        self._image_settings = get_trait_value(self.inputs, 'image_settings', default={}) or {}
+        self._reconstructed_img_file = intermediate_file('{}_resting_state.nii.gz'.format(self._estimator_name),
+                                                         self._image_settings.get('intermediate_format'))
         self._score_file   = '{}_score.txt'.format(self._estimator_name)
         self._loading_file = '{}_{}_loading.txt'
 
@@ -140,7 +154,9 @@ class CanICAInterface(BaseInterface):
         masker = self._estimator.masker_
         # Drop output maps to a Nifti file
         components_img = masker.inverse_transform(self._estimator.components_)
-        components_img.to_filename(self._reconstructed_img_file)
+        save_nifti(components_img, self._reconstructed_img_file,
+                   compresslevel=self._image_settings.get('compress_level'),
+                   n_threads=cpu_count(get_trait_value(self.inputs, 'n_jobs')))
 
         # save the score array
         if isinstance(self._score, float):
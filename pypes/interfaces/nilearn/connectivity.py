@@ -41,6 +41,10 @@ class ConnectivityCorrelationInputSpec(BaseInterfaceInputSpec):
                                          "'labels' you must use 'data', 'labels' or None."
                                          "Have a look on nilearn docs for more information.")
 
+    censor_file = traits.File(desc="Numpy .npy file with a boolean censor mask, True for the volumes "
+                                   "to remove before computing the connectivity. See pypes.preproc.censor.",
+                              exists=True)
+
     # connectome options
     kind = traits.Enum ("correlation", "partial correlation", "tangent", "covariance", "precision",
                         desc="The connectivity matrix kind.", default='covariance')
@@ -99,6 +103,11 @@ class ConnectivityCorrelationInterface(BaseInterface):
 
         self._time_series = masker.fit_transform(in_files)
 
+        censor_file = get_trait_value(self.inputs, 'censor_file', default=None)
+        if censor_file:
+            censored = np.load(censor_file).astype(bool)
+            self._time_series = self._time_series[~censored]
+
         conn_measure   = nilearn.connectome.ConnectivityMeasure(kind=conn_kind)
         self._conn_mat = conn_measure.fit_transform([self._time_series])
 
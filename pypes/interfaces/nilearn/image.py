@@ -18,6 +18,13 @@ def ni2file(**presuffixes):
     - the first argument in the function call.
     In the last case a presuffix must be defined in the decorator to avoid overwriting
     an existing file.
+    The '.gz' extension is dropped if the `intermediate_format` does not allow compressed
+    intermediate images. It and the `compress_level` are taken from the `image_settings`
+    keyword argument, the input the nodes get at build time (see `pypes.config.set_image_settings`),
+    or else from the configuration settings.
+    The input image files are read from memory if they were written before in the same
+    process, see `pypes.imgcache.handoff_niimgs`, and the output image is registered for
+    the next reads.
     """
     def _pick_an_input_file(*args, **kwargs):
         """Assume that either the first arg or the first kwarg is an input file."""
@@ -29,7 +36,16 @@ def ni2file(**presuffixes):
     def nifti_out(f):
         @wraps(f)
         def wrapped(*args, **kwargs):
-            res_img = f(*args, **kwargs)
+            from pypes.imgcache import handoff_niimgs
+
+            settings = kwargs.pop('image_settings', None) or {}
+
+            # the input images written before in this process are taken from memory
+            in_args   = handoff_niimgs(args)
+            in_kwargs = {name: value if name == 'out_file' else handoff_niimgs(value)
+                         for name, value in kwargs.items()}
+
+            res_img = f(*in_args, **in_kwargs)
             if isinstance(res_img, list):
                 if len(res_img) == 1:
                     res_img = res_img[0]
@@ -64,7 +80,13 @@ def ni2file(**presuffixes):
                 raise ValueError("Could not find a output file name for this function: "
                                 " {}({}, {}).".format(f.__name__, *args, **kwargs))
 
-            res_img.to_filename(out_file)
+            from pypes.config   import intermediate_file
+            from pypes.imgcache import register_img
+            from pypes.utils    import save_nifti
+
+            out_file = intermediate_file(out_file, settings.get('intermediate_format'))
+            save_nifti(res_img, out_file, compresslevel=settings.get('compress_level'))
+            register_img(out_file, res_img)
 
             return op.abspath(out_file)
 
@@ -2,22 +2,33 @@
 """
 Workflows to grab input file structures.
 """
+import os
 import os.path as op
+import json
 import logging as log
+from   warnings    import warn
+from   collections import OrderedDict
 
 import nipype.pipeline.engine as pe
-from   nipype.interfaces.io   import DataSink
 
 from hansel.utils import joint_value_map, valuesmap_to_dict
-from nipype.interfaces.utility import IdentityInterface
-
-from .crumb  import DataCrumb
+from nipype.interfaces.utility import IdentityInterface, Function
+from nipype.utils.filemanip    import list_to_filename
+
+from .crumb    import DataCrumb, DataCrumbTable, CrumbIndex, crumb_file_table
+from .manifest import (config_digest,
+                       manifest_entries,
+                       outdated_subjects,
+                       save_pending_manifests,
+                       write_subject_manifest)
 from .utils  import extend_trait_list, joinstrings
+from .interfaces.files import GzipDataSink, sink_compression
 from .       import configuration
 
 
 def build_crumb_workflow(wfname_attacher, data_crumb, in_out_kwargs, output_dir,
-                         cache_dir='', wf_name="main_workflow"):
+                         cache_dir='', wf_name="main_workflow", use_index=True,
+                         batch_select=False, incremental=False, digest='mtime', shard=None):
     """ Returns a workflow for the give `data_crumb` with the attached workflows
     given by `attach_functions`.
 
@@ -53,10 +64,37 @@ def build_crumb_workflow(wfname_attacher, data_crumb, in_out_kwargs, output_dir,
 
     wf_name: str
         Name of the main workflow.
-    """
-    if not data_crumb.exists():
-        raise IOError("Expected an existing folder for `data_crumb`, got {}.".format(data_crumb))
 
+    use_index: bool
+        If True will use a `CrumbIndex` file in `cache_dir` to list the
+        file system only for the folders that changed since the last build.
+
+    batch_select: bool
+        If True will resolve the input files of all subjects in one pass
+        at build time. See `crumb_wf`.
+
+    incremental: bool
+        If True will leave out the subjects whose datasink outputs are
+        up to date with their input files and the configuration.
+        See `crumb_wf`. It is ignored if the attached workflows have nodes
+        that join over the subjects, such as the group templates or the
+        group ICA, so these always see the whole cohort.
+
+    digest: str
+        Choices: 'mtime', 'content'.
+        How to check if the input files changed in the `incremental` mode.
+
+    shard: 2-tuple of int
+        (shard index, number of shards).
+        If given, the workflow will process only one shard of the subjects.
+        The attached workflows can't have nodes that join over the
+        subjects, such as the group templates. See `crumb_wf`.
+
+    Returns
+    -------
+    main_wf: nipype Workflow
+        None if in the `incremental` mode all the subjects are up to date.
+    """
     if not data_crumb.isabs():
         raise IOError("Expected an absolute Crumb path for `data_crumb`, got {}.".format(data_crumb))
 
@@ -72,19 +110,61 @@ def build_crumb_workflow(wfname_attacher, data_crumb, in_out_kwargs, output_dir,
     if not cache_dir:
         cache_dir = op.join(op.dirname(output_dir), "wd")
 
+    if use_index:
+        index = crumb_index(cache_dir)
+        crumb_exists = index.exists(data_crumb)
+        index.save()
+    else:
+        crumb_exists = data_crumb.exists()
+    if not crumb_exists:
+        raise IOError("Expected an existing folder for `data_crumb`, got {}.".format(data_crumb))
+
     # print the configuration parameters
     log.info('Using the following configuration parameters:')
     log.info(configuration)
 
     # generate the workflow
-    main_wf = crumb_wf(work_dir=cache_dir,
-                       data_crumb=data_crumb,
-                       output_dir=output_dir,
-                       file_templates=in_out_kwargs,
-                       wf_name=wf_name)
-
-    for wf_name, attach_wf in wfname_attacher.items():
-        main_wf = attach_wf(main_wf=main_wf, wf_name=wf_name)
+    def attached_wf(incremental, shard):
+        main_wf = crumb_wf(work_dir=cache_dir,
+                           data_crumb=data_crumb,
+                           output_dir=output_dir,
+                           file_templates=in_out_kwargs,
+                           wf_name=wf_name,
+                           use_index=use_index,
+                           batch_select=batch_select,
+                           incremental=incremental,
+                           digest=digest,
+                           config_id=config_digest(sorted(wfname_attacher), in_out_kwargs),
+                           shard=shard)
+
+        for attach_name, attach_wf in wfname_attacher.items():
+            main_wf = attach_wf(main_wf=main_wf, wf_name=attach_name)
+        return main_wf
+
+    # the join nodes are checked before the incremental mode computes the
+    # input digests and writes the pending manifests of the subjects,
+    # the workflow is built again with them only if there are none
+    main_wf = attached_wf(incremental=False, shard=None if incremental else shard)
+
+    join_nodes = [node.fullname for node in main_wf._get_all_nodes()
+                  if isinstance(node, pe.JoinNode)]
+    if join_nodes and shard is not None:
+        raise ValueError("Can't split in shards a workflow that joins the subjects "
+                         "in the nodes {}.".format(join_nodes))
+
+    if join_nodes and incremental:
+        # the group nodes must see all the subjects, not only the outdated ones
+        log.warning("The nodes {} join the subjects, ignoring the incremental mode "
+                    "and processing all of them.".format(join_nodes))
+        incremental = False
+
+    if incremental:
+        main_wf = attached_wf(incremental=True, shard=shard)
+
+        infosrc = main_wf.get_node('infosrc')
+        if not any(values for _, values in infosrc.iterables):
+            log.info('Incremental mode: all the subjects are up to date, nothing to run.')
+            return None
 
     # move the crash files folder elsewhere
     main_wf.config["execution"]["crashdump_dir"] = op.join(main_wf.base_dir,
@@ -95,8 +175,26 @@ def build_crumb_workflow(wfname_attacher, data_crumb, in_out_kwargs, output_dir,
     return main_wf
 
 
+def crumb_index(work_dir):
+    """ Return the `CrumbIndex` for the workflows in `work_dir`.
+    The index file is stored in `work_dir`, which is created if needed.
+
+    Parameters
+    ----------
+    work_dir: str
+        Path to the workflow temporary folder
+
+    Returns
+    -------
+    index: pypes.crumb.CrumbIndex
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    return CrumbIndex(op.join(work_dir, 'crumb_index.json'))
+
+
 def crumb_wf(work_dir, data_crumb, output_dir, file_templates,
-             wf_name="main_workflow"):
+             wf_name="main_workflow", use_index=True, batch_select=False,
+             incremental=False, digest='mtime', config_id='', shard=None):
     """ Creates a workflow with the `subject_session_file` input nodes and an empty `datasink`.
     The 'datasink' must be connected afterwards in order to work.
 
@@ -121,24 +219,71 @@ def crumb_wf(work_dir, data_crumb, output_dir, file_templates,
     wf_name: str
         Name of the main workflow
 
+    use_index: bool
+        If True the `infosrc` iterables and the `selectfiles` node will be
+        resolved through a `CrumbIndex` stored in `work_dir`.
+        The index is only saved here, the `selectfiles` nodes read it.
+
+    batch_select: bool
+        If True, one unfold of `data_crumb` resolves the `file_templates`
+        for all subjects. The resulting subject to files table is saved in
+        '{work_dir}/{wf_name}/selectfiles_table.json' and its rows are
+        given to the `infosrc` iterables, so the `selectfiles` node is a
+        `DataCrumbTable` that nipype removes from the execution graph.
+        Otherwise a `DataCrumb` node will select the files of each subject.
+
+    incremental: bool
+        If True, the subjects whose manifest in `output_dir` matches the
+        digests of their current input files and `config_id`, and whose
+        output files all exist, are left out of the `infosrc` iterables.
+        A `manifest` node will write the manifest of each processed subject
+        in its `output_dir` folder once the `datasink` is done.
+
+    digest: str
+        Choices: 'mtime', 'content'.
+        How the input files digests are computed. See `pypes.manifest.file_digest`.
+
+    config_id: str
+        Digest of the configuration the results depend on.
+        By default it will be computed from the global configuration
+        and `file_templates`. See `pypes.manifest.config_digest`.
+
+    shard: 2-tuple of int
+        (shard index, number of shards).
+        If given, only every `n`-th subject, starting from the shard index,
+        will be in the `infosrc` iterables and the manifests of the subjects
+        will be written as in the `incremental` mode, so they can be merged
+        once all the shards are done. See `pypes.run.run_shards`.
+        The work files of the shard are named with a '_shard{i}of{n}' suffix,
+        the node folders are the same as without sharding.
+
     Returns
     -------
     wf: Workflow
     """
+    if shard is not None and not 0 <= shard[0] < shard[1]:
+        raise ValueError("Expected `shard` to be (index, number of shards), got {}.".format(shard))
+
     # create the root workflow
     wf = pe.Workflow(name=wf_name, base_dir=work_dir)
 
     # datasink
-    datasink = pe.Node(DataSink(parameterization=False,
-                                base_directory=output_dir,),
+    datasink = pe.Node(GzipDataSink(parameterization=False,
+                                    base_directory=output_dir,
+                                    **sink_compression()),
                        name="datasink")
 
     # input workflow
     # (work_dir, data_crumb, crumb_arg_values, files_crumb_args, wf_name="input_files"):
-    select_files = pe.Node(DataCrumb(crumb=data_crumb,
-                                     templates=file_templates,
-                                     raise_on_empty=False),
-                           name='selectfiles')
+    if batch_select:
+        select_files = pe.Node(DataCrumbTable(crumb=data_crumb,
+                                              templates=file_templates),
+                               name='selectfiles')
+    else:
+        select_files = pe.Node(DataCrumb(crumb=data_crumb,
+                                         templates=file_templates,
+                                         raise_on_empty=False),
+                               name='selectfiles')
 
     # basic file name substitutions for the datasink
     undef_args = select_files.interface._infields
@@ -149,10 +294,60 @@ def crumb_wf(work_dir, data_crumb, output_dir, file_templates,
                                                       substitutions)
 
     # Infosource - the information source that iterates over crumb values map from the filesystem
-    infosource = pe.Node(interface=IdentityInterface(fields=undef_args), name="infosrc")
-    infosource.iterables = list(valuesmap_to_dict(joint_value_map(data_crumb, undef_args)).items())
+    index = crumb_index(work_dir) if use_index else None
+    if index is not None and not batch_select:
+        select_files.inputs.index_file = index.index_file
+
+    write_manifests = incremental or shard is not None
+    shard_suffix = '_shard{}of{}'.format(*shard) if shard is not None else ''
+
+    table = None
+    if batch_select or write_manifests:
+        table = crumb_file_table(data_crumb, file_templates, undef_args, index=index)
+
+    if shard is not None:
+        shard_idx, n_shards = shard
+        table = OrderedDict(list(table.items())[shard_idx::n_shards])
+
+    if write_manifests:
+        if not config_id:
+            config_id = config_digest(file_templates)
+
+        entries = manifest_entries(table, undef_args, config_id, digest=digest)
+        if incremental:
+            n_subjects = len(table)
+            table = outdated_subjects(table, entries, output_dir)
+            entries = OrderedDict((op.join(*key), entries[op.join(*key)]) for key in table)
+            log.info('Incremental mode: {} of {} subjects are outdated.'.format(len(table),
+                                                                               n_subjects))
+
+        pending_file = op.join(work_dir, wf_name, 'manifest_pending{}.json'.format(shard_suffix))
+        save_pending_manifests(entries, pending_file)
+
+    if batch_select:
+        file_fields = list(file_templates)
+        infosource  = pe.Node(interface=IdentityInterface(fields=undef_args + file_fields), name="infosrc")
+        infosource.iterables = file_table_iterables(table, file_templates, undef_args,
+                                                    table_file=op.join(work_dir, wf_name,
+                                                                       'selectfiles_table{}.json'.format(shard_suffix)))
+        infosrc_fields = undef_args + file_fields
+    else:
+        infosource = pe.Node(interface=IdentityInterface(fields=undef_args), name="infosrc")
+        if table is not None:
+            infosource.iterables = [(name, [key[idx] for key in table])
+                                    for idx, name in enumerate(undef_args)]
+        else:
+            if index is not None:
+                values_map = index.joint_value_map(data_crumb, undef_args)
+            else:
+                values_map = joint_value_map(data_crumb, undef_args)
+            infosource.iterables = list(valuesmap_to_dict(values_map).items())
+        infosrc_fields = undef_args
     infosource.synchronize = True
 
+    if index is not None:
+        index.save()
+
     # connect the input_wf to the datasink
     joinpath = pe.Node(joinstrings(len(undef_args)), name='joinpath')
 
@@ -161,12 +356,74 @@ def crumb_wf(work_dir, data_crumb, output_dir, file_templates,
                    for arg_no, name in enumerate(undef_args)]
 
     wf.connect([
-                (infosource,   select_files, [(field, field) for field in undef_args]),
+                (infosource,   select_files, [(field, field) for field in infosrc_fields]),
                 (select_files, joinpath,     input_joins),
                 (joinpath,     datasink,     [("out", "container")]),
                ],
               )
 
+    if write_manifests:
+        # it always runs, the manifest must be rewritten if the subject is reprocessed
+        manifest = pe.Node(Function(input_names=['out_files',
+                                                 'output_dir',
+                                                 'container',
+                                                 'pending_file'],
+                                    output_names=['manifest_file'],
+                                    function=write_subject_manifest),
+                           name='manifest',
+                           overwrite=True)
+        manifest.inputs.output_dir   = output_dir
+        manifest.inputs.pending_file = pending_file
+
+        wf.connect([
+                    (joinpath, manifest, [("out",      "container")]),
+                    (datasink, manifest, [("out_file", "out_files")]),
+                   ])
+
     return wf
 
 
+def file_table_iterables(table, file_templates, arg_names, table_file=''):
+    """ Return the synchronized iterables for the crumb arguments `arg_names`
+    and the fields of `file_templates` from a `crumb_file_table`.
+
+    Parameters
+    ----------
+    table: OrderedDict[tuple of str] -> dict[str] -> list of str
+        The result of `crumb_file_table`.
+
+    file_templates: Dict[str -> list of 2-tuple]
+
+    arg_names: list of str
+        The crumb arguments that identify each subject.
+
+    table_file: str
+        If not empty, path to a JSON file where to save the subject to files table.
+
+    Returns
+    -------
+    iterables: list of 2-tuples
+        (field name, list of values) for each of `arg_names` and `file_templates`.
+        The subjects with no files for any of the `file_templates` are left out.
+    """
+    iterables = [(name, []) for name in list(arg_names) + list(file_templates)]
+    for key, files in table.items():
+        missing = [field for field in file_templates if not files[field]]
+        if missing:
+            warn("No files were found for {} of {}, skipping it.".format(missing,
+                                                                         dict(zip(arg_names, key))))
+            continue
+
+        values = list(key) + [list_to_filename(files[field]) for field in file_templates]
+        for idx, value in enumerate(values):
+            iterables[idx][1].append(value)
+
+    if table_file:
+        os.makedirs(op.dirname(table_file), exist_ok=True)
+        with open(table_file, 'w') as f:
+            json.dump([dict(zip(arg_names, key), **files) for key, files in table.items()],
+                      f, indent=2)
+
+    return iterables
+
+
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""
+A job queue on a shared file system and the nipype execution plugin that
+submits the workflow nodes to it.
+
+The queue is a folder with one JSON file per job in the `pending`, `running`
+and `done` subfolders. A worker claims a pending job renaming its file into
+`running`, which only one of the workers can do, writes its lease in it and
+keeps it leased touching the file while the job runs. Each claim writes a new lease token in
+the job file, so a worker whose job was reaped and claimed again by another
+one can not renew nor complete it anymore. The jobs whose lease expired,
+because its worker died or lost the file system, are put back in `pending`.
+The lease times are measured with the clock of the file system of the
+queue, not with the clocks of the hosts.
+Any number of workers in any host that mounts the queue folder can be
+started with `pypes worker <queue_dir>`.
+"""
+import os
+import os.path as op
+import json
+import time
+import shlex
+import uuid
+import socket
+import logging
+import subprocess
+import threading
+
+from   nipype.pipeline.plugins.base import SGELikeBatchManagerBase
+
+from   .imgcache import cache_settings, IMAGE_CACHE_VAR
+
+
+log = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE    = 'done'
+
+CLAIM_EXT = '.claim'
+
+
+class JobQueue(object):
+    """ A job queue in the folder `queue_dir`.
+
+    Parameters
+    ----------
+    queue_dir: str
+        Path to the queue folder. It must be in a file system shared by
+        the submitting process and the workers.
+
+    lease_secs: float
+        Number of seconds a running job is kept leased without a heartbeat
+        from its worker.
+
+    max_attempts: int
+        Number of times a job is run before giving up, counting the ones
+        whose lease expired.
+    """
+    def __init__(self, queue_dir, lease_secs=120, max_attempts=3):
+        self.queue_dir    = op.abspath(queue_dir)
+        self.lease_secs   = lease_secs
+        self.max_attempts = max_attempts
+
+        for state in (PENDING, RUNNING, DONE):
+            os.makedirs(op.join(self.queue_dir, state), exist_ok=True)
+
+    def _job_file(self, state, job_id):
+        return op.join(self.queue_dir, state, job_id + '.json')
+
+    def _write(self, file_path, job):
+        tmp_file = '{}.{}.tmp'.format(file_path, uuid.uuid4().hex)
+        with open(tmp_file, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_file, file_path)
+
+    def _read(self, file_path):
+        with open(file_path) as f:
+            return json.load(f)
+
+    def put(self, script_file, name=''):
+        """ Add a job that runs `script_file` with `sh` and return its id."""
+        # the ids sort by submission time
+        job_id = '{:020d}_{}'.format(time.time_ns(), uuid.uuid4().hex[:8])
+        job = {'id': job_id,
+               'name': name,
+               'script': script_file,
+               'attempts': 0,
+               'max_attempts': self.max_attempts,
+               'submitted': time.time(),
+              }
+        self._write(self._job_file(PENDING, job_id), job)
+        return job_id
+
+    def status(self, job_id):
+        """ Return the state of the job: 'pending', 'running', 'done' or
+        None if it is not in the queue."""
+        for state in (DONE, RUNNING, PENDING):
+            if op.exists(self._job_file(state, job_id)):
+                return state
+        return None
+
+    def result(self, job_id):
+        """ Return the content of the job file of a done job."""
+        return self._read(self._job_file(DONE, job_id))
+
+    def _fs_now(self):
+        """ Return the current time of the file system of the queue,
+        touching a probe file of this process in it."""
+        probe_file = op.join(self.queue_dir, '.clock_{}_{}'.format(socket.gethostname(), os.getpid()))
+        with open(probe_file, 'a'):
+            pass
+        os.utime(probe_file)
+        return os.stat(probe_file).st_mtime
+
+    def _owns(self, job):
+        """ Return True if `job` is still running with its lease token."""
+        try:
+            running_job = self._read(self._job_file(RUNNING, job['id']))
+        except (FileNotFoundError, ValueError):
+            return False
+        return running_job.get('lease') == job.get('lease')
+
+    def claim(self, worker=''):
+        """ Lease the oldest pending job to `worker`.
+
+        Returns
+        -------
+        job: dict or None
+            None if there are no pending jobs.
+        """
+        for job_file in sorted(os.listdir(op.join(self.queue_dir, PENDING))):
+            if not job_file.endswith('.json'):
+                continue
+
+            job_id = job_file[:-len('.json')]
+            lease  = uuid.uuid4().hex
+
+            # the job is leased in a file of this claim only, that `reap` does not
+            # take as expired, and then moved to its running file with a fresh mtime
+            claim_file = op.join(self.queue_dir, RUNNING, '{}.{}{}'.format(job_id, lease, CLAIM_EXT))
+            try:
+                os.rename(self._job_file(PENDING, job_id), claim_file)
+            except FileNotFoundError:
+                # another worker was faster
+                continue
+
+            try:
+                job = self._read(claim_file)
+            except (FileNotFoundError, ValueError):
+                log.warning('Could not read the job file of {}, skipping it.'.format(job_id))
+                continue
+
+            job['attempts'] += 1
+            job['worker'] = worker
+            job['lease'] = lease
+            self._write(claim_file, job)
+            os.replace(claim_file, self._job_file(RUNNING, job_id))
+            return job
+
+        return None
+
+    def heartbeat(self, job):
+        """ Renew the lease of the running `job`, as returned by `claim`.
+        Return False if the job is not leased with its token anymore."""
+        if not self._owns(job):
+            return False
+        try:
+            os.utime(self._job_file(RUNNING, job['id']))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def complete(self, job, exitcode):
+        """ Move the running `job` to done with its `exitcode`.
+        Return False, and leave the job as it is, if it is not leased with
+        the token of `job` anymore."""
+        if not self._owns(job):
+            log.warning('Job {} is not leased to {} anymore, '
+                        'not completing it.'.format(job['id'], job.get('worker')))
+            return False
+
+        job['exitcode'] = exitcode
+        job['finished'] = time.time()
+        self._write(self._job_file(DONE, job['id']), job)
+        try:
+            os.remove(self._job_file(RUNNING, job['id']))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def reap(self):
+        """ Put back in pending the running jobs with an expired lease, or
+        in done if they already ran `max_attempts` times.
+        Return the ids of the reaped jobs."""
+        reaped = []
+        now = self._fs_now()
+        for job_file in os.listdir(op.join(self.queue_dir, RUNNING)):
+            if job_file.endswith(CLAIM_EXT):
+                self._reap_claim(op.join(self.queue_dir, RUNNING, job_file), now)
+                continue
+
+            if not job_file.endswith('.json'):
+                continue
+
+            running_file = op.join(self.queue_dir, RUNNING, job_file)
+            try:
+                if now - os.stat(running_file).st_mtime < self.lease_secs:
+                    continue
+                job = self._read(running_file)
+            except (FileNotFoundError, ValueError):
+                continue
+
+            log.warning('The lease of job {} in {} expired.'.format(job['id'], job.get('worker')))
+            if job['attempts'] >= job.get('max_attempts', self.max_attempts):
+                self.complete(job, exitcode=None)
+            else:
+                try:
+                    os.rename(running_file, self._job_file(PENDING, job['id']))
+                except FileNotFoundError:
+                    continue
+            reaped.append(job['id'])
+
+        return reaped
+
+    def _reap_claim(self, claim_file, now):
+        """ Put back in pending the job of a claim file of a worker that died
+        while claiming it."""
+        try:
+            # the rename into the claim file sets its ctime, not its mtime
+            if now - os.stat(claim_file).st_ctime < self.lease_secs:
+                return
+            job_id = op.basename(claim_file).split('.')[0]
+            log.warning('The claim of job {} was not finished.'.format(job_id))
+            os.rename(claim_file, self._job_file(PENDING, job_id))
+        except FileNotFoundError:
+            pass
+
+
+def run_worker(queue_dir, n_jobs=1, lease_secs=120, poll_secs=2, idle_exit=0):
+    """ Run the jobs of the queue in `queue_dir` until killed.
+
+    Parameters
+    ----------
+    queue_dir: str
+        Path to the queue folder.
+
+    n_jobs: int
+        Number of jobs to run at the same time.
+
+    lease_secs: float
+        See `JobQueue`. It should be the same for all the workers.
+
+    poll_secs: float
+        Seconds to wait for new jobs when the queue is empty.
+
+    idle_exit: float
+        If > 0, exit after this number of seconds without jobs.
+    """
+    queue   = JobQueue(queue_dir, lease_secs=lease_secs)
+    worker  = '{}:{}'.format(socket.gethostname(), os.getpid())
+    threads = []
+    idle_since = time.time()
+
+    log.info('Worker {} listening to {}.'.format(worker, queue.queue_dir))
+    while True:
+        queue.reap()
+
+        threads = [thread for thread in threads if thread.is_alive()]
+        if threads:
+            idle_since = time.time()
+
+        if len(threads) >= n_jobs:
+            time.sleep(poll_secs)
+            continue
+
+        job = queue.claim(worker)
+        if job is None:
+            if idle_exit > 0 and time.time() - idle_since > idle_exit:
+                break
+            time.sleep(poll_secs)
+            continue
+
+        thread = threading.Thread(target=_run_job, args=(queue, job), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    log.info('Worker {} idle for {} seconds, exiting.'.format(worker, idle_exit))
+
+
+def _run_job(queue, job):
+    """ Run `job` renewing its lease until it finishes.
+    The job process is killed if the lease is lost."""
+    log.info('Running job {} ({}).'.format(job['id'], job['name']))
+    proc = subprocess.Popen(['sh', job['script']], cwd=op.dirname(job['script']))
+    while True:
+        try:
+            proc.wait(timeout=queue.lease_secs / 4.)
+            break
+        except subprocess.TimeoutExpired:
+            if not queue.heartbeat(job):
+                log.warning('Lost the lease of job {}, killing it.'.format(job['id']))
+                proc.kill()
+                proc.wait()
+                return
+
+    queue.complete(job, exitcode=proc.returncode)
+
+
+class QueuePlugin(SGELikeBatchManagerBase):
+    """ Execute the workflow nodes through a `JobQueue`.
+
+    The nodes are run by the `pypes worker` processes of the queue, in this
+    or any other host that shares the file system of the queue and of the
+    workflow working directory.
+
+    The plugin_args input to run can be used to control the execution.
+    Currently supported options are:
+
+    - queue_dir: path to the queue folder.
+
+    - lease_secs: see `JobQueue`.
+
+    - max_attempts: see `JobQueue`.
+
+    - template: the lines to put before the node command in the job script.
+
+    The job scripts export the image cache settings of this process for
+    the node processes, see `pypes.imgcache.cache_settings`.
+    """
+    def __init__(self, **kwargs):
+        plugin_args = kwargs.get('plugin_args') or {}
+        if 'queue_dir' not in plugin_args:
+            raise ValueError('Expected a `queue_dir` in `plugin_args` for the Queue plugin.')
+
+        self._queue = JobQueue(plugin_args['queue_dir'],
+                               lease_secs=plugin_args.get('lease_secs', 120),
+                               max_attempts=plugin_args.get('max_attempts', 3))
+
+        super(QueuePlugin, self).__init__('', **kwargs)
+
+        # the workers do not share the configuration of this process
+        settings = cache_settings()
+        if settings['image_cache_gb'] and settings['image_cache_dir']:
+            self._template = '\n'.join((self._template.rstrip('\n'),
+                                        'export {}={}'.format(IMAGE_CACHE_VAR,
+                                                              shlex.quote(json.dumps(settings)))))
+
+    def _is_pending(self, taskid):
+        return self._queue.status(taskid) != DONE
+
+    def _submit_batchtask(self, scriptfile, node):
+        taskid = self._queue.put(scriptfile, name=node.fullname)
+        self._pending[taskid] = node.output_dir()
+        log.debug('Submitted job {} for node {}.'.format(taskid, node._id))
+        return taskid
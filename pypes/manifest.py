@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Manifests of the datasink outputs of each subject, used to skip the
+subjects whose results are already complete and up to date.
+
+Each subject folder in the output directory gets a JSON sidecar with
+the digests of its input files, the digest of the configuration it was
+processed with and the list of files the datasink left for it.
+"""
+import os
+import os.path as op
+import json
+import hashlib
+from   collections import OrderedDict
+
+from   .config import PYPES_CFG
+
+
+MANIFEST_NAME = 'pypes_manifest.json'
+
+
+def file_digest(file_path, method='mtime'):
+    """ Return a digest string of the file in `file_path`.
+
+    Parameters
+    ----------
+    file_path: str
+
+    method: str
+        Choices: 'mtime', 'content'.
+        With 'mtime' the digest is built from the size and the modification
+        time of the file, with 'content' it is the SHA-1 of the file content.
+
+    Returns
+    -------
+    digest: str
+    """
+    if method == 'mtime':
+        stat = os.stat(file_path)
+        return '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+    elif method == 'content':
+        sha1 = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+    else:
+        raise ValueError("Expected 'mtime' or 'content' for `method`, got {}.".format(method))
+
+
+def input_digests(files, method='mtime'):
+    """ Return the digests of the input files of one subject.
+
+    Parameters
+    ----------
+    files: dict[str] -> list of str
+        The input files of each field, as in a `crumb_file_table` row.
+
+    method: str
+        See `file_digest`.
+
+    Returns
+    -------
+    digests: dict[str] -> dict[str] -> str
+        For each field, a dict from file path to its digest.
+    """
+    return {field: {path: file_digest(path, method=method) for path in paths}
+            for field, paths in files.items()}
+
+
+def config_digest(*extra):
+    """ Return the SHA-1 digest of the global configuration settings and of
+    any other JSON serializable object in `extra` that defines the results,
+    e.g., the names of the attached workflows.
+    """
+    content = json.dumps([sorted(PYPES_CFG.items()), extra], sort_keys=True, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def manifest_file(output_dir, container):
+    """ Return the path to the manifest of the subject in the
+    `container` folder of `output_dir`."""
+    return op.join(output_dir, container, MANIFEST_NAME)
+
+
+def read_manifest(file_path):
+    """ Return the content of the manifest in `file_path`, None if it
+    does not exist or can't be read."""
+    try:
+        with open(file_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_up_to_date(manifest, inputs, config_id, output_dir):
+    """ Return True if `manifest` was written for the same `inputs`
+    digests and `config_id` and all its output files still exist
+    in `output_dir`."""
+    if not manifest or not manifest.get('outputs'):
+        return False
+
+    if manifest.get('config') != config_id or manifest.get('inputs') != inputs:
+        return False
+
+    return all(op.exists(op.join(output_dir, path)) for path in manifest['outputs'])
+
+
+def manifest_entries(table, arg_names, config_id, digest='mtime'):
+    """ Return the manifest entries, without the outputs, for the
+    subjects in `table`.
+
+    Parameters
+    ----------
+    table: OrderedDict[tuple of str] -> dict[str] -> list of str
+        A `crumb_file_table` of the input files.
+
+    arg_names: list of str
+        The crumb arguments of the keys in `table`.
+        The values of the keys are joined to make the subject folder
+        in the output directory, as the `joinpath` node of `crumb_wf` does.
+
+    config_id: str
+        Digest of the configuration, see `config_digest`.
+
+    digest: str
+        Method to compute the input file digests. See `file_digest`.
+
+    Returns
+    -------
+    entries: OrderedDict[str] -> dict
+        The manifest entry for each subject folder.
+    """
+    entries = OrderedDict()
+    for key, files in table.items():
+        entries[op.join(*key)] = {'args':   OrderedDict(zip(arg_names, key)),
+                                  'inputs': input_digests(files, method=digest),
+                                  'config': config_id,
+                                 }
+    return entries
+
+
+def outdated_subjects(table, entries, output_dir):
+    """ Return the rows of `table` whose subjects have no up to date manifest
+    in `output_dir`.
+
+    Parameters
+    ----------
+    table: OrderedDict[tuple of str] -> dict[str] -> list of str
+        A `crumb_file_table` of the input files.
+
+    entries: OrderedDict[str] -> dict
+        The result of `manifest_entries` for `table`.
+
+    output_dir: str
+        The datasink base directory.
+
+    Returns
+    -------
+    table: OrderedDict[tuple of str] -> dict[str] -> list of str
+    """
+    outdated = OrderedDict()
+    for (key, files), (container, entry) in zip(table.items(), entries.items()):
+        manifest = read_manifest(manifest_file(output_dir, container))
+        if not is_up_to_date(manifest, entry['inputs'], entry['config'], output_dir):
+            outdated[key] = files
+
+    return outdated
+
+
+def save_pending_manifests(entries, pending_file):
+    """ Save the manifest `entries` in the JSON `pending_file`, for the
+    `write_subject_manifest` nodes."""
+    os.makedirs(op.dirname(pending_file), exist_ok=True)
+    with open(pending_file, 'w') as f:
+        json.dump(entries, f)
+
+
+def write_subject_manifest(out_files, output_dir, container, pending_file):
+    """ Write the manifest of the subject in `container` with its entry in
+    `pending_file` and the datasink `out_files`.
+    This is a nipype Function node function, to run after the datasink.
+
+    Parameters
+    ----------
+    out_files: str or list of str
+        The `out_file` output of the datasink.
+
+    output_dir: str
+        The datasink base directory.
+
+    container: str
+        The subject folder in `output_dir`.
+
+    pending_file: str
+        JSON file written by `save_pending_manifests`.
+
+    Returns
+    -------
+    manifest_file: str
+    """
+    import os
+    import os.path as op
+    import json
+
+    from nipype.utils.filemanip import filename_to_list
+
+    from pypes.manifest import manifest_file
+
+    with open(pending_file) as f:
+        entry = json.load(f)[container]
+
+    entry['outputs'] = sorted(op.relpath(path, output_dir)
+                              for path in filename_to_list(out_files) if path)
+
+    out_file = manifest_file(output_dir, container)
+    os.makedirs(op.dirname(out_file), exist_ok=True)
+    tmp_file = out_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(entry, f, indent=2)
+    os.replace(tmp_file, out_file)
+
+    return out_file
+
+
+def merge_manifests(output_dir, out_file=''):
+    """ Collect the manifests of all the subjects in `output_dir` in one file.
+
+    Parameters
+    ----------
+    output_dir: str
+        The datasink base directory.
+
+    out_file: str
+        Path to the output JSON file.
+        Default: '{output_dir}/pypes_cohort_manifest.json'.
+
+    Returns
+    -------
+    out_file: str
+    """
+    if not out_file:
+        out_file = op.join(output_dir, 'pypes_cohort_manifest.json')
+
+    manifests = OrderedDict()
+    for root, dirs, files in os.walk(output_dir):
+        dirs.sort()
+        if MANIFEST_NAME in files:
+            # the outputs of a subject are inside its folder
+            dirs[:] = []
+            manifest = read_manifest(op.join(root, MANIFEST_NAME))
+            if manifest is not None:
+                manifests[op.relpath(root, output_dir)] = manifest
+
+    with open(out_file, 'w') as f:
+        json.dump(manifests, f, indent=2)
+
+    return out_file
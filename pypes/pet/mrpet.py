@@ -5,11 +5,11 @@ PET-MR image preprocessing nipype workflows.
 import os.path as op
 
 import nipype.pipeline.engine    as pe
-from   nipype.algorithms.misc    import Gunzip
 from   nipype.interfaces         import spm
 from   nipype.interfaces.utility import Merge, IdentityInterface, Function
 
 from   .pvc      import petpvc_workflow
+from   ..interfaces.files import Gunzip
 from   ..config  import (setup_node,
                         check_atlas_file,
                         get_config_setting)
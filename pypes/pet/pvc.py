@@ -5,12 +5,12 @@ A PETPVC workflow
 import os.path as op
 
 import nipype.pipeline.engine    as pe
-from   nipype.algorithms.misc    import Gunzip
 from   nipype.interfaces.utility import Select, IdentityInterface, Function
 
 from  .utils     import (petpvc_cmd,
                          petpvc_mask,
                          intensity_norm)
+from   ..interfaces.files import Gunzip
 from   ..config  import setup_node, get_config_setting
 from   ..preproc import spm_coregister
 from   ..utils   import (get_datasink,
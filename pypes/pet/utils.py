@@ -3,13 +3,12 @@
 PET image preprocessing utilities nipype function helpers.
 """
 from   nipype.interfaces.base    import traits
-from   nipype.interfaces.utility import Merge, Function, IdentityInterface
+from   nipype.interfaces.utility import Function, IdentityInterface
 from   nipype.pipeline import Workflow
 
-from   ..interfaces.nilearn import math_img, concat_imgs, resample_to_img
 from   ..config  import setup_node
 from   ..preproc import PETPVC
-from   ..utils   import selectindex, rename
+from   ..utils   import rename
 
 
 #TODO: add a becquerel/ml normalization function node
@@ -56,6 +55,81 @@ def petpvc_cmd(in_file=traits.Undefined, mask_file=traits.Undefined, out_file=tr
     return pvc
 
 
+def pvc_mask_imgs(tissues, image_settings=None):
+    """ Return the 4D PETPVC mask of the `tissues` and the background and a
+    brain mask from the `tissues`.
+    The background image is handed off in memory to the concatenation,
+    see `pypes.imgcache`.
+
+    Parameters
+    ----------
+    tissues: list of str
+        The paths to the GM, WM and CSF images, in this order.
+
+    image_settings: dict
+        The format of the images, see `pypes.config.image_settings`.
+
+    Returns
+    -------
+    petpvc_mask: str
+        Path to the 4D image with GM, WM, CSF and background.
+
+    brain_mask: str
+        Path to the binarised sum of the tissues.
+    """
+    from pypes.interfaces.nilearn import math_img, concat_imgs
+
+    gm, wm, csf = tissues
+
+    background = math_img("np.maximum((-((gm + wm + csf) - 1)), 0)",
+                          out_file="tissue_bkg.nii.gz", gm=gm, wm=wm, csf=csf,
+                          image_settings=image_settings)
+
+    brain_mask = math_img("np.abs(gm + wm + csf) > 0",
+                          out_file="tissues_brain_mask.nii.gz", gm=gm, wm=wm, csf=csf,
+                          image_settings=image_settings)
+
+    petpvc_mask = concat_imgs([gm, wm, csf, background], out_file="petpvc_mask.nii.gz",
+                              image_settings=image_settings)
+
+    return petpvc_mask, brain_mask
+
+
+def intensity_norm_img(source, mask, out_file, image_settings=None):
+    """ Divide `source` by its mean value within `mask` and save it in `out_file`.
+    The mask is resampled to `source` first, and handed off in memory to
+    the mean, see `pypes.imgcache`.
+
+    Parameters
+    ----------
+    source: str
+        Path to the image to normalize.
+
+    mask: str
+        Path to the mask image.
+
+    out_file: str
+        Path to the normalized image.
+
+    image_settings: dict
+        The format of the images, see `pypes.config.image_settings`.
+
+    Returns
+    -------
+    out_file: str
+    """
+    from pypes.interfaces.nilearn import math_img, resample_to_img
+
+    # fix the affine matrix (it's necessary for some cases)
+    mask_file = resample_to_img(mask, source, interpolation="nearest",
+                                image_settings=image_settings)
+
+    mean_val = math_img("np.mean(np.nonzero(img[mask > 0]))", img=source, mask=mask_file)
+
+    return math_img("img / val", out_file=out_file, img=source, val=mean_val,
+                    image_settings=image_settings)
+
+
 def petpvc_mask(wf_name="petpvc_mask"):
     """ A Workflow that returns a 4D merge of 4 volumes for PETPVC: GM, WM, CSF and background.
 
@@ -94,36 +168,12 @@ def petpvc_mask(wf_name="petpvc_mask"):
     pvcmask_input = setup_node(IdentityInterface(fields=in_fields, mandatory_inputs=True),
                                name="pvcmask_input")
 
-    tissues = setup_node(IdentityInterface(fields=["gm", "wm", "csf"], mandatory_inputs=True),
-                         name="tissues")
-
-    merge_list = setup_node(Merge(4), name="merge_list")
-
-    ## maths for background
-    img_bkg = setup_node(Function(function=math_img,
-                                  input_names=["formula", "out_file", "gm", "wm", "csf"],
-                                  output_names=["out_file"],
-                                  imports=['from pypes.interfaces.nilearn import ni2file']),
-                          name='background')
-    img_bkg.inputs.out_file = "tissue_bkg.nii.gz"
-    img_bkg.inputs.formula  = "np.maximum((-((gm + wm + csf) - 1)), 0)"
-
-    ## maths for brain mask
-    brain_mask = setup_node(Function(function=math_img,
-                                     input_names=["formula", "out_file", "gm", "wm", "csf"],
-                                     output_names=["out_file"],
-                                     imports=['from pypes.interfaces.nilearn import ni2file']),
-                            name='brain_mask')
-    brain_mask.inputs.out_file = "tissues_brain_mask.nii.gz"
-    brain_mask.inputs.formula  = "np.abs(gm + wm + csf) > 0"
-
-    ## concat the tissues images and the background for PETPVC
-    merge_tissues = setup_node(Function(function=concat_imgs,
-                                        input_names=["in_files"],
-                                        output_names=["out_file"],
-                                        imports=['from pypes.interfaces.nilearn import ni2file']),
-                               name='merge_tissues')
-    merge_tissues.inputs.out_file = "petpvc_mask.nii.gz"
+    ## the background, the brain mask and the concatenation of the tissues and the background
+    ## for PETPVC run in one node, so the background is handed off in memory
+    tissue_masks = setup_node(Function(function=pvc_mask_imgs,
+                                       input_names=["tissues", "image_settings"],
+                                       output_names=["petpvc_mask", "brain_mask"]),
+                              name='tissue_masks')
 
     # output
     pvcmask_output = setup_node(IdentityInterface(fields=out_fields), name="pvcmask_output")
@@ -133,25 +183,12 @@ def petpvc_mask(wf_name="petpvc_mask"):
 
     # Connect the nodes
     wf.connect([
-                # separate [GM, WM, CSF] into [GM] and [WM, CSF]
-                (pvcmask_input, tissues,    [(("tissues", selectindex, [0]), "gm"),
-                                             (("tissues", selectindex, [1]), "wm"),
-                                             (("tissues", selectindex, [2]), "csf"),
-                                            ]),
-
-                (tissues,       img_bkg,    [("gm", "gm" ), ("wm", "wm" ), ("csf", "csf"),]),
-                (tissues,       brain_mask, [("gm", "gm" ), ("wm", "wm" ), ("csf", "csf"),]),
-                (tissues,       merge_list, [("gm", "in1"), ("wm", "in2"), ("csf", "in3"),]),
-
-                # create a list of [GM, WM, CSF, BKG]
-                (img_bkg,       merge_list, [("out_file", "in4")]),
-
-                # merge into 4D: [GM, WM, CSF, BKG]
-                (merge_list,    merge_tissues,  [("out", "in_files")]),
+                (pvcmask_input, tissue_masks,   [("tissues",     "tissues")]),
 
                 # output
-                (merge_tissues, pvcmask_output, [("out_file", "petpvc_mask")]),
-                (brain_mask,    pvcmask_output, [("out_file", "brain_mask")]),
+                (tissue_masks,  pvcmask_output, [("petpvc_mask", "petpvc_mask"),
+                                                 ("brain_mask",  "brain_mask"),
+                                                ]),
               ])
 
     return wf
@@ -193,29 +230,12 @@ def intensity_norm(wf_name='intensity_norm'):
     intnorm_input = setup_node(IdentityInterface(fields=in_fields, mandatory_inputs=True),
                                name="intnorm_input")
 
-    # fix the affine matrix (it's necessary for some cases)
-    resample = setup_node(Function(function=resample_to_img,
-                                   input_names=["source", "target", "interpolation"],
-                                   output_names=["out_file"],
-                                   imports=['from pypes.interfaces.nilearn import ni2file']),
-                          name="resample_mask")
-    resample.inputs.interpolation = "nearest"
-
-    # calculate masked mean value
-    mean_val = setup_node(Function(function=math_img,
-                                   input_names=["formula", "img", "mask"],
-                                   output_names=["out_value"],
-                                   imports=['from pypes.interfaces.nilearn import ni2file']),
-                          name='mean_value')
-    mean_val.inputs.formula = "np.mean(np.nonzero(img[mask > 0]))"
-
-    # normalize
-    norm_img = setup_node(Function(function=math_img,
-                                   input_names=["formula", "out_file", "img", "val"],
-                                   output_names=["out_file"],
-                                   imports=['from pypes.interfaces.nilearn import ni2file']),
+    # resample the mask, take the mean value in it and normalize in one node,
+    # so the resampled mask is handed off in memory
+    norm_img = setup_node(Function(function=intensity_norm_img,
+                                   input_names=["source", "mask", "out_file", "image_settings"],
+                                   output_names=["out_file"]),
                           name='norm_img')
-    norm_img.inputs.formula = "img / val"
 
     # output
     intnorm_output = setup_node(IdentityInterface(fields=out_fields),
@@ -225,19 +245,12 @@ def intensity_norm(wf_name='intensity_norm'):
     wf = Workflow(name=wf_name)
 
     wf.connect([
-                # resample
-                (intnorm_input, resample,  [("source",    "target"),
-                                            ("mask",      "source")]),
-
                 # normalize
-                (intnorm_input, mean_val,  [("source",    "img" )]),
-                (resample,      mean_val,  [("out_file",  "mask")]),
-
-                (intnorm_input, norm_img,  [("source",    "img"),
+                (intnorm_input, norm_img,  [("source", "source"),
+                                            ("mask",   "mask"),
                                             (("source", rename, "_intnormed"), "out_file"),
                                            ]),
 
-                (mean_val,      norm_img,  [("out_value", "val")]),
                 (norm_img, intnorm_output, [("out_file",  "out_file")]),
                ])
 
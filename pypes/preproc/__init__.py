@@ -5,6 +5,12 @@ from .realign import nipy_motion_correction
 from .denoise import (nlmeans_denoise_img,
                       create_regressors,
                       extract_noise_components,
+                      masked_timecourses,
+                      CompCorInterface,
+                      global_signal,
+                      global_signal_regressors,
+                      nuisance_regression,
+                      NuisanceRegressionInterface,
                       motion_regressors,
                       reslice_img)
 from .registration import (spm_apply_deformations,
@@ -24,3 +30,7 @@ from .slicetime_params import (STCParameters,
                                STCParametersInterface)
 
 from .spatial import get_bounding_box
+
+from .censor import (censor_mask,
+                     censor_frames,
+                     load_censor_mask)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Censoring ("scrubbing") of the fMRI volumes with too much motion.
+
+The censor mask of a functional image is a boolean vector with one value
+per volume, True for the volumes to remove. It is saved as a .npy file to
+be used directly by the regression and connectivity nodes.
+"""
+import numpy as np
+
+
+def censor_mask(fd, threshold, frames_before=1, frames_after=2,
+                dvars=None, dvars_threshold=None):
+    """ Return the censor mask of the volumes whose framewise displacement,
+    or DVARS, exceed a threshold, together with their `frames_before`
+    preceding and `frames_after` following volumes.
+
+    Parameters
+    ----------
+    fd: np.ndarray
+        The framewise displacement of each volume.
+        The first value is ignored, there is no volume before it.
+
+    threshold: float
+        The FD threshold, the volumes with FD >= `threshold` are censored.
+
+    frames_before: int
+
+    frames_after: int
+
+    dvars: np.ndarray
+        The DVARS between each pair of consecutive volumes,
+        of length len(fd) - 1.
+
+    dvars_threshold: float
+        The volumes with DVARS > `dvars_threshold` are also censored.
+
+    Returns
+    -------
+    mask: np.ndarray of bool
+        True for the censored volumes.
+    """
+    fd = np.asarray(fd, dtype=float)
+
+    offending = fd >= threshold
+    offending[0] = False
+
+    if dvars is not None and dvars_threshold is not None:
+        offending[1:] |= np.asarray(dvars) > dvars_threshold
+
+    # dilate the offending volumes with a single pass
+    window = np.ones(frames_before + frames_after + 1)
+    dilated = np.convolve(offending, window, mode='full')
+    return dilated[frames_before:frames_before + len(fd)] > 0
+
+
+def load_censor_mask(censor_file):
+    """ Return the censor mask in the .npy `censor_file`."""
+    return np.load(censor_file).astype(bool)
+
+
+def _write_frames(out_file, indices):
+    """ Write the frame `indices` as the comma separated text files of
+    `pypes.preproc.motion_stats.set_frames_ex`."""
+    with open(out_file, 'w') as f:
+        f.write(''.join('{},'.format(idx) for idx in indices))
+
+
+def censor_frames(fd_file, threshold, frames_before=1, frames_after=2,
+                  dvars_file=None, dvars_threshold=None):
+    """ Save the `censor_mask` of the framewise displacement in `fd_file`.
+    This is a nipype Function node function.
+
+    Parameters
+    ----------
+    fd_file: str
+        Path to the FD text file.
+
+    threshold: float
+
+    frames_before: int
+
+    frames_after: int
+
+    dvars_file: str
+        Path to the DVARS .npy file.
+
+    dvars_threshold: float
+
+    Returns
+    -------
+    censor_file: str
+        Path to the censor mask .npy file.
+
+    frames_ex_file: str
+        Path to the text file with the indices of the censored frames.
+
+    frames_in_file: str
+        Path to the text file with the indices of the kept frames.
+    """
+    import os.path as op
+
+    import numpy as np
+
+    from pypes.preproc.censor import censor_mask, _write_frames
+
+    dvars = np.load(dvars_file) if dvars_file else None
+    mask  = censor_mask(np.loadtxt(fd_file), threshold,
+                        frames_before=frames_before,
+                        frames_after=frames_after,
+                        dvars=dvars,
+                        dvars_threshold=dvars_threshold)
+
+    censor_file = op.abspath('censor_mask.npy')
+    np.save(censor_file, mask)
+
+    frames_ex_file = op.abspath('frames_ex.1D')
+    frames_in_file = op.abspath('frames_in.1D')
+    _write_frames(frames_ex_file, np.flatnonzero(mask))
+    _write_frames(frames_in_file, np.flatnonzero(~mask))
+
+    return censor_file, frames_ex_file, frames_in_file
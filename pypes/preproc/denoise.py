@@ -2,7 +2,17 @@
 """
 Denoise and motion correction helper functions
 """
-from boyle.nifti.utils import nifti_out
+import os.path as op
+
+from   nipype.interfaces.base import (BaseInterface,
+                                      TraitedSpec,
+                                      InputMultiPath,
+                                      BaseInterfaceInputSpec,
+                                      traits,)
+from   boyle.nifti.utils import nifti_out
+
+from   ..config import intermediate_file
+from   ..utils import get_trait_value
 
 
 @nifti_out
@@ -113,12 +123,12 @@ def motion_regressors(motion_params, order=0, derivatives=1):
         for i in range(2, order + 1):
             out_params2 = np.hstack((out_params2, np.power(out_params, i)))
         filename = os.path.join(os.getcwd(), "motion_regressor%02d.txt" % idx)
-        np.savetxt(filename, out_params2, fmt=b"%.10f")
+        np.savetxt(filename, out_params2, fmt="%.10f")
         out_files.append(filename)
     return out_files
 
 
-def create_regressors(motion_params, comp_norm, outliers, detrend_poly=None):
+def create_regressors(motion_params, comp_norm, outliers, detrend_poly=None, censor_file=None):
     """Builds a regressor set comprising motion parameters, composite norm and
     outliers.
     The outliers are added as a single time point column for each outlier
@@ -129,6 +139,8 @@ def create_regressors(motion_params, comp_norm, outliers, detrend_poly=None):
     comp_norm: a text file containing the composite norm
     outliers: a text file containing 0-based outlier indices
     detrend_poly: number of polynomials to add to detrend
+    censor_file: a .npy censor mask, see pypes.preproc.censor.
+        A single time point column is added for each censored volume.
 
     Returns
     -------
@@ -150,8 +162,12 @@ def create_regressors(motion_params, comp_norm, outliers, detrend_poly=None):
             outlier_val = np.empty((0))
         for index in np.atleast_1d(outlier_val):
             outlier_vector = np.zeros((out_params.shape[0], 1))
-            outlier_vector[index] = 1
+            outlier_vector[int(index)] = 1
             out_params = np.hstack((out_params, outlier_vector))
+        if censor_file:
+            censored = np.load(filename_to_list(censor_file)[idx]).astype(bool)
+            spikes = np.eye(out_params.shape[0])[:, np.flatnonzero(censored)]
+            out_params = np.hstack((out_params, spikes))
         if detrend_poly:
             timepoints = out_params.shape[0]
             X = np.empty((timepoints, 0))
@@ -160,13 +176,140 @@ def create_regressors(motion_params, comp_norm, outliers, detrend_poly=None):
                     i + 1)(np.linspace(-1, 1, timepoints))[:, None]))
             out_params = np.hstack((out_params, X))
         filename = os.path.join(os.getcwd(), "filter_regressor%02d.txt" % idx)
-        np.savetxt(filename, out_params, fmt=b"%.10f")
+        np.savetxt(filename, out_params, fmt="%.10f")
         out_files.append(filename)
     return out_files
 
 
+def principal_components(X, n_components, method='full', seed=0, chunk_size=20000):
+    """ Return the first left singular vectors of `X` and the fraction of
+    the variance of `X` they explain.
+
+    Parameters
+    ----------
+    X: np.ndarray
+        Matrix of shape (n_timepoints, n_voxels).
+
+    n_components: int
+        Number of components to return, all of them if None.
+
+    method: str
+        Choices: 'full', 'gram', 'randomized'.
+        - 'full': the SVD of `X`.
+        - 'gram': the eigendecomposition of the T x T matrix X.X^T, summed
+        in float64, much faster than 'full' when there are more voxels than
+        volumes. It squares the condition number of `X`, the smallest
+        components are less precise than with 'full'.
+        - 'randomized': randomized SVD (Halko, 2011) with a fixed `seed`,
+        only the first `n_components` + 10 components are computed.
+
+    seed: int
+        Seed of the random generator of the 'randomized' method.
+
+    chunk_size: int
+        Number of voxels of `X` cast to float64 at a time by the 'gram' method.
+
+    Returns
+    -------
+    components: np.ndarray
+        Matrix of shape (n_timepoints, n_components).
+
+    explained_variance_ratio: np.ndarray
+        The fraction of the total variance of `X` explained by each component.
+    """
+    import numpy as np
+    import scipy as sp
+    import scipy.linalg
+
+    total_var = np.sum(np.square(X, dtype=np.float64))
+    n_timepoints = X.shape[0]
+
+    if method == 'full':
+        u, s, _ = sp.linalg.svd(X, full_matrices=False)
+    elif method == 'gram':
+        # float64 sums, a few voxels at a time not to copy the whole `X`
+        gram = np.zeros((n_timepoints, n_timepoints))
+        for start in range(0, X.shape[1], chunk_size):
+            block = X[:, start:start + chunk_size].astype(np.float64)
+            gram += np.dot(block, block.T)
+        eigvals, eigvecs = sp.linalg.eigh(gram)
+        order = np.argsort(eigvals)[::-1]
+        u = eigvecs[:, order]
+        s = np.sqrt(np.maximum(eigvals[order], 0))
+    elif method == 'randomized':
+        rng = np.random.RandomState(seed)
+        n_random = min(n_timepoints, (n_components or n_timepoints) + 10)
+        Y = np.dot(X, rng.standard_normal((X.shape[1], n_random)).astype(X.dtype))
+        for _ in range(4):
+            Y, _ = sp.linalg.qr(Y, mode='economic')
+            Y = np.dot(X, np.dot(X.T, Y))
+        Q, _ = sp.linalg.qr(Y, mode='economic')
+        ub, s, _ = sp.linalg.svd(np.dot(Q.T, X), full_matrices=False)
+        u = np.dot(Q, ub)
+    else:
+        raise ValueError("Expected 'full', 'gram' or 'randomized' for `method`, "
+                         "got {}.".format(method))
+
+    explained = np.square(s) / total_var if total_var > 0 else np.zeros_like(s)
+    return u[:, :n_components], explained[:n_components]
+
+
+def masked_timecourses(img_file, mask_files, chunk_size=10, dtype='float32'):
+    """ Return the time courses of the voxels in any of `mask_files`, reading
+    the 4D `img_file` once, `chunk_size` volumes at a time.
+
+    Parameters
+    ----------
+    img_file: str
+        Path to the 4D image.
+
+    mask_files: list of str
+        Paths to the 3D masks of `img_file`.
+
+    chunk_size: int
+        Number of volumes to read at a time.
+
+    dtype: str or np.dtype
+        Data type of the time courses.
+
+    Returns
+    -------
+    timecourses: np.ndarray
+        Array of shape (n_volumes, n_voxels) with the voxels in the union of
+        the masks, in C order.
+
+    columns: list of np.ndarray
+        The columns of `timecourses` of the voxels of each mask.
+    """
+    import nibabel as nib
+    import numpy as np
+
+    from pypes.imgcache import cached_file
+
+    masks = [np.asanyarray(nib.load(mask_file).dataobj) > 0 for mask_file in mask_files]
+    union = np.zeros_like(masks[0])
+    for mask in masks:
+        union |= mask
+
+    # keep the file open so the volumes of compressed images are read sequentially,
+    # the uncompressed ones are memory-mapped
+    img    = nib.load(cached_file(img_file), keep_file_open=True)
+    n_vols = img.shape[3]
+
+    timecourses = np.empty((n_vols, int(union.sum())), dtype=dtype)
+    for start in range(0, n_vols, chunk_size):
+        chunk = np.asanyarray(img.dataobj[..., start:start + chunk_size])
+        timecourses[start:start + chunk.shape[3]] = chunk[union].T
+        del chunk
+
+    union_idx = np.flatnonzero(union)
+    columns = [np.searchsorted(union_idx, np.flatnonzero(mask)) for mask in masks]
+    return timecourses, columns
+
+
 def extract_noise_components(realigned_file, mask_file, num_components=5,
-                             extra_regressors=None):
+                             extra_regressors=None, svd_method='full',
+                             variance_threshold=None):
     """Derive components most reflective of physiological noise.
     Parameters
     ----------
@@ -174,41 +317,332 @@ def extract_noise_components(realigned_file, mask_file, num_components=5,
     mask_file: a 3D Nifti file containing white matter + ventricular masks
     num_components: number of components to use for noise decomposition
     extra_regressors: additional regressors to add
+    svd_method: 'full', 'gram' or 'randomized', see principal_components
+    variance_threshold: if set, the number of components of each mask is
+        the least that explain this fraction of its variance, instead of
+        num_components
     Returns
     -------
     components_file: a text file containing the noise components
+    variance_file: a text file with the explained variance ratio of the
+        components of each mask
     """
     import os
-    import nibabel as nb
     import numpy as np
-    import scipy as sp
     from   nipype.utils.filemanip import filename_to_list
 
-    imgseries = nb.load(realigned_file)
+    from   pypes.preproc.denoise import principal_components, masked_timecourses
+
+    timecourses, columns = masked_timecourses(realigned_file, filename_to_list(mask_file))
     components = None
-    for filename in filename_to_list(mask_file):
-        mask = nb.load(filename).get_data()
-        if len(np.nonzero(mask > 0)[0]) == 0:
+    variances = []
+    for mask_idx, cols in enumerate(columns):
+        if not len(cols):
             continue
-        voxel_timecourses = imgseries.get_data()[mask > 0]
-        voxel_timecourses[np.isnan(np.sum(voxel_timecourses, axis=1)), :] = 0
         # remove mean and normalize by variance
-        # voxel_timecourses.shape == [nvoxels, time]
-        X = voxel_timecourses.T
+        # X.shape == [time, nvoxels]
+        X = timecourses[:, cols]
+        X[:, np.isnan(np.sum(X, axis=0))] = 0
         stdX = np.std(X, axis=0)
         stdX[stdX == 0] = 1.
         stdX[np.isnan(stdX)] = 1.
         stdX[np.isinf(stdX)] = 1.
-        X = (X - np.mean(X, axis=0)) / stdX
-        u, _, _ = sp.linalg.svd(X, full_matrices=False)
+        X -= np.mean(X, axis=0)
+        X /= stdX
+
+        n_components = None if variance_threshold else num_components
+        u, explained = principal_components(X, n_components, method=svd_method)
+        del X
+        if variance_threshold:
+            n_components = np.searchsorted(np.cumsum(explained), variance_threshold) + 1
+            u, explained = u[:, :n_components], explained[:n_components]
+
+        for comp_idx, ratio in enumerate(explained):
+            variances.append((mask_idx, comp_idx, ratio))
+
         if components is None:
-            components = u[:, :num_components]
+            components = u
         else:
-            components = np.hstack((components, u[:, :num_components]))
+            components = np.hstack((components, u))
     if extra_regressors:
         regressors = np.genfromtxt(extra_regressors)
         components = np.hstack((components, regressors))
     components_file = os.path.join(os.getcwd(), 'noise_components.txt')
+    variance_file   = os.path.join(os.getcwd(), 'noise_components_variance.txt')
+
+    np.savetxt(components_file, components, fmt="%.10f")
+    np.savetxt(variance_file, np.array(variances).reshape(-1, 3), fmt=["%d", "%d", "%.10f"],
+               header='mask component explained_variance_ratio')
+    return components_file, variance_file
+
+
+def global_signal(img_file, mask_file, chunk_size=10):
+    """ Return the mean of the 4D `img_file` within `mask_file` for each
+    volume, reading `chunk_size` volumes at a time.
+
+    Parameters
+    ----------
+    img_file: str
+        Path to the 4D image.
+
+    mask_file: str
+        Path to the 3D mask of `img_file`.
+
+    chunk_size: int
+        Number of volumes to read at a time.
+
+    Returns
+    -------
+    signal: np.ndarray
+        Array of shape (n_volumes, ).
+    """
+    import nibabel as nib
+    import numpy as np
+
+    from pypes.imgcache import cached_file
+
+    mask = np.asanyarray(nib.load(mask_file).dataobj) > 0
+
+    # keep the file open so the volumes of compressed images are read sequentially,
+    # the uncompressed ones are memory-mapped
+    img    = nib.load(cached_file(img_file), keep_file_open=True)
+    n_vols = img.shape[3]
+
+    signal = np.zeros(n_vols)
+    for start in range(0, n_vols, chunk_size):
+        chunk = np.asanyarray(img.dataobj[..., start:start + chunk_size])
+        signal[start:start + chunk.shape[3]] = np.mean(chunk[mask], axis=0, dtype=np.float64)
+        del chunk
+
+    return signal
+
+
+def global_signal_regressors(realigned_file, mask_file, derivatives=False, squares=False):
+    """ Save the global signal of `realigned_file` within `mask_file`
+    to be used as regressors.
+
+    Parameters
+    ----------
+    realigned_file: str
+        Path to the 4D fMRI image.
+
+    mask_file: str
+        Path to the brain mask.
+
+    derivatives: bool
+        If True, add the temporal derivative of the global signal,
+        0 for the first volume.
+
+    squares: bool
+        If True, add the squares of the other regressors.
+
+    Returns
+    -------
+    regressors_file: str
+        Path to the text file with one column per regressor.
+    """
+    import os
+    import numpy as np
+
+    from   pypes.preproc.denoise import global_signal
+
+    signal = global_signal(realigned_file, mask_file)
+
+    regressors = [signal]
+    if derivatives:
+        regressors.append(np.concatenate([[0], np.diff(signal)]))
+    if squares:
+        regressors.extend([np.square(regressor) for regressor in regressors])
+
+    regressors_file = os.path.join(os.getcwd(), 'global_signal.txt')
+    np.savetxt(regressors_file, np.column_stack(regressors), fmt="%.10f")
+    return regressors_file
+
+
+def nuisance_regression(in_file, design_files, mask_file, out_file, demean=True, chunk_size=20000,
+                        image_settings=None):
+    """ Save the residuals of the least squares regression of the time courses
+    of `in_file` within `mask_file` on all the regressors in `design_files`.
 
-    np.savetxt(components_file, components, fmt=b"%.10f")
-    return components_file
+    The voxel time courses are read once and the regression is solved in
+    memory, `chunk_size` voxels at a time. The residuals are written to a
+    temporary memory-mapped file, not held in memory as a whole 4D array.
+
+    Parameters
+    ----------
+    in_file: str
+        Path to the 4D fMRI image.
+
+    design_files: list of str
+        Paths to the text files with the regressors, one column per regressor.
+
+    mask_file: str
+        Path to the brain mask. The voxels out of it are 0 in the output.
+
+    out_file: str
+        Path to the output residuals image.
+
+    demean: bool
+        If True, remove the mean of the time courses and of the regressors
+        before the regression, as fsl_glm --demean.
+
+    chunk_size: int
+        Number of voxels to regress at a time.
+
+    image_settings: dict
+        The format of the output image, see `pypes.config.image_settings`.
+
+    Returns
+    -------
+    out_file: str
+    """
+    import os
+    import tempfile
+
+    import nibabel as nib
+    import numpy as np
+    from   nipype.utils.filemanip import filename_to_list
+
+    from   pypes.config import intermediate_file
+    from   pypes.utils.files import save_nifti
+    from   pypes.preproc.denoise import masked_timecourses
+
+    timecourses, _ = masked_timecourses(in_file, [mask_file])
+    n_vols = timecourses.shape[0]
+
+    X = np.hstack([np.loadtxt(design_file, ndmin=2).reshape(n_vols, -1)
+                   for design_file in filename_to_list(design_files)])
+    if demean:
+        X = X - X.mean(axis=0)
+    pinv_X = np.linalg.pinv(X).astype(np.float32)
+    X      = X.astype(np.float32)
+
+    img  = nib.load(in_file)
+    mask = np.asanyarray(nib.load(mask_file).dataobj) > 0
+    voxels = np.flatnonzero(mask)
+
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    image_settings = image_settings or {}
+    out_file = intermediate_file(out_file, image_settings.get('intermediate_format'))
+
+    with tempfile.TemporaryDirectory(dir=os.getcwd()) as tmp_dir:
+        # the voxel time courses are the rows of the C ordered residuals
+        residuals = np.memmap(os.path.join(tmp_dir, 'residuals.dat'), dtype=np.float32,
+                              mode='w+', shape=img.shape)
+        residuals_2d = residuals.reshape(-1, n_vols)
+        for start in range(0, len(voxels), chunk_size):
+            Y = timecourses[:, start:start + chunk_size]
+            if demean:
+                Y -= Y.mean(axis=0)
+            Y -= np.dot(X, np.dot(pinv_X, Y))
+            residuals_2d[voxels[start:start + chunk_size]] = Y.T
+        del timecourses
+
+        save_nifti(nib.Nifti1Image(residuals, img.affine, header), out_file,
+                   compresslevel=image_settings.get('compress_level'))
+        del residuals, residuals_2d
+
+    return out_file
+
+
+class CompCorInputSpec(BaseInterfaceInputSpec):
+    realigned_file     = traits.File(exists=True, mandatory=True,
+                                     desc="4D fMRI image file.")
+    mask_file          = InputMultiPath(traits.File(exists=True), mandatory=True,
+                                        desc="3D mask file(s) of the noise regions, e.g., white matter "
+                                             "and CSF. The components of each mask are extracted.")
+    num_components     = traits.Int(5, usedefault=True,
+                                    desc="Number of components to extract of each mask.")
+    extra_regressors   = traits.File(exists=True,
+                                     desc="Text file with regressors to append to the components.")
+    svd_method         = traits.Enum('full', 'gram', 'randomized', usedefault=True,
+                                     desc="Method of the singular value decomposition. "
+                                          "See `principal_components`.")
+    variance_threshold = traits.Float(desc="If set, extract of each mask the least components "
+                                           "that explain this fraction of its variance, "
+                                           "instead of `num_components`.")
+
+
+class CompCorOutputSpec(TraitedSpec):
+    components_file = traits.File(exists=True, desc="Text file with the noise components.")
+    variance_file   = traits.File(exists=True, desc="Text file with the explained variance ratio "
+                                                    "of the components of each mask.")
+
+
+class CompCorInterface(BaseInterface):
+    """ Extract the components of the physiological noise of an fMRI image
+    (CompCor, Behzadi et al. 2007) from its time courses within noise masks.
+
+    See `extract_noise_components`.
+    """
+    input_spec  = CompCorInputSpec
+    output_spec = CompCorOutputSpec
+
+    def _run_interface(self, runtime):
+        self._components_file, self._variance_file = extract_noise_components(
+            self.inputs.realigned_file,
+            self.inputs.mask_file,
+            num_components=self.inputs.num_components,
+            extra_regressors=get_trait_value(self.inputs, 'extra_regressors', default=None),
+            svd_method=self.inputs.svd_method,
+            variance_threshold=get_trait_value(self.inputs, 'variance_threshold', default=None),
+        )
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['components_file'] = op.abspath(self._components_file)
+        outputs['variance_file']   = op.abspath(self._variance_file)
+        return outputs
+
+
+class NuisanceRegressionInputSpec(BaseInterfaceInputSpec):
+    in_file      = traits.File(exists=True, mandatory=True, desc="4D fMRI image file.")
+    design_files = InputMultiPath(traits.File(exists=True), mandatory=True,
+                                  desc="Text file(s) with the regressors, one column per regressor. "
+                                       "All of them are regressed at once.")
+    mask_file    = traits.File(exists=True, mandatory=True, desc="Brain mask file.")
+    out_file     = traits.Str(desc="Name of the output residuals image file.")
+    demean       = traits.Bool(True, usedefault=True,
+                               desc="Remove the mean of the data and of the regressors.")
+    image_settings = traits.Dict(desc="The format of the residuals image, "
+                                      "see pypes.config.image_settings.")
+
+
+class NuisanceRegressionOutputSpec(TraitedSpec):
+    out_file = traits.File(exists=True, desc="The residuals image file.")
+
+
+class NuisanceRegressionInterface(BaseInterface):
+    """ Regress the nuisance regressors of all the `design_files` out of
+    an fMRI image in one least squares fit.
+
+    See `nuisance_regression`.
+    """
+    input_spec  = NuisanceRegressionInputSpec
+    output_spec = NuisanceRegressionOutputSpec
+
+    def _image_settings(self):
+        return get_trait_value(self.inputs, 'image_settings', default={}) or {}
+
+    def _out_file(self):
+        out_file = get_trait_value(self.inputs, 'out_file', default='')
+        if not out_file:
+            out_file = 'residuals.nii.gz'
+        return intermediate_file(op.abspath(op.basename(out_file)),
+                                 self._image_settings().get('intermediate_format'))
+
+    def _run_interface(self, runtime):
+        nuisance_regression(self.inputs.in_file,
+                            self.inputs.design_files,
+                            self.inputs.mask_file,
+                            self._out_file(),
+                            demean=self.inputs.demean,
+                            image_settings=self._image_settings())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._out_file()
+        return outputs
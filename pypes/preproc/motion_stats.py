@@ -5,6 +5,9 @@ This file is refactored from C-PAC:
 https://github.com/FCP-INDI/C-PAC
 """
 
+from   collections import OrderedDict
+
+import numpy as np
 import nipype.pipeline.engine    as pe
 from   nipype.interfaces.utility import Function, Select, IdentityInterface
 
@@ -16,6 +19,8 @@ from   ..preproc import (auto_spm_slicetime,
                          spm_tpm_priors_path,
                          )
 
+from   .censor  import censor_frames
+from   ..qc     import save_motion_qc
 from   ..config import setup_node, get_config_setting, check_atlas_file
 from   .._utils import format_pair_list, flatten_list
 from   ..utils  import (remove_ext,
@@ -26,13 +31,315 @@ from   ..utils  import (remove_ext,
                         extension_duplicates)
 
 
-def calc_friston_twenty_four(in_file):
+# the output file of each motion metric of `motion_metrics`
+METRIC_FILES = OrderedDict([('fd_power',     'FD.1D'),
+                            ('fd_jenkinson', 'FD_J.1D'),
+                            ('rms_abs',      'rms_abs.1D'),
+                            ('rms_rel',      'rms_rel.1D'),
+                            ('friston24',    'fristons_twenty_four.1D'),
+                           ])
+
+
+# the column order and the rotation units of the motion parameters files
+# of each realignment tool, the translations are in mm:
+# - nipy: the par_file of nipy SpaceTimeRealigner, the rotation vector;
+# - spm: the rp_*.txt file of SPM Realign;
+# - fsl: the .par file of MCFLIRT;
+# - afni: the 3dvolreg -1Dfile, roll pitch yaw dS dL dP.
+MOTION_PARAMS_FORMATS = OrderedDict([('nipy', (('tx', 'ty', 'tz', 'rx', 'ry', 'rz'), 'radians')),
+                                     ('spm',  (('tx', 'ty', 'tz', 'rx', 'ry', 'rz'), 'radians')),
+                                     ('fsl',  (('rx', 'ry', 'rz', 'tx', 'ty', 'tz'), 'radians')),
+                                     ('afni', (('rz', 'rx', 'ry', 'tz', 'tx', 'ty'), 'degrees')),
+                                    ])
+
+
+def motion_params_format(params_format):
+    """ Return the column names and the rotation units of the motion
+    parameters `params_format`, a key of `MOTION_PARAMS_FORMATS` or a
+    2-tuple with them."""
+    if isinstance(params_format, str):
+        if params_format not in MOTION_PARAMS_FORMATS:
+            raise ValueError('Expected one of {} for the motion parameters format, '
+                             'got {}.'.format(list(MOTION_PARAMS_FORMATS.keys()), params_format))
+        return MOTION_PARAMS_FORMATS[params_format]
+
+    columns, units = params_format
+    if sorted(columns) != sorted(MOTION_PARAMS_FORMATS['nipy'][0]) or units not in ('radians', 'degrees'):
+        raise ValueError('Expected the 6 motion parameters columns and the rotation units, '
+                         'got {}.'.format(params_format))
+    return tuple(columns), units
+
+
+def convert_motion_params(params, from_format, to_format='nipy'):
+    """ Return the motion parameters `params`, written by the tool of
+    `from_format`, in the column order and rotation units of `to_format`.
+    See `MOTION_PARAMS_FORMATS`.
+
+    The rotations are only reordered, not converted between the Euler
+    angle conventions of the tools, which agree for small angles.
+
+    Parameters
+    ----------
+    params: np.ndarray
+        Array of shape (n, 6).
+
+    from_format: str or 2-tuple
+
+    to_format: str or 2-tuple
+
+    Returns
+    -------
+    params: np.ndarray
+        Array of shape (n, 6).
+    """
+    from_columns, from_units = motion_params_format(from_format)
+    to_columns,   to_units   = motion_params_format(to_format)
+
+    converted = np.array(params, dtype=float)[:, [from_columns.index(col) for col in to_columns]]
+    if from_units != to_units:
+        rotations = [idx for idx, col in enumerate(to_columns) if col.startswith('r')]
+        convert   = np.deg2rad if to_units == 'radians' else np.rad2deg
+        converted[:, rotations] = convert(converted[:, rotations])
+    return converted
+
+
+def _load_rows(in_files, n_cols):
+    """ Return the rows of all the text files in `in_files` stacked in one
+    array with `n_cols` columns and the index of the first row of each file."""
+    arrays = [np.atleast_2d(np.loadtxt(in_file))[:, :n_cols] for in_file in in_files]
+    starts = np.cumsum([0] + [len(array) for array in arrays[:-1]])
+    return np.concatenate(arrays), starts
+
+
+def _previous_index(n_rows, starts):
+    """ Return the index of the previous row of each row, the row itself
+    for the first row of each file."""
+    prev = np.arange(n_rows) - 1
+    prev[starts] = starts
+    return prev
+
+
+def _first_index(n_rows, starts):
+    """ Return the index of the first row of the file of each row."""
+    lengths = np.diff(np.append(starts, n_rows))
+    return np.repeat(starts, lengths)
+
+
+def rigid_matrices(params):
+    """ Return the 4x4 rigid body matrices of the motion parameters.
+
+    Parameters
+    ----------
+    params: np.ndarray
+        Array of shape (n, 6) with the translations (mm) and the rotations
+        (radians) about x, y and z in each row, the 'nipy' format of
+        `MOTION_PARAMS_FORMATS`. See `convert_motion_params`.
+
+    Returns
+    -------
+    matrices: np.ndarray
+        Array of shape (n, 4, 4), rotation Rz.Ry.Rx and then the translation.
+    """
+    rotations = params[:, 3:6]
+    cx, cy, cz = np.cos(rotations).T
+    sx, sy, sz = np.sin(rotations).T
+
+    matrices = np.zeros((len(params), 4, 4))
+    matrices[:, 0, 0] = cy * cz
+    matrices[:, 0, 1] = sx * sy * cz - cx * sz
+    matrices[:, 0, 2] = cx * sy * cz + sx * sz
+    matrices[:, 1, 0] = cy * sz
+    matrices[:, 1, 1] = sx * sy * sz + cx * cz
+    matrices[:, 1, 2] = cx * sy * sz - sx * cz
+    matrices[:, 2, 0] = -sy
+    matrices[:, 2, 1] = sx * cy
+    matrices[:, 2, 2] = cx * cy
+    matrices[:, :3, 3] = params[:, :3]
+    matrices[:, 3, 3] = 1
+    return matrices
+
+
+def affine_rows_matrices(rows):
+    """ Return the 4x4 matrices of the affine matrices with 12 values
+    per row, row-by-row, as the 3dvolreg 'oned_matrix_save' files."""
+    matrices = np.zeros((len(rows), 4, 4))
+    matrices[:, :3, :] = rows[:, :12].reshape(-1, 3, 4)
+    matrices[:, 3, 3] = 1
+    return matrices
+
+
+def rms_deviation(matrices, ref_index, radius=80.):
+    """ Return the RMS deviation of the transforms `matrices` from the
+    transforms `matrices[ref_index]`, over a sphere of `radius` mm
+    (Jenkinson, 2002).
+
+    Parameters
+    ----------
+    matrices: np.ndarray
+        Array of shape (n, 4, 4).
+
+    ref_index: np.ndarray of int
+        The index of the reference transform of each matrix.
+
+    radius: float
+
+    Returns
+    -------
+    rms: np.ndarray
+        Array of shape (n, ).
+    """
+    deviation = matrices @ np.linalg.inv(matrices)[ref_index] - np.eye(4)
+    A = deviation[:, :3, :3]
+    b = deviation[:, :3, 3]
+    rms = np.sqrt(radius**2 / 5 * np.sum(A**2, axis=(1, 2)) + np.sum(b**2, axis=1))
+    rms[ref_index == np.arange(len(matrices))] = 0
+    return rms
+
+
+def power_fd(params, prev_index, radius=50.):
+    """ Return the framewise displacement of the motion parameters
+    (Power, 2012), with the rotations displaced on a sphere of `radius` mm.
+    See `rigid_matrices` for the `params`."""
+    diff = np.abs(params - params[prev_index])
+    return diff[:, :3].sum(axis=1) + radius * diff[:, 3:6].sum(axis=1)
+
+
+def friston_24(params, prev_index):
+    """ Return the 24 Friston parameters of the motion parameters: the
+    parameters, of the previous volume and their squares (Friston, 1996)."""
+    prev = params[prev_index]
+    prev[prev_index == np.arange(len(params))] = 0
+    return np.hstack((params, params**2, prev, prev**2))
+
+
+def motion_metrics(params_files, matrix_files=None, params_format='nipy',
+                   power_radius=50., jenkinson_radius=80.):
+    """ Return the motion metrics of each one of the motion parameters files,
+    computed in one pass for all of them.
+
+    Parameters
+    ----------
+    params_files: list of str
+        Paths to the motion parameters text files, one row per volume with
+        the 3 translations (mm) and the 3 rotations.
+
+    matrix_files: list of str
+        Paths to the 3dvolreg affine matrices files of the same volumes,
+        with the 12 values of each matrix in one row, row-by-row.
+        If given, they are used for the Jenkinson FD.
+
+    params_format: str or 2-tuple
+        The column order and the rotation units of `params_files`, the name
+        of the realignment tool that wrote them. See `MOTION_PARAMS_FORMATS`.
+
+    power_radius: float
+        Radius of the sphere for the Power FD, in mm.
+
+    jenkinson_radius: float
+        Radius of the sphere for the Jenkinson FD and the RMS displacements, in mm.
+
+    Returns
+    -------
+    metrics: list of OrderedDict[str] -> np.ndarray
+        For each file, the arrays of the `METRIC_FILES` metrics:
+        - fd_power: framewise displacement (Power, 2012);
+        - fd_jenkinson: framewise displacement (Jenkinson, 2002);
+        - rms_abs: RMS displacement from the first volume;
+        - rms_rel: RMS displacement from the previous volume;
+        - friston24: the 24 Friston parameters (Friston, 1996), of the
+          parameters as they are in the files.
+    """
+    raw_params, starts = _load_rows(params_files, n_cols=6)
+    params = convert_motion_params(raw_params, params_format, 'nipy')
+    prev   = _previous_index(len(params), starts)
+    first  = _first_index(len(params), starts)
+
+    rigid   = rigid_matrices(params)
+    rms_rel = rms_deviation(rigid, prev,  radius=jenkinson_radius)
+    rms_abs = rms_deviation(rigid, first, radius=jenkinson_radius)
+
+    fd_jenkinson = rms_rel
+    if matrix_files:
+        rows, matrix_starts = _load_rows(matrix_files, n_cols=12)
+        if len(rows) != len(params) or np.any(matrix_starts != starts):
+            raise ValueError('Expected the same number of volumes in `matrix_files` '
+                             'as in `params_files`.')
+        fd_jenkinson = rms_deviation(affine_rows_matrices(rows), prev, radius=jenkinson_radius)
+
+    metrics = OrderedDict([('fd_power',     power_fd(params, prev, radius=power_radius)),
+                           ('fd_jenkinson', fd_jenkinson),
+                           ('rms_abs',      rms_abs),
+                           ('rms_rel',      rms_rel),
+                           ('friston24',    friston_24(raw_params, prev)),
+                          ])
+
+    splits = {name: np.split(values, starts[1:]) for name, values in metrics.items()}
+    return [OrderedDict((name, splits[name][idx]) for name in metrics)
+            for idx in range(len(params_files))]
+
+
+def calc_motion_metrics(in_files, matrix_files=None, params_format='nipy'):
+    """ Save the `motion_metrics` of the motion parameters files in text files.
+    This is a nipype Function node function.
+
+    Parameters
+    ----------
+    in_files: str or list of str
+        Paths to the motion parameters files.
+
+    matrix_files: str or list of str
+        Paths to the affine matrices files. See `motion_metrics`.
+
+    params_format: str
+        The realignment tool that wrote `in_files`. See `MOTION_PARAMS_FORMATS`.
+
+    Returns
+    -------
+    fd_power, fd_jenkinson, rms_abs, rms_rel, friston24: str or list of str
+        Paths to the metric files, named as in `METRIC_FILES`.
+        With more than one input file, the files of each one are in the
+        'motion_{index}' folder and each output is a list.
+    """
+    import os
+    import os.path as op
+
+    import numpy as np
+    from nipype.utils.filemanip import filename_to_list
+
+    from pypes.preproc.motion_stats import motion_metrics, METRIC_FILES
+
+    in_files = filename_to_list(in_files)
+    if matrix_files:
+        matrix_files = filename_to_list(matrix_files)
+
+    out_files = {name: [] for name in METRIC_FILES}
+    all_metrics = motion_metrics(in_files, matrix_files=matrix_files,
+                                 params_format=params_format)
+    for idx, metrics in enumerate(all_metrics):
+        out_dir = os.getcwd() if len(in_files) == 1 else op.abspath('motion_{}'.format(idx))
+        os.makedirs(out_dir, exist_ok=True)
+
+        for name, values in metrics.items():
+            out_file = op.join(out_dir, METRIC_FILES[name])
+            np.savetxt(out_file, values, fmt='%.8f', delimiter=' ')
+            out_files[name].append(out_file)
+
+    if len(in_files) == 1:
+        out_files = {name: files[0] for name, files in out_files.items()}
+
+    return tuple(out_files[name] for name in METRIC_FILES)
+
+
+def calc_friston_twenty_four(in_file, params_format='nipy'):
     """ Method to calculate friston twenty four parameters.
     
     Parameters
     ----------
     in_file: string
         input movement parameters file from motion correction
+
+    params_format: str
+        The realignment tool that wrote `in_file`. See `MOTION_PARAMS_FORMATS`.
     
     Returns
     -------
@@ -42,25 +349,16 @@ def calc_friston_twenty_four(in_file):
     import os.path as op
     import numpy as np
 
-    data = np.genfromtxt(in_file)
-
-    data_squared = data ** 2
-    new_data = np.concatenate((data, data_squared), axis=1)
-
-    data_roll = np.roll(data, 1, axis=0)
-    data_roll[0] = 0
-    new_data = np.concatenate((new_data, data_roll), axis=1)
-
-    data_roll_squared = data_roll ** 2
-    new_data = np.concatenate((new_data, data_roll_squared), axis=1)
+    from pypes.preproc.motion_stats import motion_metrics
 
     new_file = 'fristons_twenty_four.1D'
-    np.savetxt(new_file, new_data, fmt='%0.8f', delimiter=' ')
+    friston24 = motion_metrics([in_file], params_format=params_format)[0]['friston24']
+    np.savetxt(new_file, friston24, fmt='%0.8f', delimiter=' ')
 
     return op.abspath(new_file)
 
 
-def fristons_twenty_four_wf(wf_name='fristons_twenty_four'):
+def fristons_twenty_four_wf(wf_name='fristons_twenty_four', params_format='nipy'):
     """ The main purpose of this workflow is to calculate 24 parameters including
     the 6 motion parameters of the current volume and the preceeding volume, 
     plus each of these values squared. 
@@ -70,6 +368,9 @@ def fristons_twenty_four_wf(wf_name='fristons_twenty_four'):
     wf_name: str
         Workflow name
 
+    params_format: str
+        The realignment tool that wrote the movement file. See `MOTION_PARAMS_FORMATS`.
+
     Returns 
     -------
     wf: workflow object
@@ -99,24 +400,26 @@ def fristons_twenty_four_wf(wf_name='fristons_twenty_four'):
     f24_input = setup_node(IdentityInterface(fields=in_fields, mandatory_inputs=True),
                            name='f24_input')
 
-    calc_friston = setup_node(Function(input_names=['in_file'],
-                                       output_names=['out_file'],
-                                       function=calc_friston_twenty_four),
+    calc_friston = setup_node(Function(input_names=['in_files',
+                                                    'params_format'],
+                                       output_names=list(METRIC_FILES.keys()),
+                                       function=calc_motion_metrics),
                              name='calc_friston')
+    calc_friston.inputs.params_format = params_format
 
     f24_output = setup_node(IdentityInterface(fields=out_fields),
                          name='f24_output')
 
     # Connect the nodes
     wf.connect([
-                (f24_input,    calc_friston,  [("in_file",  "in_file")]),
-                (calc_friston, f24_output,    [("out_file", "out_file")]),
+                (f24_input,    calc_friston,  [("in_file",   "in_files")]),
+                (calc_friston, f24_output,    [("friston24", "out_file")]),
 
               ])
     return wf
 
 
-def motion_power_stats_wf(wf_name='gen_motion_stats'):
+def motion_power_stats_wf(wf_name='gen_motion_stats', params_format='nipy'):
     """ The main purpose of this workflow is to get various statistical measures from the
     movement/motion parameters obtained in functional preprocessing.
 
@@ -128,7 +431,7 @@ def motion_power_stats_wf(wf_name='gen_motion_stats'):
 
       Differentiating head realignment parameters across frames yields a six dimensional timeseries that represents
       instantaneous head motion.
-      Rotational displacements are converted from degrees to millimeters by calculating displacement on the surface of
+      Rotational displacements are converted from radians to millimeters by calculating displacement on the surface of
       a sphere of radius 50 mm.[R5]
 
     - Calculate Frame wise Displacement FD as per jenkinson et al., 2002
@@ -185,6 +488,10 @@ def motion_power_stats_wf(wf_name='gen_motion_stats'):
     ----------
     wf_name: workflow object
         Workflow name
+
+    params_format: str
+        The realignment tool that wrote the movement parameters file, for
+        their column order and rotation units. See `MOTION_PARAMS_FORMATS`.
     
     Returns 
     -------
@@ -199,16 +506,23 @@ def motion_power_stats_wf(wf_name='gen_motion_stats'):
     inputspec.mask : string (nifti file)
         Path to field contianing brain-only mask for the functional data
 
+    inputspec.subject_id, inputspec.scan_id : string
+        Optional, written in the motion and power parameters files.
+
     inputspec.max_displacement : string (Mat file)
-        maximum displacement (in mm) vector for brain voxels in each volume.
-        This file is obtained in functional preprocessing step
+        Optional maximum displacement (in mm) vector for brain voxels in each volume,
+        as 3dvolreg -maxdisp1D.
 
     inputspec.movement_parameters : string (Mat file)
         1D file containing six movement/motion parameters(3 Translation, 3 Rotations)
-        in different columns (roll pitch yaw dS  dL  dP), obtained in functional preprocessing step
+        in different columns, in the `params_format` of the realignment tool.
+
+    inputspec.oned_matrix_save : string (1D file)
+        Optional 3dvolreg affine matrices, one per row, for the Jenkinson FD.
+        Otherwise it is computed from the movement parameters.
         
     scrubbing_input.threshold : a float
-        scrubbing threshold
+        scrubbing FD threshold, in mm. Default: 0.5.
         
     scrubbing_input.remove_frames_before : an integer
         count of preceding frames to the offending time
@@ -217,12 +531,28 @@ def motion_power_stats_wf(wf_name='gen_motion_stats'):
     scrubbing_input.remove_frames_after : an integer
         count of subsequent frames to the offending time
         frames to be removed (i.e., those exceeding FD threshold)
+
+    scrubbing_input.dvars_threshold : a float
+        Optional DVARS threshold, the frames that exceed it are also removed.
             
     Nipype outputs
     --------------
     outputspec.FD_1D : 1D file
         mean Framewise Displacement (FD)
 
+    outputspec.FDJ_1D : 1D file
+        Framewise Displacement as per jenkinson et al., 2002
+
+    outputspec.rms_abs_1D, outputspec.rms_rel_1D : 1D file
+        RMS displacement from the first and from the previous volume
+
+    outputspec.friston24_1D : 1D file
+        The Friston 24 motion parameters
+
+    outputspec.censor_mask : npy file
+        Boolean vector, True for the censored frames.
+        See `pypes.preproc.censor`.
+
     outputspec.frames_ex_1D : 1D file
         Number of frames that would be censored ("scrubbed")
         also removing the offending time frames (i.e., those exceeding the threshold),
@@ -237,6 +567,10 @@ def motion_power_stats_wf(wf_name='gen_motion_stats'):
     outputspec.motion_params : txt file
        Text file containing various movement parameters
 
+    outputspec.qc_file : json file
+        The motion QC measures of the subject, to be added to the cohort
+        QC store. See `pypes.qc.save_motion_qc`.
+
     References
     ----------
     .. [1] Power, J. D., Barnes, K. A., Snyder, A. Z., Schlaggar, B. L., & Petersen, S. E. (2012). Spurious
@@ -252,145 +586,130 @@ def motion_power_stats_wf(wf_name='gen_motion_stats'):
     """
     wf = pe.Workflow(name=wf_name)
 
-    # specify input and output fields
-    in_fields  = ["in_files",
-                  "anat",
-                  "atlas_anat",
-                  "coreg_target",
-                  "tissues",
-                  "lowpass_freq",
-                  "highpass_freq",]
-
-    out_fields = ["motion_corrected",
-                  "motion_params",
-                  "tissues",
-                  "anat",
-                  "time_filtered",
-                  "smooth",
-                  "time_filtered_mni",
-                  "smooth_mni",
-                  "tsnr_file",
-                  "epi_brain_mask",
-                  "tissues_brain_mask",
-                  "motion_regressors",
-                  "compcor_regressors",
-                  "gsr_regressors",
-                  "nuis_corrected",
-                  "epi_mni",
-                  "epi_mni_warpfield",]
-
+    # the affine matrices for the Jenkinson FD are optional
     inputNode = setup_node(IdentityInterface(fields=['subject_id',
                                                        'scan_id',
                                                        'movement_parameters',
                                                        'max_displacement',
                                                        'motion_correct',
                                                        'mask',
-                                                       'oned_matrix_save']),
+                                                       'oned_matrix_save'],
+                                             mandatory_inputs=False),
                         name='inputspec')
+    inputNode.inputs.subject_id = ''
+    inputNode.inputs.scan_id    = ''
 
     scrubbing_input = setup_node(IdentityInterface(fields=['threshold',
                                                               'remove_frames_before',
-                                                              'remove_frames_after']),
+                                                              'remove_frames_after',
+                                                              'dvars_threshold'],
+                                                      mandatory_inputs=False),
                              name='scrubbing_input')
+    scrubbing_input.inputs.threshold = get_config_setting('scrubbing_input.threshold', default=0.5)
 
     outputNode = setup_node(IdentityInterface(fields=['FD_1D',
                                                         'FDJ_1D',
+                                                        'rms_abs_1D',
+                                                        'rms_rel_1D',
+                                                        'friston24_1D',
+                                                        'censor_mask',
                                                         'frames_ex_1D',
                                                         'frames_in_1D',
                                                         'power_params',
-                                                        'motion_params']),
+                                                        'motion_params',
+                                                        'qc_file']),
                         name='outputspec')
 
 
     # calculate mean DVARS
-    cal_DVARS = setup_node(Function(input_names=['in_file',
+    cal_DVARS = setup_node(Function(input_names=['rest',
                                                    'mask'],
                                       output_names=['out_file'],
                                       function=calculate_DVARS),
                              name='cal_DVARS')
-    pm.connect(inputNode, 'motion_correct', cal_DVARS, 'rest')
-    pm.connect(inputNode, 'mask', cal_DVARS, 'mask')
+    wf.connect(inputNode, 'motion_correct', cal_DVARS, 'rest')
+    wf.connect(inputNode, 'mask', cal_DVARS, 'mask')
 
 
-    # Calculating mean Framewise Displacement as per power et al., 2012
-    calculate_FD = setup_node(Function(input_names=['in_file'],
-                                         output_names=['out_file'],
-                                         function=calculate_FD_P),
+    # Calculating the Framewise Displacement as per power et al., 2012 and jenkinson et al., 2002,
+    # the RMS displacements and the Friston 24 parameters
+    calculate_FD = setup_node(Function(input_names=['in_files',
+                                                      'matrix_files',
+                                                      'params_format'],
+                                         output_names=list(METRIC_FILES.keys()),
+                                         function=calc_motion_metrics),
                            name='calculate_FD')
-    
-    pm.connect(inputNode, 'movement_parameters', 
-               calculate_FD, 'in_file' )
-    
-    pm.connect(calculate_FD, 'out_file', 
+    calculate_FD.inputs.params_format = params_format
+
+    wf.connect(inputNode, 'movement_parameters',
+               calculate_FD, 'in_files')
+    wf.connect(inputNode, 'oned_matrix_save',
+               calculate_FD, 'matrix_files')
+
+    wf.connect(calculate_FD, 'fd_power',
                outputNode, 'FD_1D')
-    
-    # Calculating mean Framewise Displacement as per jenkinson et al., 2002
-    calculate_FDJ = setup_node(Function(input_names=['in_file'],
-                                         output_names=['out_file'],
-                                           function=calculate_FD_J),
-                             name='calculate_FDJ')
-    
-    pm.connect(inputNode, 'oned_matrix_save', 
-               calculate_FDJ, 'in_file' )
-    
-    pm.connect(calculate_FDJ, 'out_file', 
+    wf.connect(calculate_FD, 'fd_jenkinson',
                outputNode, 'FDJ_1D')
-
-    ##calculating frames to exclude and include after scrubbing
-    exclude_frames = setup_node(Function(input_names=['in_file', 
-                                                        'threshold',
-                                                        'frames_before',
-                                                        'frames_after'],
-                                           output_names=['out_file'],
-                                           function=set_frames_ex),
-                             name='exclude_frames')
-
-    pm.connect(calculate_FD, 'out_file', 
-               exclude_frames, 'in_file')
-    pm.connect(scrubbing_input, 'threshold', 
-               exclude_frames, 'threshold')
-    pm.connect(scrubbing_input, 'remove_frames_before',
-               exclude_frames, 'frames_before')
-    pm.connect(scrubbing_input, 'remove_frames_after',
-               exclude_frames, 'frames_after')
-    
-    pm.connect(exclude_frames, 'out_file', 
+    wf.connect(calculate_FD, 'rms_abs',
+               outputNode, 'rms_abs_1D')
+    wf.connect(calculate_FD, 'rms_rel',
+               outputNode, 'rms_rel_1D')
+    wf.connect(calculate_FD, 'friston24',
+               outputNode, 'friston24_1D')
+
+    ##calculating the censor mask and the frames to exclude and include after scrubbing
+    censor = setup_node(Function(input_names=['fd_file',
+                                                'threshold',
+                                                'frames_before',
+                                                'frames_after',
+                                                'dvars_file',
+                                                'dvars_threshold'],
+                                   output_names=['censor_file',
+                                                 'frames_ex_file',
+                                                 'frames_in_file'],
+                                   function=censor_frames),
+                        name='censor_frames')
+
+    wf.connect(calculate_FD, 'fd_power',
+               censor, 'fd_file')
+    wf.connect(cal_DVARS, 'out_file',
+               censor, 'dvars_file')
+    wf.connect(scrubbing_input, 'threshold', 
+               censor, 'threshold')
+    wf.connect(scrubbing_input, 'remove_frames_before',
+               censor, 'frames_before')
+    wf.connect(scrubbing_input, 'remove_frames_after',
+               censor, 'frames_after')
+    wf.connect(scrubbing_input, 'dvars_threshold',
+               censor, 'dvars_threshold')
+
+    wf.connect(censor, 'censor_file',
+               outputNode, 'censor_mask')
+    wf.connect(censor, 'frames_ex_file',
                outputNode, 'frames_ex_1D')
-    
-    include_frames = setup_node(Function(input_names=['in_file',
-                                                        'threshold', 
-                                                        'exclude_list'],
-                                           output_names=['out_file'],
-                                           function=set_frames_in),
-                             name='include_frames')
-    pm.connect(calculate_FD, 'out_file', 
-               include_frames, 'in_file')
-    pm.connect(scrubbing_input, 'threshold', 
-               include_frames, 'threshold')
-    pm.connect(exclude_frames, 'out_file', 
-               include_frames, 'exclude_list')
-
-    pm.connect(include_frames, 'out_file', 
+    wf.connect(censor, 'frames_in_file',
                outputNode, 'frames_in_1D')
 
     
     calc_motion_parameters = setup_node(Function(input_names=["subject_id", 
                                                                 "scan_id", 
                                                                 "movement_parameters",
-                                                                "max_displacement"],
+                                                                "max_displacement",
+                                                                "params_format"],
                                                    output_names=['out_file'],
                                                    function=gen_motion_parameters),
                                      name='calc_motion_parameters')
-    pm.connect(inputNode, 'subject_id',
+    calc_motion_parameters.inputs.params_format = params_format
+    wf.connect(inputNode, 'subject_id',
                calc_motion_parameters, 'subject_id')
-    pm.connect(inputNode, 'scan_id',
+    wf.connect(inputNode, 'scan_id',
                calc_motion_parameters, 'scan_id')
-    pm.connect(inputNode, 'movement_parameters',
+    wf.connect(inputNode, 'movement_parameters',
                calc_motion_parameters, 'movement_parameters')
-    pm.connect(inputNode, 'max_displacement',
+    wf.connect(inputNode, 'max_displacement',
                calc_motion_parameters, 'max_displacement')
     
-    pm.connect(calc_motion_parameters, 'out_file', 
+    wf.connect(calc_motion_parameters, 'out_file', 
                outputNode, 'motion_params')
 
 
@@ -403,24 +722,54 @@ def motion_power_stats_wf(wf_name='gen_motion_stats'):
                                                    output_names=['out_file'],
                                                    function=gen_power_parameters),
                                      name='calc_power_parameters')
-    pm.connect(inputNode, 'subject_id',
+    wf.connect(inputNode, 'subject_id',
                calc_power_parameters, 'subject_id')
-    pm.connect(inputNode, 'scan_id',
+    wf.connect(inputNode, 'scan_id',
                calc_power_parameters, 'scan_id')
-    pm.connect(cal_DVARS, 'out_file',
+    wf.connect(cal_DVARS, 'out_file',
                calc_power_parameters, 'DVARS')
-    pm.connect(calculate_FD, 'out_file',
+    wf.connect(calculate_FD, 'fd_power',
                calc_power_parameters, 'FD_1D')
-    pm.connect(calculate_FDJ, 'out_file',
+    wf.connect(calculate_FD, 'fd_jenkinson',
                calc_power_parameters, 'FDJ_1D')
-    pm.connect(scrubbing_input, 'threshold',
+    wf.connect(scrubbing_input, 'threshold',
                calc_power_parameters, 'threshold')
 
 
-    pm.connect(calc_power_parameters, 'out_file', 
+    wf.connect(calc_power_parameters, 'out_file', 
                outputNode, 'power_params')
 
-    return pm
+
+    # the subject measures for the cohort QC store
+    save_qc = setup_node(Function(input_names=['subject_id',
+                                                 'scan_id',
+                                                 'fd_file',
+                                                 'fdj_file',
+                                                 'dvars_file',
+                                                 'censor_file',
+                                                 'threshold'],
+                                    output_names=['qc_file'],
+                                    function=save_motion_qc),
+                         name='save_motion_qc')
+    wf.connect(inputNode, 'subject_id',
+               save_qc, 'subject_id')
+    wf.connect(inputNode, 'scan_id',
+               save_qc, 'scan_id')
+    wf.connect(calculate_FD, 'fd_power',
+               save_qc, 'fd_file')
+    wf.connect(calculate_FD, 'fd_jenkinson',
+               save_qc, 'fdj_file')
+    wf.connect(cal_DVARS, 'out_file',
+               save_qc, 'dvars_file')
+    wf.connect(censor, 'censor_file',
+               save_qc, 'censor_file')
+    wf.connect(scrubbing_input, 'threshold',
+               save_qc, 'threshold')
+
+    wf.connect(save_qc, 'qc_file',
+               outputNode, 'qc_file')
+
+    return wf
 
 
 def set_frames_ex(in_file, threshold, 
@@ -451,56 +800,29 @@ def set_frames_ex(in_file, threshold,
     """
 
     import os
-    import numpy as np
-    from numpy import loadtxt
 
-    out_file = os.path.join(os.getcwd(), 'frames_ex.1D')
-    data = loadtxt(in_file)
-    #masking zeroth timepoint value as 0, since the mean displacment value for
-    #zeroth timepoint cannot be calculated, as there is no timepoint before it
-    data[0] = 0
+    import numpy as np
 
-    extra_indices = []
+    from pypes.preproc.censor import censor_mask, _write_frames
 
-    indices = [i[0] for i in (np.argwhere(data >= threshold)).tolist()]
-    #print "initial indices-->", indices
-    
-    for i in indices:
-        #remove preceding frames
-        if i > 0 :
-            count = 1
-            while count <= frames_before:
-                extra_indices.append(i-count)
-                count+=1
-                
-        #remove following frames
-        count = 1
-        while count <= frames_after:
-            extra_indices.append(i+count)
-            count+=1
-                    
-    indices = list(set(indices) | set(extra_indices))
-    indices.sort()
-
-    f = open(out_file, 'a')
-
-    #print "indices preceding and following -->", \
-    #      set(extra_indices)
-    #print "final indices -->", indices
-    for idx in indices:
-        f.write('%s,' % int(idx))
-
-    f.close()
+    out_file = os.path.join(os.getcwd(), 'frames_ex.1D')
+    mask = censor_mask(np.loadtxt(in_file), threshold,
+                       frames_before=frames_before,
+                       frames_after=frames_after)
+    _write_frames(out_file, np.flatnonzero(mask))
 
     return out_file
 
 
-def calculate_FD_P(in_file):
+def calculate_FD_P(in_file, params_format='nipy'):
     """ Method to calculate Framewise Displacement (FD) calculations (Power et al., 2012).
     Parameters
     ----------
     in_file: str
         Movement parameters vector file path.
+
+    params_format: str
+        The realignment tool that wrote `in_file`. See `MOTION_PARAMS_FORMATS`.
     
     Returns
     -------
@@ -511,22 +833,11 @@ def calculate_FD_P(in_file):
 
     import numpy as np
 
-    out_file = 'FD.1D'
+    from pypes.preproc.motion_stats import motion_metrics
 
-    lines = open(in_file, 'r').readlines()
-    rows = [[float(x) for x in line.split()] for line in lines]
-    cols = np.array([list(col) for col in zip(*rows)])
-    
-    translations = np.transpose(np.abs(np.diff(cols[0:3, :])))
-    rotations = np.transpose(np.abs(np.diff(cols[3:6, :])))
+    out_file = 'FD.1D'
+    np.savetxt(out_file, motion_metrics([in_file], params_format=params_format)[0]['fd_power'])
 
-    FD_power = np.sum(translations, axis = 1) + (50*3.141/180)*np.sum(rotations, axis =1)
-    
-    #FD is zero for the first time point
-    FD_power = np.insert(FD_power, 0, 0)
-    
-    np.savetxt(out_file, FD_power)
-    
     return op.abspath(out_file)
     
 
@@ -548,45 +859,20 @@ def calculate_FD_J(in_file):
     `in_file` should have one 3dvolreg affine matrix in one row - NOT the motion parameters.
     """
     import os.path as op
-    import sys
-    import math
 
     import numpy as np
 
-    out_file = 'FD_J.1D'
-
-    #print in_file
-    pm_ = np.genfromtxt(in_file)
+    from pypes.preproc.motion_stats import (affine_rows_matrices,
+                                            rms_deviation,
+                                            _load_rows,
+                                            _previous_index)
 
-    pm = np.zeros((pm_.shape[0],pm_.shape[1]+4))
-    pm[:,:12]=pm_
-    pm[:,12:]=[0.0, 0.0, 0.0, 1.0]
-
-    flag = 0
+    out_file = 'FD_J.1D'
 
     #The default radius (as in FSL) of a sphere represents the brain
-    rmax = 80.0
-
-    with open(out_file, 'w') as f:
-        #rigid body transformation matrix
-        T_rb_prev = np.matrix(np.eye(4))
-
-        for i in range(0, pm.shape[0]):
-            T_rb = np.matrix(pm[i].reshape(4,4)) # making use of the fact that the order of aff12 matrix is "row-by-row"
-
-            if flag == 0:
-                flag = 1
-                # first timepoint
-                print >> f, 0
-            else:
-                M = np.dot(T_rb, T_rb_prev.I) - np.eye(4)
-                A = M[0:3, 0:3]
-                b = M[0:3, 3]
-
-                FD_J = math.sqrt((rmax*rmax/5)*np.trace(np.dot(A.T, A)) + np.dot(b.T, b))
-                print >> f, '%.8f'%FD_J
-
-            T_rb_prev = T_rb
+    rows, starts = _load_rows([in_file], n_cols=12)
+    FD_J = rms_deviation(affine_rows_matrices(rows), _previous_index(len(rows), starts), radius=80.)
+    np.savetxt(out_file, FD_J, fmt='%.8f')
 
     return op.abspath(out_file)
 
@@ -612,33 +898,27 @@ def set_frames_in(in_file, threshold, exclude_list):
 
     import numpy as np
 
+    from pypes.preproc.censor import _write_frames
+
     out_file = 'frames_in.1D'
     data = np.loadtxt(in_file)
 
     #masking zeroth timepoint value as 0, since the mean displacment value for
     #zeroth timepoint cannot be calculated, as there is no timepoint before it
     data[0] = 0
-    indices = [i[0] for i in (np.argwhere(data < threshold)).tolist()]
+    keep = data < threshold
 
-    indx = []
     with open(exclude_list, 'r') as f:
-        line = f.readline()
-
-    if line:
-        line = line.strip(',')
-        indx = map(int, line.split(","))
-
-    if indx:
-        indices = list(set(indices) - set(indx))
+        excluded = [int(idx) for idx in f.read().split(',') if idx.strip()]
+    keep[[idx for idx in excluded if idx < len(keep)]] = False
 
-    with open(out_file, 'a') as f:
-        for idx in indices:
-            f.write('%s,' % int(idx))
+    _write_frames(out_file, np.flatnonzero(keep))
 
     return op.abspath(out_file)
 
 
-def gen_motion_parameters(subject_id, scan_id, movement_parameters, max_displacement):
+def gen_motion_parameters(subject_id, scan_id, movement_parameters, max_displacement=None,
+                          params_format='nipy'):
     """  Method to calculate all the movement parameters.
     
     Parameters
@@ -650,11 +930,17 @@ def gen_motion_parameters(subject_id, scan_id, movement_parameters, max_displace
         scan name or id
 
     max_displacement : string
-        path of file with maximum displacement (in mm) for brain voxels in each volume    
+        path of file with maximum displacement (in mm) for brain voxels in each volume,
+        as 3dvolreg -maxdisp1D. If not given, its measures are NaN.
 
     movement_parameters : string
         path of 1D file containing six movement/motion parameters(3 Translation, 
-        3 Rotations) in different columns (roll pitch yaw dS  dL  dP)
+        3 Rotations) in different columns
+
+    params_format : string
+        The realignment tool that wrote `movement_parameters`, see `MOTION_PARAMS_FORMATS`.
+        The parameters are converted to the 3dvolreg columns (roll pitch yaw dS  dL  dP),
+        with the rotations in degrees.
     
     Returns 
     -------
@@ -666,6 +952,8 @@ def gen_motion_parameters(subject_id, scan_id, movement_parameters, max_displace
     import numpy as np
     import re
 
+    from pypes.preproc.motion_stats import convert_motion_params
+
     out_file = 'motion_parameters.txt'
 
     with open(out_file, 'w') as f:
@@ -685,7 +973,9 @@ def gen_motion_parameters(subject_id, scan_id, movement_parameters, max_displace
         f.write("%s," % (subject_id))
         f.write("%s," % (scan_id))
 
-        arr = np.genfromtxt(movement_parameters)
+        # roll pitch yaw dS dL dP
+        arr = convert_motion_params(np.atleast_2d(np.genfromtxt(movement_parameters)),
+                                    params_format, 'afni')
         arr = arr.T
 
         ##Relative RMS of translation
@@ -706,29 +996,33 @@ def gen_motion_parameters(subject_id, scan_id, movement_parameters, max_displace
         MEANrot = np.mean(np.abs(np.diff((abs(arr[0])+ abs(arr[1])+ abs(arr[2]))/3 ) ) )
         f.write("%.3f," % (MEANrot))
 
-        with open(max_displacement, 'r') as disp_f:
-            lines = disp_f.readlines()
-
         list1 = []
-        #remove any other information aother than matrix from
-        #max displacement file. afni adds infomration to the file
-        for l in lines:
-            if re.match("^\d+?\.\d+?$", l.strip()):
-                list1.append(float(l.strip()))
+        if max_displacement:
+            with open(max_displacement, 'r') as disp_f:
+                lines = disp_f.readlines()
 
-        arr2 = np.array(list1, dtype='float')
+            #remove any other information aother than matrix from
+            #max displacement file. afni adds infomration to the file
+            for l in lines:
+                if re.match("^\d+?\.\d+?$", l.strip()):
+                    list1.append(float(l.strip()))
 
-        #Mean Relative Maxdisp
-        mean = np.mean(np.diff(arr2))
-        f.write("%.3f," % (mean))
+        if list1:
+            arr2 = np.array(list1, dtype='float')
 
-        #Max Relative Maxdisp
-        relMAX = np.max(abs(np.diff(arr2)))
-        f.write("%.3f," % (relMAX))
+            #Mean Relative Maxdisp
+            mean = np.mean(np.diff(arr2))
+            f.write("%.3f," % (mean))
 
-        #Max Abs Maxdisp
-        MAX= np.max(arr2)
-        f.write("%.3f," %(MAX))
+            #Max Relative Maxdisp
+            relMAX = np.max(abs(np.diff(arr2)))
+            f.write("%.3f," % (relMAX))
+
+            #Max Abs Maxdisp
+            MAX= np.max(arr2)
+            f.write("%.3f," %(MAX))
+        else:
+            f.write("nan,nan,nan,")
 
         #Max Relative Roll,Max Relative Pitch,
         #Max Relative Yaw,Max Relative dS-I,
@@ -792,8 +1086,8 @@ def gen_power_parameters(subject_id, scan_id, FD_1D, FDJ_1D, DVARS, threshold =
     with open(out_file,'w') as f:
 
         header = "Subject,Scan,MeanFD,MeanFD_Jenkinson," \
-        "NumFD_greater_than_%.2f,rootMeanSquareFD,FDquartile(top1/4thFD)," \
-        "PercentFD_greater_than_%.2f,MeanDVARS\n".format(threshold,threshold)
+        "NumFD_greater_than_{0:.2f},rootMeanSquareFD,FDquartile(top1/4thFD)," \
+        "PercentFD_greater_than_{0:.2f},MeanDVARS\n".format(threshold)
 
         f.write(header)
 
@@ -828,7 +1122,7 @@ def gen_power_parameters(subject_id, scan_id, FD_1D, FDJ_1D, DVARS, threshold =
         f.write('%.4f,' % FDquartile)
 
         ##NUMBER OF FRAMES >threshold FD as percentage of total num frames
-        count = np.float(jenkFD_data[jenkFD_data>threshold].size)
+        count = float(jenkFD_data[jenkFD_data>threshold].size)
         percentFD = (count*100/(len(jenkFD_data)+1))
         f.write('%.4f,' %percentFD)
 
@@ -839,7 +1133,71 @@ def gen_power_parameters(subject_id, scan_id, FD_1D, FDJ_1D, DVARS, threshold =
     return op.abspath(out_file)
 
 
-def calculate_DVARS(rest, mask):
+def streaming_dvars(rest, mask, chunk_size=1):
+    """ Return the DVARS of the `rest` image within `mask` reading `chunk_size`
+    volumes at a time, so that only about two volumes are in memory.
+
+    The standardized DVARS (Nichols, 2013) is the DVARS divided by the
+    mean over the mask of the standard deviation of the temporal
+    differences of each voxel. Here this standard deviation is the usual,
+    non-robust one, so it can be accumulated while reading the volumes.
+
+    Parameters
+    ----------
+    rest: str
+        Path to the 4D functional image.
+
+    mask: str
+        Path to the 3D brain mask of `rest`.
+
+    chunk_size: int
+        Number of volumes to read at a time.
+
+    Returns
+    -------
+    dvars: np.ndarray
+        Array of shape (n_volumes - 1, ).
+
+    std_dvars: np.ndarray
+        The standardized DVARS, array of shape (n_volumes - 1, ).
+    """
+    import nibabel as nib
+
+    from pypes.imgcache import cached_file
+
+    # keep the file open so the volumes of compressed images are read sequentially,
+    # the uncompressed ones are memory-mapped
+    img       = nib.load(cached_file(rest), keep_file_open=True)
+    mask_data = np.asanyarray(nib.load(mask).dataobj).astype(bool)
+    n_vols    = img.shape[3]
+
+    dvars    = np.zeros(n_vols - 1)
+    diff_sum = np.zeros(mask_data.sum())
+    diff_ssq = np.zeros(mask_data.sum())
+
+    prev = None
+    for start in range(0, n_vols, chunk_size):
+        chunk = np.asanyarray(img.dataobj[..., start:start + chunk_size])
+        for idx in range(chunk.shape[3]):
+            vol = chunk[..., idx][mask_data].astype(np.float32)
+            if prev is not None:
+                diff = vol - prev
+                dvars[start + idx - 1] = np.mean(np.square(diff), dtype=np.float64)
+                diff_sum += diff
+                diff_ssq += np.square(diff, dtype=np.float64)
+            prev = vol
+        del chunk
+
+    dvars = np.sqrt(dvars)
+
+    n_diffs = n_vols - 1
+    diff_sd = np.sqrt(np.maximum(diff_ssq / n_diffs - (diff_sum / n_diffs)**2, 0))
+    std_dvars = dvars / diff_sd.mean()
+
+    return dvars, std_dvars
+
+
+def calculate_DVARS(rest, mask, standardized=False, chunk_size=1):
     """
     Method to calculate DVARS as per power's method
     
@@ -850,7 +1208,14 @@ def calculate_DVARS(rest, mask):
 
     mask : string (nifti file)
         path to brain only mask for functional data
-        
+
+    standardized : bool
+        If True, save the standardized DVARS instead.
+        See `streaming_dvars`.
+
+    chunk_size : int
+        Number of volumes read at a time.
+
     Returns
     -------
     out_file : string (numpy mat file)
@@ -860,25 +1225,16 @@ def calculate_DVARS(rest, mask):
     import os.path as op
 
     import numpy as np
-    import nibabel as nib
 
-    out_file = 'DVARS.npy'
-    
-    rest_data = nib.load(rest).get_data().astype(np.float32)
-    mask_data = nib.load(mask).get_data().astype('bool')
-    
-    #square of relative intensity value for each voxel across
-    #every timepoint 
-    data = np.square(np.diff(rest_data, axis = 3))
-
-    #applying mask, getting the data in the brain only
-    data = data[mask_data]
+    from pypes.preproc.motion_stats import streaming_dvars
 
-    #square root and mean across all timepoints inside mask
-    DVARS = np.sqrt(np.mean(data, axis=0))
+    dvars, std_dvars = streaming_dvars(rest, mask, chunk_size=chunk_size)
 
-    np.save(out_file, DVARS)
+    if standardized:
+        out_file = 'DVARS_std.npy'
+        np.save(out_file, std_dvars)
+    else:
+        out_file = 'DVARS.npy'
+        np.save(out_file, dvars)
     
     return op.abspath(out_file)
-
-    
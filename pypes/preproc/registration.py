@@ -8,12 +8,12 @@ import nipype.interfaces.afni as afni
 import nipype.interfaces.fsl as fsl
 import nipype.interfaces.spm  as spm
 import nipype.pipeline.engine    as pe
-from   nipype.algorithms.misc    import Gunzip
 from   nipype.interfaces.base import traits
 from   nipype.interfaces.utility import IdentityInterface, Function, isdefined
 
 from ..interfaces.nilearn import mean_img, concat_imgs
 from .spatial import get_bounding_box
+from ..interfaces.files import Gunzip
 from ..config import setup_node, get_config_setting
 from ..utils import spm_tpm_priors_path
 
@@ -289,14 +289,14 @@ def spm_create_group_template_wf(wf_name="spm_create_group_template"):
     if not use_common_template:
         # merge
         concat = setup_node(Function(function=concat_imgs,
-                                     input_names=["in_files"],
+                                     input_names=["in_files", "image_settings"],
                                      output_names=["out_file"],
                                      imports=['from pypes.interfaces.nilearn import ni2file']),
                             name='merge_time')
 
         # average
         average = setup_node(Function(function=mean_img,
-                                      input_names=["in_file", "out_file"],
+                                      input_names=["in_file", "out_file", "image_settings"],
                                       output_names=["out_file"],
                                       imports=['from pypes.interfaces.nilearn import ni2file']),
                             name='group_average')
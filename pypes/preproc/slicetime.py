@@ -7,10 +7,10 @@ import os.path as op
 import nipype.pipeline.engine as pe
 from   nipype.interfaces.base import traits, isdefined
 from   nipype.interfaces.utility import IdentityInterface
-from   nipype.algorithms.misc import Gunzip
 
 from   .slicetime_params import STCParametersInterface
 from   ..utils  import remove_ext
+from   ..interfaces.files import Gunzip
 from   ..config import setup_node
 
 
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Sampling profiler of the python code run by the workflow nodes.
+
+The nodes whose name matches any of the patterns of the `profile`
+configuration setting are profiled, e.g.:
+
+    profile: ['*spatial_maps_goodness_of_fit*', 'rest_noise_filter.gsr_pars']
+
+The patterns are matched with `fnmatch` against the node name and against
+its full name in the workflow, '{workflow}.{subworkflow}.{node}'.
+
+While a profiled node runs, the stack of the thread running it is sampled
+every `profile_interval` seconds, default: 0.005.
+The samples of each node run are saved in the 'profile' folder of the
+workflow log directory, in the folded stacks format of the FlameGraph tools.
+At the end of the workflow run they are merged in one flame graph,
+'profile/flamegraph.svg', with the nodes as its roots.
+"""
+import os
+import os.path as op
+import sys
+import hashlib
+import threading
+from   fnmatch import fnmatch
+from   collections import Counter
+
+from   .config import get_config_setting
+
+
+PROFILE_DIR = 'profile'
+FOLDED_EXT  = '.folded'
+MERGED_NAME = 'merged'
+
+
+def profile_patterns():
+    """ Return the node name patterns of the `profile` configuration setting."""
+    patterns = get_config_setting('profile', default=[])
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return list(patterns or [])
+
+
+def is_profiled(node, patterns):
+    """ Return True if `node` matches any of the name `patterns`."""
+    names = [node.name, node.fullname]
+    if node._hierarchy:
+        names.append('{}.{}'.format(node._hierarchy, node.name))
+    return any(fnmatch(name, pattern) for pattern in patterns for name in names)
+
+
+def default_profile_dir(wf):
+    """ Return the profile folder of `wf`, next to the crash files of
+    `pypes.io.build_crumb_workflow`: '{wf.base_dir}/{wf.name}/log/profile'."""
+    return op.join(wf.base_dir or os.getcwd(), wf.name, 'log', PROFILE_DIR)
+
+
+def node_profile_file(profile_dir, node):
+    """ Return the path to the profile of one run of `node` in `profile_dir`."""
+    from .resources import node_type
+
+    run_id = hashlib.md5(node.output_dir().encode('utf-8')).hexdigest()[:8]
+    return op.join(profile_dir, '{}_{}{}'.format(node_type(node), run_id, FOLDED_EXT))
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name, op.basename(code.co_filename),
+                               code.co_firstlineno).replace(';', ',')
+
+
+def _is_node_run(frame):
+    code = frame.f_code
+    return code.co_name == 'run' and code.co_filename.endswith(op.join('engine', 'nodes.py'))
+
+
+class SamplingProfiler(threading.Thread):
+    """ Thread that counts the stacks of the thread `thread_id` every `interval`
+    seconds. Only the stacks inside a `Node.run` call are kept, from it.
+
+    Parameters
+    ----------
+    thread_id: int
+        The identifier of the thread to sample. Default: the current one.
+
+    interval: float
+        Seconds between samples.
+    """
+    def __init__(self, thread_id=None, interval=0.005):
+        super(SamplingProfiler, self).__init__(daemon=True)
+        self.thread_id   = thread_id if thread_id is not None else threading.get_ident()
+        self.interval    = interval
+        self.stacks      = Counter()
+        self._stop_event = threading.Event()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(frame)
+            frame = frame.f_back
+        stack.reverse()
+
+        for idx, frame in enumerate(stack):
+            if _is_node_run(frame):
+                self.stacks[';'.join(_frame_name(frame) for frame in stack[idx:])] += 1
+                break
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self._sample()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.stacks
+
+
+def write_folded(folded_file, stacks, root=''):
+    """ Write the `stacks` sample counts in `folded_file`, prefixing
+    them with the `root` frame."""
+    os.makedirs(op.dirname(op.abspath(folded_file)), exist_ok=True)
+    with open(folded_file, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write('{} {}\n'.format(root + ';' + stack if root else stack, count))
+
+
+def read_folded(folded_file):
+    """ Return the stack sample counts in `folded_file`."""
+    stacks = Counter()
+    with open(folded_file) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack:
+                stacks[stack] += int(count)
+    return stacks
+
+
+def run_profiled(func, profile_file, node_name='', interval=0.005):
+    """ Return the result of `func()`, saving the stack samples of its run
+    in the folded `profile_file` with the root frame `node_name`."""
+    profiler = SamplingProfiler(interval=interval)
+    profiler.start()
+    try:
+        return func()
+    finally:
+        write_folded(profile_file, profiler.stop(), root=node_name)
+
+
+class ProfileCallback(object):
+    """ A nipype `status_callback` that profiles the nodes run in this
+    process that match `patterns`, i.e., with the Linear plugin."""
+    def __init__(self, profile_dir, patterns, interval=0.005):
+        self.profile_dir = profile_dir
+        self.patterns    = list(patterns)
+        self.interval    = interval
+        self._profilers  = {}
+
+    def __call__(self, node, status):
+        from .resources import node_type
+
+        if status == 'start':
+            if is_profiled(node, self.patterns):
+                profiler = SamplingProfiler(interval=self.interval)
+                profiler.start()
+                self._profilers[node.output_dir()] = profiler
+            return
+
+        profiler = self._profilers.pop(node.output_dir(), None)
+        if profiler is not None:
+            write_folded(node_profile_file(self.profile_dir, node), profiler.stop(),
+                         root=node_type(node))
+
+
+def merge_profiles(profile_dir):
+    """ Merge the node profiles in `profile_dir` in 'merged.folded' and
+    in the flame graph 'flamegraph.svg'.
+
+    Returns
+    -------
+    svg_file: str
+        Empty if there are no profiles.
+    """
+    stacks = Counter()
+    for name in sorted(os.listdir(profile_dir)):
+        if name.endswith(FOLDED_EXT) and name != MERGED_NAME + FOLDED_EXT:
+            stacks.update(read_folded(op.join(profile_dir, name)))
+
+    if not stacks:
+        return ''
+
+    write_folded(op.join(profile_dir, MERGED_NAME + FOLDED_EXT), stacks)
+    return flamegraph_svg(stacks, op.join(profile_dir, 'flamegraph.svg'))
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def flamegraph_svg(stacks, svg_file, width=1200, row_height=16):
+    """ Draw the `stacks` sample counts as a flame graph in `svg_file`.
+
+    Parameters
+    ----------
+    stacks: dict[str] -> int
+        The sample counts of each ';' separated stack.
+
+    svg_file: str
+
+    width: int
+        Width of the image in pixels.
+
+    row_height: int
+        Height of each stack level in pixels.
+
+    Returns
+    -------
+    svg_file: str
+    """
+    # the tree of frames, each node is [count, children]
+    tree = [0, {}]
+    for stack, count in stacks.items():
+        tree[0] += count
+        node = tree
+        for frame in stack.split(';'):
+            node = node[1].setdefault(frame, [0, {}])
+            node[0] += count
+
+    depth = [0]
+    rects = []
+
+    def draw(children, x, level):
+        depth[0] = max(depth[0], level + 1)
+        for frame, (count, grandchildren) in sorted(children.items()):
+            rects.append((frame, count, x, level))
+            draw(grandchildren, x, level + 1)
+            x += count
+
+    draw(tree[1], 0, 0)
+
+    total  = float(tree[0])
+    height = (depth[0] + 1) * row_height
+    lines  = ['<?xml version="1.0" standalone="no"?>',
+              '<svg version="1.1" width="{}" height="{}" xmlns="http://www.w3.org/2000/svg" '
+              'font-family="Verdana" font-size="11">'.format(width, height),
+              '<rect x="0" y="0" width="{}" height="{}" fill="#f8f8f8"/>'.format(width, height)]
+
+    for frame, count, x, level in rects:
+        rect_width = width * count / total
+        if rect_width < 0.5:
+            continue
+
+        rect_x = width * x / total
+        rect_y = height - (level + 2) * row_height
+        shade  = int(hashlib.md5(frame.encode('utf-8')).hexdigest()[:2], 16)
+        title  = '{} ({} samples, {:.1f}%)'.format(frame, count, 100. * count / total)
+        label  = frame[:int(rect_width / 7)] if rect_width > 21 else ''
+
+        lines.append('<g><title>{}</title>'.format(_escape(title)))
+        lines.append('<rect x="{:.1f}" y="{}" width="{:.1f}" height="{}" fill="rgb(230,{},55)" '
+                     'stroke="#ffffff" stroke-width="0.5"/>'.format(rect_x, rect_y, rect_width,
+                                                                    row_height - 1,
+                                                                    80 + shade * 120 // 255))
+        lines.append('<text x="{:.1f}" y="{}">{}</text></g>'.format(rect_x + 3, rect_y + row_height - 4,
+                                                                   _escape(label)))
+    lines.append('</svg>')
+
+    os.makedirs(op.dirname(op.abspath(svg_file)), exist_ok=True)
+    with open(svg_file, 'w') as f:
+        f.write('\n'.join(lines))
+
+    return svg_file
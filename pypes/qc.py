@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+A cohort store of the motion quality control measures of each subject.
+
+The measures are kept in a SQLite file, one row per subject and measure,
+keyed by the crumb argument values of the subject. So the group
+summaries, the outliers and the spreadsheet exports are queries on one
+file instead of parsing the output folder of each subject.
+
+The workflow nodes never write the store: each one saves the measures of
+its subject in a JSON file, see `save_motion_qc`, and they are added to
+the store afterwards by one process, see `MotionQCStore.add_qc_file`.
+The SQLite locks are not reliable on network file systems, so the store
+must be written by one process at a time and should be on a local disk.
+"""
+import os
+import os.path as op
+import json
+import sqlite3
+from   collections import OrderedDict
+
+import numpy as np
+
+
+def subject_key(args):
+    """ Return the key of the subject with the crumb argument values `args`."""
+    return '/'.join(str(value) for value in args.values())
+
+
+class MotionQCStore(object):
+    """ A SQLite store of the motion QC measures of a cohort.
+    It must be written by only one process at a time.
+
+    Parameters
+    ----------
+    db_file: str
+        Path to the SQLite file. It will be created if it does not exist.
+        It should be on a local disk, not on a network file system.
+    """
+    def __init__(self, db_file):
+        self.db_file = op.abspath(db_file)
+        self._con = None
+
+    def _connect(self):
+        if self._con is None:
+            self._con = sqlite3.connect(self.db_file, timeout=60)
+            with self._con:
+                self._con.execute('CREATE TABLE IF NOT EXISTS subject '
+                                  '(key TEXT PRIMARY KEY, args TEXT, source TEXT, mtime INTEGER)')
+                self._con.execute('CREATE TABLE IF NOT EXISTS measure '
+                                  '(key TEXT, name TEXT, value REAL, PRIMARY KEY (key, name))')
+                self._con.execute('CREATE INDEX IF NOT EXISTS measure_name ON measure (name)')
+        return self._con
+
+    def add(self, args, measures, source=''):
+        """ Set the `measures` of the subject with the crumb argument values `args`.
+
+        Parameters
+        ----------
+        args: OrderedDict[str] -> str
+            The crumb argument values of the subject.
+
+        measures: dict[str] -> float
+
+        source: str
+            Path to the file the measures were taken from. Its modification
+            time is kept to check if the measures are up to date.
+        """
+        key   = subject_key(args)
+        mtime = os.stat(source).st_mtime_ns if source and op.exists(source) else None
+
+        con = self._connect()
+        with con:
+            con.execute('INSERT OR REPLACE INTO subject VALUES (?, ?, ?, ?)',
+                        (key, json.dumps(args), source, mtime))
+            con.execute('DELETE FROM measure WHERE key=?', (key, ))
+            con.executemany('INSERT INTO measure VALUES (?, ?, ?)',
+                            [(key, name, float(value)) for name, value in measures.items()])
+
+    def add_qc_file(self, qc_file, args=None):
+        """ Add the measures of a `save_motion_qc` file, unless they are
+        already in the store and the file did not change since.
+
+        Parameters
+        ----------
+        qc_file: str
+            Path to the JSON file.
+
+        args: OrderedDict[str] -> str
+            The crumb argument values of the subject.
+            Default: the ones in `qc_file`.
+
+        Returns
+        -------
+        added: bool
+        """
+        file_args, measures = read_motion_qc(qc_file)
+        if args is None:
+            args = file_args
+
+        if self.is_current(args, qc_file):
+            return False
+
+        self.add(args, measures, source=qc_file)
+        return True
+
+    def is_current(self, args, source):
+        """ Return True if the measures of the subject were taken from
+        `source` and it did not change since."""
+        row = self._connect().execute('SELECT source, mtime FROM subject WHERE key=?',
+                                      (subject_key(args), )).fetchone()
+        if row is None or row[0] != source or not op.exists(source):
+            return False
+        return row[1] == os.stat(source).st_mtime_ns
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM subject').fetchone()[0]
+
+    def summary(self):
+        """ Return the count, mean, standard deviation, minimum and maximum
+        of each measure over all the subjects.
+
+        Returns
+        -------
+        summary: OrderedDict[str] -> OrderedDict[str] -> float
+        """
+        rows = self._connect().execute('SELECT name, COUNT(value), AVG(value), AVG(value * value), '
+                                       'MIN(value), MAX(value) FROM measure '
+                                       'GROUP BY name ORDER BY name').fetchall()
+
+        summary = OrderedDict()
+        for name, count, mean, mean_sq, vmin, vmax in rows:
+            summary[name] = OrderedDict([('count', count),
+                                         ('mean',  mean),
+                                         ('std',   np.sqrt(max(mean_sq - mean**2, 0))),
+                                         ('min',   vmin),
+                                         ('max',   vmax),
+                                        ])
+        return summary
+
+    def outliers(self, name, n_std=3.):
+        """ Return the subjects whose measure `name` is more than `n_std`
+        standard deviations away from the cohort mean.
+
+        Returns
+        -------
+        outliers: list of 2-tuples
+            The crumb argument values and the measure of each outlier subject.
+        """
+        stats = self.summary().get(name)
+        if stats is None or not stats['std']:
+            return []
+
+        rows = self._connect().execute('SELECT subject.args, measure.value FROM measure '
+                                       'JOIN subject ON subject.key = measure.key '
+                                       'WHERE measure.name=? AND ABS(measure.value - ?) > ? '
+                                       'ORDER BY measure.value DESC',
+                                       (name, stats['mean'], n_std * stats['std'])).fetchall()
+        return [(json.loads(args, object_pairs_hook=OrderedDict), value) for args, value in rows]
+
+    def to_frame(self):
+        """ Return a pandas.DataFrame with one row per subject, the crumb
+        argument values and the measures in columns."""
+        import pandas as pd
+
+        con = self._connect()
+        subjects = OrderedDict((key, json.loads(args, object_pairs_hook=OrderedDict))
+                               for key, args in con.execute('SELECT key, args FROM subject '
+                                                            'ORDER BY key'))
+
+        records = OrderedDict((key, OrderedDict(args)) for key, args in subjects.items())
+        for key, name, value in con.execute('SELECT key, name, value FROM measure ORDER BY name'):
+            if key in records:
+                records[key][name] = value
+
+        return pd.DataFrame.from_records(list(records.values()))
+
+    def export(self, out_path):
+        """ Save the `to_frame` table in an Excel (.xls, .xlsx) or CSV file."""
+        df = self.to_frame()
+        if out_path.endswith(('.xls', '.xlsx')):
+            df.to_excel(out_path, index=False)
+        else:
+            df.to_csv(out_path, index=False)
+        return out_path
+
+
+def motion_summary(fd_power, fd_jenkinson=None, rms_abs=None, rms_rel=None,
+                   dvars=None, censor=None, threshold=0.5):
+    """ Return the QC measures of the motion metrics of one subject.
+
+    Parameters
+    ----------
+    fd_power, fd_jenkinson, rms_abs, rms_rel: np.ndarray
+        See `pypes.preproc.motion_stats.motion_metrics`.
+
+    dvars: np.ndarray
+
+    censor: np.ndarray of bool
+        See `pypes.preproc.censor.censor_mask`.
+
+    threshold: float
+        FD threshold to count the volumes with too much motion.
+
+    Returns
+    -------
+    measures: OrderedDict[str] -> float
+    """
+    measures = OrderedDict()
+    for name, values in (('fd_power',     fd_power),
+                         ('fd_jenkinson', fd_jenkinson),
+                         ('rms_abs',      rms_abs),
+                         ('rms_rel',      rms_rel),
+                         ('dvars',        dvars)):
+        if values is None:
+            continue
+        values = np.asarray(values)
+        measures['mean_' + name] = values.mean()
+        measures['max_'  + name] = values.max()
+
+    measures['n_fd_power_over_threshold'] = np.sum(np.asarray(fd_power) > threshold)
+
+    if censor is not None:
+        measures['n_censored'] = np.sum(censor)
+        measures['percent_censored'] = 100. * np.mean(censor)
+
+    return measures
+
+
+def rapidart_summary(stats_file):
+    """ Return the outliers and the motion norm statistics in the
+    `statistics_files` output of the nipype.RapidArt interface."""
+    with open(stats_file) as f:
+        stats = json.load(f)
+
+    measures = OrderedDict(stats[1])
+    for name, value in stats[3]['motion_norm'].items():
+        measures['{}_motion_norm'.format(name)] = value
+    return measures
+
+
+def read_motion_qc(qc_file):
+    """ Return the subject crumb argument values and the measures in the
+    JSON file of `save_motion_qc`."""
+    with open(qc_file) as f:
+        qc = json.load(f, object_pairs_hook=OrderedDict)
+    return qc['args'], qc['measures']
+
+
+def save_motion_qc(subject_id, scan_id, fd_file, fdj_file=None,
+                   dvars_file=None, censor_file=None, threshold=1.0):
+    """ Save the `motion_summary` of one subject in a JSON file, to be added
+    to a `MotionQCStore` with its `add_qc_file`.
+    This is a nipype Function node function.
+
+    Parameters
+    ----------
+    subject_id: str
+
+    scan_id: str
+
+    fd_file, fdj_file: str
+        Paths to the Power and Jenkinson FD text files.
+
+    dvars_file: str
+        Path to the DVARS .npy file.
+
+    censor_file: str
+        Path to the censor mask .npy file.
+
+    threshold: float
+        The scrubbing FD threshold.
+
+    Returns
+    -------
+    qc_file: str
+        Path to the 'motion_qc.json' file.
+    """
+    import os.path as op
+    import json
+    from   collections import OrderedDict
+
+    import numpy as np
+
+    from pypes.qc import motion_summary
+
+    measures = motion_summary(np.loadtxt(fd_file),
+                              fd_jenkinson=np.loadtxt(fdj_file) if fdj_file else None,
+                              dvars=np.load(dvars_file) if dvars_file else None,
+                              censor=np.load(censor_file) if censor_file else None,
+                              threshold=threshold)
+
+    qc_file = op.abspath('motion_qc.json')
+    with open(qc_file, 'w') as f:
+        json.dump(OrderedDict([('args',     OrderedDict([('subject_id', subject_id),
+                                                         ('scan_id',    scan_id)])),
+                               ('measures', OrderedDict((name, float(value))
+                                                        for name, value in measures.items())),
+                              ]), f, indent=2)
+    return qc_file
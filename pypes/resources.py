@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+"""
+Resource profiles of the workflow nodes and the MultiProc plugin that
+schedules them against a total CPU and memory budget.
+
+A node profile is set through the configuration next to the other node
+settings, e.g.:
+
+    anat_bias.n_procs: 4
+    anat_bias.mem_gb: 6
+
+For the nodes without a `mem_gb` profile, the memory is estimated from the
+header dimensions of their input NIfTI files right before they run, except
+for the data grabbing, data sink and file handling nodes, which only take
+the default reservation.
+
+The threads of each node are limited to its `n_procs`, within the total
+number of CPUs, with the thread environment variables of the command line
+interfaces and with `threadpoolctl` in the worker process for the python
+ones. The multithreaded interfaces (with a `num_threads` input) without a
+`n_procs` profile share the free CPUs among the ready jobs, up to the
+`max_threads_per_node` configuration setting.
+
+With the 'critical_path' scheduler, the ready jobs start by the length of
+the longest chain of nodes that depends on them, measured with the node
+durations of the previous runs. So the slow steps of all the subjects start
+early and the nodes that join the subjects are reached sooner.
+
+The nodes can also be measured, see `pypes.telemetry`, and profiled, see
+`pypes.profiler`, in their worker processes.
+"""
+import os
+import os.path as op
+import json
+import time
+import logging
+import tempfile
+from   functools import partial
+
+import numpy as np
+import nibabel as nib
+from   nipype.pipeline.plugins.multiproc import MultiProcPlugin
+from   nipype.interfaces.base import isdefined
+from   nipype.interfaces.io import IOBase
+from   nipype.interfaces.utility import IdentityInterface, Rename, Select, Merge, Split
+from   nipype.algorithms.misc import Gunzip
+
+from   .config import get_config_setting
+from   .utils.environ import set_node_threads, NODE_THREADS_VAR
+from   .telemetry import NodeMeter, node_event, write_event
+from   .profiler import (profile_patterns,
+                         is_profiled,
+                         node_profile_file,
+                         run_profiled,
+                         merge_profiles)
+
+
+log = logging.getLogger(__name__)
+
+# nipype's default for Node.mem_gb, used when no profile is given
+DEFAULT_MEM_GB = 0.20
+
+NIFTI_EXTS = ('.nii', '.nii.gz', '.img', '.hdr')
+
+# interfaces that handle the file paths, or stream the files, without loading the images
+PATH_INTERFACES = (IOBase, IdentityInterface, Rename, Select, Merge, Split, Gunzip)
+
+
+def _nifti_files(value):
+    """ Return the existing NIfTI file paths in the input `value`."""
+    if isinstance(value, str):
+        if value.endswith(NIFTI_EXTS) and op.isfile(value):
+            return [value]
+        return []
+
+    if isinstance(value, (list, tuple)):
+        return [path for item in value for path in _nifti_files(item)]
+
+    return []
+
+
+def nifti_input_bytes(inputs):
+    """ Return the number of bytes the input NIfTI files of a node take
+    once loaded in memory as float64 arrays.
+    Only the file headers are read.
+
+    Parameters
+    ----------
+    inputs: nipype interface inputs
+
+    Returns
+    -------
+    n_bytes: int
+    """
+    n_bytes = 0
+    for name, value in inputs.trait_get().items():
+        if not isdefined(value):
+            continue
+
+        for path in _nifti_files(value):
+            try:
+                shape = nib.load(path).header.get_data_shape()
+            except Exception:
+                log.debug('Could not read the header of {} for input {}.'.format(path, name))
+                continue
+            n_bytes += int(np.prod(shape, dtype=np.int64)) * 8
+
+    return n_bytes
+
+
+def estimate_mem_gb(node):
+    """ Return an estimation of the peak memory of `node` from the size of
+    its input NIfTI files.
+
+    The estimation is `mem_estimate_overhead_gb` plus `mem_estimate_factor`
+    times the size of the inputs as float64 arrays, both global
+    configuration settings, with defaults 0.25 and 3.
+
+    The nodes with an interface in `PATH_INTERFACES` take `DEFAULT_MEM_GB`.
+
+    Parameters
+    ----------
+    node: nipype Node
+        Its inputs from the upstream nodes must be already set.
+
+    Returns
+    -------
+    mem_gb: float
+    """
+    if isinstance(node.interface, PATH_INTERFACES):
+        return DEFAULT_MEM_GB
+
+    factor   = get_config_setting('mem_estimate_factor',      default=3.)
+    overhead = get_config_setting('mem_estimate_overhead_gb', default=0.25)
+
+    n_bytes = nifti_input_bytes(node.inputs)
+    if not n_bytes:
+        return DEFAULT_MEM_GB
+
+    return overhead + factor * n_bytes / 1024.**3
+
+
+def run_node_job(node, updatehash, taskid, n_threads=None, telemetry=False, profile_file='',
+                 interval=0.005):
+    """ The nipype MultiProc `run_node` function that limits the thread pools
+    of the numerical libraries loaded in the worker process to `n_threads`,
+    and gives it to the node functions through `pypes.utils.environ.node_threads`,
+    also measures the node run if `telemetry` is True, in the 'telemetry'
+    item of the result, and profiles it in `profile_file` if given."""
+    from nipype.pipeline.plugins.multiproc import run_node
+    from threadpoolctl import threadpool_limits
+
+    run = partial(run_node, node, updatehash, taskid)
+    if profile_file:
+        run = partial(run_profiled, run, profile_file, node_name=node_type(node), interval=interval)
+
+    # the worker processes run one node at a time
+    if n_threads:
+        os.environ[NODE_THREADS_VAR] = str(n_threads)
+
+    # the BLAS and OpenMP pools are created when numpy is imported, before
+    # the worker forks, so the environment variables don't limit them anymore
+    try:
+        with threadpool_limits(limits=n_threads):
+            if not telemetry:
+                return run()
+
+            meter  = NodeMeter().start()
+            result = run()
+            result['telemetry'] = meter.stop()
+            return result
+    finally:
+        os.environ.pop(NODE_THREADS_VAR, None)
+
+
+class ResourceMultiProcPlugin(MultiProcPlugin):
+    """ The nipype MultiProc plugin that estimates the memory of the nodes
+    without a `mem_gb` profile and that packs the ready jobs in the CPU
+    and memory budget starting with the biggest ones.
+
+    It also limits the threads of each node to its `n_procs` and gives
+    the free CPUs to the multithreaded nodes without a `n_procs` profile.
+
+    The plugin_args are the same as for MultiProc, mainly:
+
+    - n_procs: total number of CPUs.
+
+    - memory_gb: total memory budget, default: 90% of the system memory.
+
+    - scheduler: 'critical_path' to start the ready jobs by their remaining
+      critical path length, otherwise by their memory and threads.
+
+    - durations_file: JSON file where the node durations are kept
+      between runs, for the 'critical_path' scheduler.
+
+    - telemetry_file: JSON-lines file where the measures of each node run
+      are appended. See `pypes.telemetry`.
+
+    - telemetry_args: the iterable names the telemetry events are tagged with.
+
+    - profile_dir: folder for the profiles of the nodes that match the
+      `profile` configuration setting. See `pypes.profiler`.
+
+    The nodes that need more than the budget are run when nothing else is
+    running, as MultiProc with `raise_insufficient` False does.
+    """
+    def __init__(self, plugin_args=None):
+        # the resource aware MultiProc scheduler of nipype >= 1.1, run on a process pool
+        for name in ('_check_resources', '_sort_jobs', '_send_procs_to_workers'):
+            if not hasattr(MultiProcPlugin, name):
+                raise RuntimeError('ResourceMultiProcPlugin needs nipype >= 1.1, '
+                                   'its MultiProcPlugin has no {}.'.format(name))
+
+        plugin_args = dict(plugin_args or {})
+        plugin_args.setdefault('raise_insufficient', False)
+        super(ResourceMultiProcPlugin, self).__init__(plugin_args=plugin_args)
+        self._estimated    = set()
+        self._auto_threads = set()
+
+        self._durations_file = self.plugin_args.get('durations_file', '')
+        self._durations   = read_durations(self._durations_file)
+        self._start_times = {}
+        self._priority    = {}
+
+        self._telemetry_file  = self.plugin_args.get('telemetry_file', '')
+        self._telemetry_args  = self.plugin_args.get('telemetry_args', [])
+        self._telemetry_nodes = {}
+
+        self._profile_dir      = self.plugin_args.get('profile_dir', '')
+        self._profile_patterns = profile_patterns() if self._profile_dir else []
+        self._profile_interval = get_config_setting('profile_interval', default=0.005)
+
+    def run(self, graph, config, updatehash=False):
+        if self.plugin_args.get('scheduler') == 'critical_path':
+            self._priority = critical_path_lengths(graph, self._durations)
+        try:
+            super(ResourceMultiProcPlugin, self).run(graph, config, updatehash=updatehash)
+        finally:
+            if self._durations_file:
+                # a failure here must not hide the result of the run
+                try:
+                    write_durations(self._durations_file, self._durations)
+                except OSError as exc:
+                    log.warning('Could not save the node durations in {}: {}'.format(self._durations_file, exc))
+            if self._profile_patterns and op.isdir(self._profile_dir):
+                merge_profiles(self._profile_dir)
+
+    def _estimate_ready_jobs(self, jobids):
+        for jobid in jobids:
+            if jobid in self._estimated:
+                continue
+
+            self._estimated.add(jobid)
+            node = self.procs[jobid]
+            if node._mem_gb != DEFAULT_MEM_GB or isinstance(node.interface, PATH_INTERFACES):
+                continue
+
+            try:
+                node._get_inputs()
+                node._mem_gb = estimate_mem_gb(node)
+            except Exception as exc:
+                log.debug('Could not estimate the memory of {}: {}'.format(node.fullname, exc))
+                continue
+
+            log.debug('Estimated {:.2f} GB for node {}.'.format(node._mem_gb, node.fullname))
+
+    def _limit_ready_jobs_threads(self, jobids):
+        # it returns 2 or 3 values, with the free GPU slots, depending on the nipype version
+        free_processors = self._check_resources(self.pending_tasks)[1]
+        max_threads = get_config_setting('max_threads_per_node', default=self.processors)
+        share = max(1, min(free_processors // max(len(jobids), 1), max_threads))
+
+        for jobid in jobids:
+            node = self.procs[jobid]
+            if jobid in self._auto_threads or (node._n_procs is None and
+                                               hasattr(node._interface.inputs, 'num_threads')):
+                self._auto_threads.add(jobid)
+                node._n_procs = share
+
+            set_node_threads(node, min(node.n_procs, self.processors))
+
+    def _send_procs_to_workers(self, updatehash=False, graph=None):
+        jobids = np.flatnonzero(~self.proc_done & (self.depidx.sum(axis=0) == 0).__array__())
+        self._estimate_ready_jobs(jobids)
+        self._limit_ready_jobs_threads(jobids)
+        return super(ResourceMultiProcPlugin, self)._send_procs_to_workers(updatehash=updatehash,
+                                                                           graph=graph)
+
+    def _submit_job(self, node, updatehash=False):
+        self._start_times[node.output_dir()] = time.time()
+
+        profile_file = ''
+        if self._profile_patterns and is_profiled(node, self._profile_patterns):
+            profile_file = node_profile_file(self._profile_dir, node)
+
+        # as MultiProcPlugin._submit_job, limiting the threads of the node and
+        # measuring or profiling it in its worker
+        self._taskid += 1
+        if getattr(node.interface, 'terminal_output', '') == 'stream':
+            node.interface.terminal_output = 'allatonce'
+
+        result_future = self.pool.submit(run_node_job, node, updatehash, self._taskid,
+                                         n_threads=min(node.n_procs, self.processors),
+                                         telemetry=bool(self._telemetry_file),
+                                         profile_file=profile_file,
+                                         interval=self._profile_interval)
+        result_future.add_done_callback(self._async_callback)
+        self._task_obj[self._taskid] = result_future
+        if self._telemetry_file:
+            self._telemetry_nodes[self._taskid] = node
+
+        log.debug('Submitted task {} (taskid={}).'.format(node.fullname, self._taskid))
+        return self._taskid
+
+    def _get_result(self, taskid):
+        result = super(ResourceMultiProcPlugin, self)._get_result(taskid)
+        if result is not None and taskid in self._telemetry_nodes:
+            node = self._telemetry_nodes.pop(taskid)
+            if 'telemetry' in result:
+                status = 'error' if result['traceback'] else 'ok'
+                write_event(self._telemetry_file,
+                            node_event(node, result['telemetry'], self._telemetry_args, status=status))
+        return result
+
+    def _task_finished_cb(self, jobid, cached=False):
+        node  = self.procs[jobid]
+        start = self._start_times.pop(node.output_dir(), None)
+        if start is not None and not cached and jobid not in self.mapnodesubids:
+            update_duration(self._durations, node_type(node), time.time() - start)
+
+        super(ResourceMultiProcPlugin, self)._task_finished_cb(jobid, cached=cached)
+
+    def _job_priority(self, jobid):
+        # the MapNode subnodes are not in the graph, they take the priority of their MapNode
+        node = self.procs[self.mapnodesubids.get(jobid, jobid)]
+        return self._priority.get(node, 0)
+
+    def _sort_jobs(self, jobids, scheduler='tsort'):
+        if scheduler == 'critical_path':
+            return sorted(jobids, key=lambda jobid: (self._job_priority(jobid),
+                                                     self.procs[jobid].mem_gb),
+                          reverse=True)
+
+        # first-fit decreasing packing of the ready jobs
+        return sorted(jobids, key=lambda jobid: (self.procs[jobid].mem_gb,
+                                                 self.procs[jobid].n_procs),
+                      reverse=True)
+
+
+def node_type(node):
+    """ Return the name of `node` in its workflow without the iterables
+    expansion, which is the same for all the subjects."""
+    if node._hierarchy:
+        return '{}.{}'.format(node._hierarchy, node.name)
+    return node.name
+
+
+def read_durations(durations_file):
+    """ Return the node durations in `durations_file`, an empty dict if
+    it does not exist."""
+    if not durations_file or not op.exists(durations_file):
+        return {}
+
+    with open(durations_file) as f:
+        return json.load(f)
+
+
+def write_durations(durations_file, durations):
+    """ Save the node `durations` in `durations_file`, merged with the ones
+    other runs sharing the file saved meanwhile.
+    Each writer goes through its own temporary file, so concurrent runs
+    don't clash."""
+    durations_dir = op.dirname(op.abspath(durations_file))
+    os.makedirs(durations_dir, exist_ok=True)
+
+    try:
+        merged = read_durations(durations_file)
+    except ValueError:
+        merged = {}
+    merged.update(durations)
+
+    fd, tmp_file = tempfile.mkstemp(dir=durations_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(merged, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, durations_file)
+    except Exception:
+        if op.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def update_duration(durations, key, seconds, alpha=0.3):
+    """ Update the exponential moving average of the duration of the
+    nodes of type `key` with a new run of `seconds`."""
+    if key in durations:
+        durations[key] = (1 - alpha) * durations[key] + alpha * seconds
+    else:
+        durations[key] = seconds
+
+
+def critical_path_lengths(graph, durations):
+    """ Return the length of the longest path from each node to the end of
+    `graph`, including the node itself.
+
+    Parameters
+    ----------
+    graph: networkx.DiGraph
+        The execution graph of a workflow.
+
+    durations: dict[str] -> float
+        The duration of each `node_type`. The nodes with no duration take
+        the mean of the known ones, or 1 second if none is known.
+
+    Returns
+    -------
+    lengths: dict[Node] -> float
+    """
+    import networkx as nx
+
+    default = sum(durations.values()) / len(durations) if durations else 1.
+
+    lengths = {}
+    for node in reversed(list(nx.topological_sort(graph))):
+        tail = max((lengths[succ] for succ in graph.successors(node)), default=0)
+        lengths[node] = durations.get(node_type(node), default) + tail
+
+    return lengths
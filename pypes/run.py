@@ -2,37 +2,244 @@
 """
 Helper functions to build base workflow and run them
 """
-from pypes.plot import plot_workflow
+import os.path as op
+import logging as log
+import multiprocessing as mp
+import multiprocessing.connection
 
+from pypes.config    import get_config_setting
+from pypes.imgcache  import setup_image_cache
+from pypes.plot      import plot_workflow
+from pypes.resources import ResourceMultiProcPlugin
+from pypes.manifest  import merge_manifests
+from pypes.jobqueue  import QueuePlugin
+from pypes.telemetry import TelemetryCallback, iterable_names, default_log_file
+from pypes.profiler  import (ProfileCallback,
+                             profile_patterns,
+                             default_profile_dir,
+                             merge_profiles)
 
-def run_wf(wf, plugin='MultiProc', n_cpus=2, **plugin_kwargs):
+
+def run_wf(wf, plugin='MultiProc', n_cpus=2, telemetry=False, log_suffix='', **plugin_kwargs):
     """ Execute `wf` with `plugin`.
 
     Parameters
     ----------
     wf: nipype Workflow
+        If None, e.g., because `pypes.io.build_crumb_workflow` found all the
+        subjects up to date, there is nothing to run.
 
     plugin: str
         The pipeline execution plugin.
         See wf.run docstring for choices.
+        With 'Queue' the nodes are submitted to a `pypes.jobqueue.JobQueue`,
+        run them starting any number of `pypes worker <queue_dir>` processes.
+        By default `queue_dir` is '{wf.base_dir}/{wf.name}/queue'.
 
     n_cpus: int
         Number of CPUs to use with the 'MultiProc' plugin.
 
+    telemetry: bool or str
+        If True or a file path, the wall time, CPU time, peak memory and bytes
+        read and written from and to the storage of each node run are appended
+        to a JSON-lines log, by default '{wf.base_dir}/{wf.name}/log/telemetry.jsonl'.
+        Only for the 'MultiProc' and the serial execution.
+        See `pypes telemetry <log_file>` for a summary.
+        Independently of it, the nodes that match the `profile` configuration
+        setting are run under a sampling profiler, see `pypes.profiler`.
+        If the `image_cache_gb` configuration setting is set, the helpers read
+        the gzipped images from their decompressed copies in
+        '{wf.base_dir}/{wf.name}/image_cache', see `pypes.imgcache`, also in
+        the worker processes of the 'Queue' plugin.
+
+    log_suffix: str
+        A suffix for the default telemetry log, profile folder and node
+        durations file names, for the runs that share the workflow folder,
+        e.g., '_shard0of4'.
+
     plugin_kwargs: keyword argumens
-        Keyword arguments for the plugin if using something different
-        then 'MultiProc'.
+        Keyword arguments for the plugin.
+        With 'MultiProc' the nodes are scheduled with a
+        `pypes.resources.ResourceMultiProcPlugin` within `n_cpus` and
+        'memory_gb', which by default is the 'memory_gb' configuration
+        setting or 90% of the system memory.
+        With `scheduler='critical_path'` the ready nodes start by their remaining
+        critical path, measured with the durations of the previous runs kept
+        in '{wf.base_dir}/{wf.name}/log/node_durations.json'.
+        The threads of each node are limited to its `n_procs`, 1 by default,
+        with the thread environment variables of the command line interfaces
+        and with `threadpoolctl` in the worker process, which also limits the
+        BLAS and OpenMP pools that numpy started before the workers forked.
     """
+    if wf is None:
+        log.info('No workflow to run.')
+        return
+
+    log_file = ''
+    if telemetry:
+        log_file = telemetry if isinstance(telemetry, str) else _suffixed(default_log_file(wf),
+                                                                           log_suffix)
+
+    patterns    = profile_patterns()
+    profile_dir = _suffixed(default_profile_dir(wf), log_suffix) if patterns else ''
+
+    # the decompressed copies of the images go in the workflow folder, see `pypes.imgcache`
+    setup_image_cache(wf)
+
     # run the workflow according to `plugin`
-    if plugin == "MultiProc" or n_cpus > 1:
-        wf.run("MultiProc", plugin_args={"n_procs": n_cpus})
+    if plugin == "Queue":
+        plugin_kwargs.setdefault('queue_dir', op.join(wf.base_dir, wf.name, 'queue'))
+        wf.run(plugin=QueuePlugin(plugin_args=plugin_kwargs))
+    elif plugin == "MultiProc" or n_cpus > 1:
+        plugin_kwargs['n_procs'] = n_cpus
+        if wf.base_dir:
+            plugin_kwargs.setdefault('durations_file',
+                                     op.join(wf.base_dir, wf.name, 'log',
+                                             'node_durations{}.json'.format(log_suffix)))
+        memory_gb = plugin_kwargs.get('memory_gb', get_config_setting('memory_gb', default=None))
+        if memory_gb:
+            plugin_kwargs['memory_gb'] = memory_gb
+        if log_file:
+            plugin_kwargs['telemetry_file'] = log_file
+            plugin_kwargs['telemetry_args'] = iterable_names(wf)
+        if profile_dir:
+            plugin_kwargs['profile_dir'] = profile_dir
+        wf.run(plugin=ResourceMultiProcPlugin(plugin_args=plugin_kwargs))
     elif not plugin or plugin is None or n_cpus <= 1:
-        wf.run(plugin=None)
+        callbacks = []
+        if log_file:
+            callbacks.append(TelemetryCallback(log_file, arg_names=iterable_names(wf)))
+        if profile_dir:
+            callbacks.append(ProfileCallback(profile_dir, patterns,
+                                             interval=get_config_setting('profile_interval',
+                                                                         default=0.005)))
+        if not callbacks:
+            wf.run(plugin=None)
+            return
+
+        def status_callback(node, status):
+            for callback in callbacks:
+                callback(node, status)
+
+        try:
+            wf.run(plugin='Linear', plugin_args={'status_callback': status_callback})
+        finally:
+            if profile_dir and op.isdir(profile_dir):
+                merge_profiles(profile_dir)
     else:
         wf.run(plugin=plugin, **plugin_kwargs)
 
 
-def run_debug(workflow, plugin="MultiProc", n_cpus=4, **plugin_kwargs):
+def _suffixed(path, suffix):
+    """ Return `path` with `suffix` before its extension."""
+    root, ext = op.splitext(path)
+    return root + suffix + ext
+
+
+def _run_shard(wf_builder, shard, builder_kwargs, plugin, n_cpus, plugin_kwargs):
+    """ Build the workflow for `shard` with `wf_builder` and run it."""
+    wf = wf_builder(shard=shard, **builder_kwargs)
+    run_wf(wf, plugin=plugin, n_cpus=n_cpus, log_suffix='_shard{}of{}'.format(*shard),
+           **plugin_kwargs)
+
+
+def run_shards(wf_builder, n_shards, shards=None, n_jobs=None, plugin='MultiProc', n_cpus=2,
+               plugin_kwargs=None, **builder_kwargs):
+    """ Split the subjects in `n_shards` shards and build and run a workflow
+    for each of them in its own process.
+
+    Each shard expands a graph only with its own subjects, so the memory and
+    the time needed to build and schedule it do not grow with the cohort.
+    The shards share the work and output folders, so they can also be run
+    from different hosts sharing the file system, each one with its own
+    list of `shards`. The manifests of the subjects in the output folder are
+    merged once the shards are done. Each shard keeps its own telemetry log,
+    profiles and node durations in the workflow 'log' folder, with a
+    '_shard{i}of{n}' suffix.
+
+    Parameters
+    ----------
+    wf_builder: function
+        A function that returns a workflow, with a `shard` keyword argument,
+        e.g., `pypes.io.build_crumb_workflow` or `pypes.datasets.clinical_crumb_workflow`.
+        The workflows can't join the subjects, e.g., to create a group template.
+
+    n_shards: int
+        Number of shards to split the subjects in.
+
+    shards: list of int
+        The indices of the shards to run here.
+        Default: all of them.
+
+    n_jobs: int
+        Number of shards running at the same time.
+        Default: all of `shards`.
+
+    plugin: str
+        The pipeline execution plugin for each shard. See `run_wf`.
+
+    n_cpus: int
+        Number of CPUs to use for each shard with the 'MultiProc' plugin.
+
+    plugin_kwargs: dict
+        Keyword arguments for the plugin if using something different
+        then 'MultiProc'.
+
+    builder_kwargs: keyword arguments
+        Arguments for `wf_builder`.
+        If 'output_dir' is one of them, the subject manifests in it will be
+        merged with `pypes.manifest.merge_manifests`.
+
+    Returns
+    -------
+    manifest_file: str
+        Path to the merged manifests file, empty if there is no `output_dir`.
+
+    Raises
+    ------
+    RuntimeError
+        If any of the shard processes failed.
+    """
+    if shards is None:
+        shards = list(range(n_shards))
+
+    if n_jobs is None:
+        n_jobs = len(shards)
+
+    if plugin_kwargs is None:
+        plugin_kwargs = {}
+
+    failed  = []
+    queue   = list(shards)
+    running = {}
+    while queue or running:
+        while queue and len(running) < n_jobs:
+            shard_idx = queue.pop(0)
+            proc = mp.Process(target=_run_shard,
+                              args=(wf_builder, (shard_idx, n_shards), builder_kwargs,
+                                    plugin, n_cpus, plugin_kwargs),
+                              name='shard{}of{}'.format(shard_idx, n_shards))
+            proc.start()
+            running[proc.sentinel] = (shard_idx, proc)
+
+        for sentinel in mp.connection.wait(list(running)):
+            shard_idx, proc = running.pop(sentinel)
+            proc.join()
+            if proc.exitcode != 0:
+                failed.append(shard_idx)
+
+    manifest_file = ''
+    output_dir = builder_kwargs.get('output_dir', '')
+    if output_dir:
+        manifest_file = merge_manifests(output_dir)
+
+    if failed:
+        raise RuntimeError('The shards {} of {} failed, see their crash files.'.format(failed, n_shards))
+
+    return manifest_file
+
+
+def run_debug(workflow, plugin="MultiProc", n_cpus=4, telemetry=False, **plugin_kwargs):
     """ Execute `wf` with `plugin`.
 
     Parameters
@@ -46,6 +253,9 @@ def run_debug(workflow, plugin="MultiProc", n_cpus=4, **plugin_kwargs):
     n_cpus: int
         Number of CPUs to use with the 'MultiProc' plugin.
 
+    telemetry: bool or str
+        Log the resources used by each node. See `run_wf`.
+
     plugin_kwargs: keyword argumens
         Keyword arguments for the plugin if using something different
         then 'MultiProc'.
@@ -56,7 +266,7 @@ def run_debug(workflow, plugin="MultiProc", n_cpus=4, **plugin_kwargs):
         plot_workflow(workflow)
 
         # run it
-        run_wf(workflow, plugin=plugin, n_cpus=n_cpus,
+        run_wf(workflow, plugin=plugin, n_cpus=n_cpus, telemetry=telemetry,
                **plugin_kwargs)
     except:
         import sys
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Execution telemetry of the workflow nodes.
+
+For each node run, the wall time, the CPU time, the peak resident memory
+and the bytes read and written by the node process and its children are
+appended as one JSON line to an event log, tagged with the crumb argument
+values of the subject.
+
+The resident memory and the bytes read and written are taken from /proc,
+they are None in systems without it. The bytes are the ones the process
+made the kernel read from and write to the storage, `read_bytes` and
+`write_bytes` in /proc/self/io: the reads served from the page cache,
+the pipes and the sockets are not counted.
+"""
+import os
+import re
+import json
+import time
+import resource
+import threading
+from   collections import OrderedDict, defaultdict
+
+
+def _proc_io():
+    """ Return the bytes (read, written) from and to the storage by this
+    process and its waited children."""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (OSError, KeyError):
+        # no /proc or no storage I/O accounting in the kernel
+        return None, None
+
+
+def _cpu_seconds():
+    """ Return the user + system CPU time of this process and its waited children."""
+    own  = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + kids.ru_utime + kids.ru_stime
+
+
+def _children(pid):
+    children = []
+    try:
+        for tid in os.listdir('/proc/{}/task'.format(pid)):
+            with open('/proc/{}/task/{}/children'.format(pid, tid)) as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def _tree_rss_bytes(pid):
+    """ Return the resident memory of process `pid` and all its descendants."""
+    try:
+        with open('/proc/{}/statm'.format(pid)) as f:
+            rss = int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # the process already finished
+        return 0
+    return rss + sum(_tree_rss_bytes(child) for child in _children(pid))
+
+
+class PeakRSSSampler(threading.Thread):
+    """ Thread that keeps the peak resident memory of this process
+    and its descendants, sampled every `interval` seconds."""
+    def __init__(self, interval=0.5):
+        super(PeakRSSSampler, self).__init__(daemon=True)
+        self.interval    = interval
+        self.peak        = None
+        self._stop_event = threading.Event()
+
+    def _sample(self):
+        if not os.path.exists('/proc/self/statm'):
+            return
+        rss = _tree_rss_bytes(os.getpid())
+        self.peak = rss if self.peak is None else max(self.peak, rss)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self._sample()
+        return self.peak
+
+
+class NodeMeter(object):
+    """ Measure the resources used by the process between `start` and `stop`."""
+    def start(self):
+        self._wall    = time.time()
+        self._cpu     = _cpu_seconds()
+        self._io      = _proc_io()
+        self._sampler = PeakRSSSampler()
+        self._sampler.start()
+        return self
+
+    def stop(self):
+        peak_rss = self._sampler.stop()
+        io = _proc_io()
+        if None in io or None in self._io:
+            bytes_read, bytes_written = None, None
+        else:
+            bytes_read, bytes_written = io[0] - self._io[0], io[1] - self._io[1]
+
+        return OrderedDict([('start',         self._wall),
+                            ('wall',          time.time() - self._wall),
+                            ('cpu',           _cpu_seconds() - self._cpu),
+                            ('peak_rss_mb',   peak_rss / 1024.**2 if peak_rss is not None else None),
+                            ('bytes_read',    bytes_read),
+                            ('bytes_written', bytes_written),
+                           ])
+
+
+def iterable_names(wf):
+    """ Return the names of the iterable fields of all the nodes in `wf`,
+    e.g., the crumb arguments of its `infosrc` node."""
+    names = []
+    for node in wf._get_all_nodes():
+        iterables = node.iterables
+        if not iterables:
+            continue
+
+        if isinstance(iterables, tuple):
+            iterables = [iterables]
+
+        for field, _ in iterables:
+            # the synchronized iterables may be given as a tuple of fields
+            fields = field if isinstance(field, (list, tuple)) else [field]
+            names.extend(name for name in fields if name not in names)
+
+    return names
+
+
+def default_log_file(wf):
+    """ Return the default telemetry log file of `wf`:
+    '{wf.base_dir}/{wf.name}/log/telemetry.jsonl'."""
+    return os.path.join(wf.base_dir or os.getcwd(), wf.name, 'log', 'telemetry.jsonl')
+
+
+def parse_parameterization(params, arg_names):
+    """ Return the values of `arg_names` in the iterables `params` of a node.
+
+    Parameters
+    ----------
+    params: list of str
+        The `parameterization` of an expanded node, e.g.:
+        ['_session_id_sess1_subject_id_s1_year_2015'].
+
+    arg_names: list of str
+        All the iterable field names that can be in `params`.
+
+    Returns
+    -------
+    args: dict[str] -> str
+    """
+    args = {}
+    if not arg_names:
+        return args
+
+    names = '|'.join(re.escape(name) for name in sorted(arg_names, key=len, reverse=True))
+    regex = re.compile(r'(?:^|_)({})_'.format(names))
+    for param in params:
+        matches = list(regex.finditer(param))
+        for match, next_match in zip(matches, matches[1:] + [None]):
+            end = next_match.start() if next_match is not None else len(param)
+            args[match.group(1)] = param[match.end():end]
+    return args
+
+
+def node_event(node, measures, arg_names=(), status='ok'):
+    """ Return the telemetry event of a `node` run with its `measures`
+    from `NodeMeter.stop`."""
+    hierarchy = node._hierarchy.split('.') if node._hierarchy else []
+    args = parse_parameterization(node.parameterization or [], arg_names)
+
+    event = OrderedDict([('node',     node.name),
+                         ('workflow', '.'.join(hierarchy[1:]) or '.'.join(hierarchy)),
+                         ('args',     OrderedDict((name, args[name]) for name in arg_names
+                                                  if name in args)),
+                         ('status',   status),
+                        ])
+    event.update(measures)
+    return event
+
+
+def write_event(log_file, event):
+    """ Append `event` as a JSON line in `log_file`."""
+    os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+    with open(log_file, 'a') as f:
+        f.write(json.dumps(event) + '\n')
+
+
+def read_events(log_file):
+    """ Return the list of events in `log_file`."""
+    with open(log_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class TelemetryCallback(object):
+    """ A nipype `status_callback` that measures the nodes run in this
+    process, i.e., with the Linear plugin, and writes their events to
+    `log_file`."""
+    def __init__(self, log_file, arg_names=()):
+        self.log_file  = log_file
+        self.arg_names = list(arg_names)
+        self._meters   = {}
+
+    def __call__(self, node, status):
+        if status == 'start':
+            self._meters[node.output_dir()] = NodeMeter().start()
+            return
+
+        meter = self._meters.pop(node.output_dir(), None)
+        if meter is None:
+            return
+
+        status = 'ok' if status == 'end' else 'error'
+        write_event(self.log_file, node_event(node, meter.stop(), self.arg_names, status=status))
+
+
+def summarize(log_file, top=10):
+    """ Return a text report of the slowest nodes, the slowest subjects and
+    the totals per workflow in the telemetry `log_file`.
+
+    Parameters
+    ----------
+    log_file: str or list of str
+        One or more logs, e.g., the ones of each shard of `pypes.run.run_shards`.
+
+    top: int
+        Number of nodes and subjects to list.
+
+    Returns
+    -------
+    report: str
+    """
+    log_files = [log_file] if isinstance(log_file, str) else list(log_file)
+    events = [event for path in log_files for event in read_events(path)]
+
+    def subject(event):
+        return '/'.join(event['args'].values()) or '-'
+
+    def mb(n_bytes):
+        return n_bytes / 1024.**2 if n_bytes else 0.
+
+    lines = ['{} node runs in {}.'.format(len(events), ', '.join(log_files)), '']
+
+    lines.append('Slowest nodes:')
+    lines.append('{:>10} {:>10} {:>10}  {}'.format('wall (s)', 'cpu (s)', 'rss (MB)', 'node'))
+    for event in sorted(events, key=lambda event: event['wall'], reverse=True)[:top]:
+        lines.append('{:>10.1f} {:>10.1f} {:>10.0f}  {}.{} [{}]'.format(event['wall'],
+                                                                         event['cpu'],
+                                                                         event['peak_rss_mb'] or 0,
+                                                                         event['workflow'],
+                                                                         event['node'],
+                                                                         subject(event)))
+    lines.append('')
+
+    subjects = defaultdict(float)
+    for event in events:
+        subjects[subject(event)] += event['wall']
+
+    lines.append('Slowest subjects:')
+    lines.append('{:>10}  {}'.format('wall (s)', 'subject'))
+    for name, wall in sorted(subjects.items(), key=lambda item: item[1], reverse=True)[:top]:
+        lines.append('{:>10.1f}  {}'.format(wall, name))
+    lines.append('')
+
+    totals = OrderedDict()
+    for event in events:
+        total = totals.setdefault(event['workflow'], defaultdict(float))
+        total['runs']    += 1
+        total['errors']  += event['status'] != 'ok'
+        total['wall']    += event['wall']
+        total['cpu']     += event['cpu']
+        total['read']    += mb(event['bytes_read'])
+        total['written'] += mb(event['bytes_written'])
+        total['rss']      = max(total['rss'], event['peak_rss_mb'] or 0)
+
+    lines.append('Totals per workflow:')
+    lines.append('{:>6} {:>6} {:>10} {:>10} {:>12} {:>12} {:>12}  {}'.format('runs', 'errors',
+                                                                            'wall (s)', 'cpu (s)',
+                                                                            'read (MB)', 'written (MB)',
+                                                                            'max rss (MB)', 'workflow'))
+    for name, total in sorted(totals.items(), key=lambda item: item[1]['wall'], reverse=True):
+        lines.append('{:>6.0f} {:>6.0f} {:>10.1f} {:>10.1f} {:>12.0f} {:>12.0f} {:>12.0f}  {}'.format(
+                     total['runs'], total['errors'], total['wall'], total['cpu'],
+                     total['read'], total['written'], total['rss'], name))
+
+    return '\n'.join(lines)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import nibabel as nib
+
+from pypes.fmri.filter import bandpass_filter, fft_bandpass
+
+
+def _fftn_bandpass(data, tr, lowpass_freq, highpass_freq):
+    """ The previous bandpass filter, the FFT of the whole 4D array."""
+    timepoints = data.shape[-1]
+    fs = 1. / tr
+
+    F = np.zeros((timepoints))
+    lowidx  = int(np.round(float(lowpass_freq)  / fs * timepoints))
+    highidx = int(np.round(float(highpass_freq) / fs * timepoints))
+    F[highidx:lowidx] = 1
+    F = ((F + F[::-1]) > 0).astype(int)
+    return np.real(np.fft.ifftn(np.fft.fftn(data) * F))
+
+
+def test_fft_bandpass():
+    rng  = np.random.RandomState(0)
+    data = rng.randn(4, 3, 2, 64)
+
+    expected = _fftn_bandpass(data, tr=2, lowpass_freq=0.1, highpass_freq=0.01)
+    filtered = fft_bandpass(data.reshape(-1, 64).astype(np.float32), tr=2,
+                            lowpass_freq=0.1, highpass_freq=0.01)
+    assert np.allclose(filtered.reshape(data.shape), expected, atol=1e-5)
+
+
+def test_bandpass_filter_slabs(tmpdir):
+    rng  = np.random.RandomState(0)
+    data = rng.randn(5, 4, 7, 40).astype(np.float32)
+    data[0] = 0
+    img_file = str(tmpdir.join('rest.nii.gz'))
+    nib.Nifti1Image(data, np.eye(4)).to_filename(img_file)
+
+    out_files = []
+    for name, n_threads, chunk_size in (('block', 1, 10000), ('slabs', 3, 20)):
+        with tmpdir.mkdir(name).as_cwd():
+            out_files.append(bandpass_filter(img_file, lowpass_freq=0.1, highpass_freq=0.01, tr=2,
+                                             n_threads=n_threads, chunk_size=chunk_size))
+
+    block, slabs = [np.asanyarray(nib.load(out_file).dataobj) for out_file in out_files]
+    assert np.array_equal(block, slabs)
+    assert np.allclose(slabs, _fftn_bandpass(data, 2, 0.1, 0.01), atol=1e-5)
+
+    # no temporary files are left
+    assert os.listdir(str(tmpdir.join('slabs'))) == [os.path.basename(out_files[1])]
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+
+import numpy as np
+import nibabel as nib
+
+from pypes import imgcache
+from pypes.config import update_config, PYPES_CFG
+from pypes.imgcache import (ImageCache,
+                            IMAGE_CACHE_VAR,
+                            cached_file,
+                            register_img,
+                            registered_img,
+                            handoff_niimgs)
+
+
+def _save_img(file_path, shape=(4, 4, 4, 3)):
+    data = np.random.rand(*shape).astype(np.float32)
+    nib.Nifti1Image(data, np.eye(4)).to_filename(file_path)
+    return data
+
+
+def test_image_cache(tmpdir):
+    img_file = str(tmpdir.join('rest.nii.gz'))
+    data = _save_img(img_file)
+
+    cache     = ImageCache(str(tmpdir.join('cache')), max_bytes=10 * 1024**2)
+    copy_file = cache.get(img_file)
+    assert copy_file.endswith('.nii')
+    assert cache.get(img_file) == copy_file
+    assert np.array_equal(np.asanyarray(nib.load(copy_file).dataobj), data)
+
+    # a changed image gets a new copy and the old one is removed
+    data = _save_img(img_file, shape=(4, 4, 4, 5))
+    new_copy = cache.get(img_file)
+    assert new_copy != copy_file
+    assert not os.path.exists(copy_file)
+    assert np.array_equal(np.asanyarray(nib.load(new_copy).dataobj), data)
+
+
+def test_image_cache_eviction(tmpdir):
+    img_files = [str(tmpdir.join('img{}.nii.gz'.format(idx))) for idx in range(3)]
+    for img_file in img_files:
+        _save_img(img_file, shape=(10, 10, 10, 10))
+
+    size  = os.path.getsize(ImageCache(str(tmpdir.join('tmp')), 0).get(img_files[0]))
+    cache = ImageCache(str(tmpdir.join('cache')), max_bytes=2 * size, grace_secs=60)
+
+    # the copies used within the grace period are not evicted
+    first  = cache.get(img_files[0])
+    second = cache.get(img_files[1])
+    cache.get(img_files[2])
+    assert len(cache.entries()) == 3
+
+    # set the last uses explicitly, the file system mtime resolution can be coarse
+    now = time.time()
+    os.utime(first,  (now - 100, now - 100))
+    os.utime(second, (now - 200, now - 200))
+    cache.evict()
+
+    # the least recently used is evicted
+    kept = [path for path, _, _ in cache.entries()]
+    assert len(kept) == 2
+    assert first in kept
+    assert second not in kept
+    assert cache.total_bytes() <= 2 * size
+
+
+def test_cached_file_disabled(tmpdir):
+    img_file = str(tmpdir.join('rest.nii.gz'))
+    _save_img(img_file)
+
+    settings = dict(PYPES_CFG.items())
+    try:
+        update_config({'image_cache_gb': 0})
+        assert cached_file(img_file) == img_file
+
+        update_config({'image_cache_gb': 1, 'image_cache_dir': str(tmpdir.join('cache'))})
+        assert cached_file(img_file).startswith(str(tmpdir.join('cache')))
+        assert cached_file(str(tmpdir.join('mask.nii'))) == str(tmpdir.join('mask.nii'))
+    finally:
+        update_config({'image_cache_gb': settings.get('image_cache_gb', 0),
+                       'image_cache_dir': settings.get('image_cache_dir', '')})
+
+
+def test_cached_file_env(tmpdir, monkeypatch):
+    img_file = str(tmpdir.join('rest.nii.gz'))
+    _save_img(img_file)
+
+    # a worker process without the cache settings in its configuration
+    config = {}
+    monkeypatch.setattr(imgcache, 'get_config_setting', lambda name, default='': config.get(name, default))
+    assert cached_file(img_file) == img_file
+
+    # the settings of the job scripts of the Queue plugin
+    monkeypatch.setenv(IMAGE_CACHE_VAR, json.dumps({'image_cache_gb': 1,
+                                                    'image_cache_dir': str(tmpdir.join('cache'))}))
+    assert cached_file(img_file).startswith(str(tmpdir.join('cache')))
+
+    # the configuration settings come first
+    config['image_cache_gb'] = 0
+    assert cached_file(img_file) == img_file
+
+
+def test_image_handoff(tmpdir):
+    img_file  = str(tmpdir.join('mask.nii.gz'))
+    mask_file = str(tmpdir.join('brain.nii'))
+    _save_img(mask_file, shape=(4, 4, 4))
+
+    img = nib.Nifti1Image(np.ones((4, 4, 4), dtype=np.float32), np.eye(4))
+    img.to_filename(img_file)
+
+    settings = dict(PYPES_CFG.items())
+    try:
+        update_config({'image_handoff_mb': 0})
+        register_img(img_file, img)
+        assert registered_img(img_file) is None
+
+        update_config({'image_handoff_mb': 1})
+        register_img(img_file, img)
+        assert np.array_equal(np.asanyarray(registered_img(img_file).dataobj), img.dataobj)
+        imgs = handoff_niimgs([img_file, mask_file, 'img / val'])
+        assert np.array_equal(np.asanyarray(imgs[0].dataobj), img.dataobj)
+        assert imgs[1:] == [mask_file, 'img / val']
+
+        # a change in place of the handed off image does not reach the registered one
+        np.asanyarray(imgs[0].dataobj)[:] = 0
+        assert (np.asanyarray(registered_img(img_file).dataobj) == 1).all()
+
+        # a changed file is read from disk
+        img.to_filename(img_file)
+        mtime = os.path.getmtime(img_file) + 10
+        os.utime(img_file, (mtime, mtime))
+        assert registered_img(img_file) is None
+        assert handoff_niimgs(img_file) == img_file
+    finally:
+        update_config({'image_handoff_mb': settings.get('image_handoff_mb', 0)})
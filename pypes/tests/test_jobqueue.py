@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import multiprocessing
+
+from pypes.jobqueue import JobQueue, run_worker
+
+
+def test_jobqueue_lease(tmpdir):
+
+    queue = JobQueue(str(tmpdir), lease_secs=60, max_attempts=2)
+    job_id = queue.put('/nowhere/batchscript.sh', name='wf.node')
+    assert(queue.status(job_id) == 'pending')
+
+    job = queue.claim('worker1')
+    assert(job['id'] == job_id)
+    assert(queue.status(job_id) == 'running')
+    assert(queue.claim('worker2') is None)
+
+    # a live lease is not reaped
+    assert(queue.heartbeat(job))
+    assert(queue.reap() == [])
+
+    # an expired lease goes back to pending
+    running_file = os.path.join(str(tmpdir), 'running', job_id + '.json')
+    old = time.time() - 120
+    os.utime(running_file, (old, old))
+    assert(queue.reap() == [job_id])
+    assert(queue.status(job_id) == 'pending')
+    assert(not queue.heartbeat(job))
+
+    # the stalled worker can not renew nor complete the job claimed again
+    stalled_job = job
+    job = queue.claim('worker2')
+    assert(job['attempts'] == 2)
+    assert(not queue.heartbeat(stalled_job))
+    assert(not queue.complete(stalled_job, exitcode=0))
+    assert(queue.status(job_id) == 'running')
+    assert(queue.heartbeat(job))
+
+    # until it runs out of attempts
+    os.utime(running_file, (old, old))
+    assert(queue.reap() == [job_id])
+    assert(queue.status(job_id) == 'done')
+    assert(queue.result(job_id)['exitcode'] is None)
+
+
+def test_jobqueue_workers(tmpdir):
+    queue_dir  = str(tmpdir.join('queue'))
+    runs_dir   = tmpdir.mkdir('runs')
+    scripts    = tmpdir.mkdir('scripts')
+    lease_secs = 2
+
+    queue = JobQueue(queue_dir, lease_secs=lease_secs)
+    job_ids = []
+    for idx in range(20):
+        script = scripts.join('job{}.sh'.format(idx))
+        script.write('echo {0} >> {1}\n'.format(idx, runs_dir.join('job{}.txt'.format(idx))))
+        job_ids.append(queue.put(str(script), name='job{}'.format(idx)))
+
+    # the jobs waited in pending longer than the lease
+    old = time.time() - 10 * lease_secs
+    for job_id in job_ids:
+        os.utime(os.path.join(queue_dir, 'pending', job_id + '.json'), (old, old))
+
+    workers = [multiprocessing.Process(target=run_worker, args=(queue_dir, ),
+                                       kwargs=dict(n_jobs=2, lease_secs=lease_secs,
+                                                   poll_secs=0.05, idle_exit=1))
+               for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=60)
+        assert(worker.exitcode == 0)
+
+    # every job ran once
+    for idx, job_id in enumerate(job_ids):
+        assert(queue.status(job_id) == 'done')
+        assert(queue.result(job_id)['exitcode'] == 0)
+        assert(runs_dir.join('job{}.txt'.format(idx)).read().split() == [str(idx)])
+    assert(os.listdir(os.path.join(queue_dir, 'pending')) == [])
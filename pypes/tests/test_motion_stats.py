@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import nibabel as nib
+
+from pypes.preproc.motion_stats import (streaming_dvars,
+                                        calculate_DVARS,
+                                        calculate_FD_P,
+                                        calculate_FD_J,
+                                        motion_metrics,
+                                        rigid_matrices)
+
+
+def _save_rest(tmpdir, shape=(5, 4, 3, 12)):
+    rng  = np.random.RandomState(0)
+    data = (100 + 10 * rng.randn(*shape)).astype(np.float32)
+    mask = rng.rand(*shape[:3]) > 0.3
+
+    rest_file = str(tmpdir.join('rest.nii.gz'))
+    mask_file = str(tmpdir.join('mask.nii.gz'))
+    nib.Nifti1Image(data, np.eye(4)).to_filename(rest_file)
+    nib.Nifti1Image(mask.astype(np.uint8), np.eye(4)).to_filename(mask_file)
+    return rest_file, mask_file, data, mask
+
+
+def _full_dvars(data, mask):
+    """ The previous DVARS, on the whole 4D array."""
+    diff = np.diff(data, axis=3)[mask]
+    return np.sqrt(np.mean(np.square(diff), axis=0))
+
+
+def _save_params(tmpdir, n_vols=10):
+    rng    = np.random.RandomState(0)
+    params = np.cumsum(rng.randn(n_vols, 6) * [0.2, 0.2, 0.2, 0.3, 0.3, 0.3], axis=0)
+
+    params_file = str(tmpdir.join('rest.par'))
+    np.savetxt(params_file, params)
+    return params_file, params
+
+
+def _rowwise_rms(matrices, ref):
+    """ The previous Jenkinson RMS, one pair of matrices in each iteration."""
+    rms = [0.]
+    for idx in range(1, len(matrices)):
+        M = np.dot(matrices[idx], np.linalg.inv(matrices[ref(idx)])) - np.eye(4)
+        A = M[0:3, 0:3]
+        b = M[0:3, 3]
+        rms.append(np.sqrt((80. * 80. / 5) * np.trace(np.dot(A.T, A)) + np.dot(b.T, b)))
+    return np.array(rms)
+
+
+def test_motion_metrics(tmpdir):
+    params_file, params = _save_params(tmpdir)
+    degrees = (('tx', 'ty', 'tz', 'rx', 'ry', 'rz'), 'degrees')
+
+    # the previous per-row code took the rotations in degrees
+    diff = np.abs(np.diff(params, axis=0))
+    fd_power = np.insert(diff[:, :3].sum(axis=1) + (50 * 3.141 / 180) * diff[:, 3:].sum(axis=1), 0, 0)
+
+    roll = np.roll(params, 1, axis=0)
+    roll[0] = 0
+    friston24 = np.concatenate((params, params**2, roll, roll**2), axis=1)
+
+    matrices = rigid_matrices(np.hstack((params[:, :3], np.deg2rad(params[:, 3:]))))
+    rms_rel  = _rowwise_rms(matrices, lambda idx: idx - 1)
+    rms_abs  = _rowwise_rms(matrices, lambda idx: 0)
+
+    metrics = motion_metrics([params_file, params_file], params_format=degrees)
+    assert len(metrics) == 2
+    for values in metrics:
+        assert np.allclose(values['fd_power'],     fd_power, rtol=1e-3)
+        assert np.allclose(values['friston24'],    friston24)
+        assert np.allclose(values['rms_rel'],      rms_rel)
+        assert np.allclose(values['rms_abs'],      rms_abs)
+        assert np.allclose(values['fd_jenkinson'], rms_rel)
+
+    # the 3dvolreg matrix rows
+    matrix_file = str(tmpdir.join('rest.aff12.1D'))
+    np.savetxt(matrix_file, matrices[:, :3, :].reshape(-1, 12))
+
+    with tmpdir.as_cwd():
+        assert np.allclose(np.loadtxt(calculate_FD_P(params_file, params_format=degrees)),
+                           fd_power, rtol=1e-3)
+        assert np.allclose(np.loadtxt(calculate_FD_J(matrix_file)), rms_rel, atol=1e-6)
+
+
+def test_streaming_dvars(tmpdir):
+    rest_file, mask_file, data, mask = _save_rest(tmpdir)
+
+    expected = _full_dvars(data, mask)
+    for chunk_size in (1, 5, 12, 20):
+        dvars, _ = streaming_dvars(rest_file, mask_file, chunk_size=chunk_size)
+        assert np.allclose(dvars, expected, rtol=1e-5)
+
+
+def test_standardized_dvars(tmpdir):
+    rest_file, mask_file, data, mask = _save_rest(tmpdir)
+
+    diff_sd  = np.std(np.diff(data.astype(np.float64), axis=3)[mask], axis=1)
+    expected = _full_dvars(data, mask) / diff_sd.mean()
+
+    with tmpdir.as_cwd():
+        std_file = calculate_DVARS(rest_file, mask_file, standardized=True, chunk_size=4)
+        assert np.allclose(np.load(std_file), expected, rtol=1e-5)
+
+        dvars_file = calculate_DVARS(rest_file, mask_file, chunk_size=4)
+        assert np.allclose(np.load(dvars_file), _full_dvars(data, mask), rtol=1e-5)
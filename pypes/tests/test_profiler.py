@@ -0,0 +1,16 @@
+from collections import Counter
+
+from pypes.profiler import write_folded, read_folded, flamegraph_svg
+
+
+def test_folded_flamegraph(tmpdir):
+    stacks = Counter({'run;helper;svd': 8, 'run;helper': 2, 'run;save': 1})
+    folded_file = str(tmpdir.join('node.folded'))
+    write_folded(folded_file, stacks, root='wf.node')
+
+    merged = read_folded(folded_file)
+    assert merged == {'wf.node;' + stack: count for stack, count in stacks.items()}
+
+    svg = open(flamegraph_svg(merged, str(tmpdir.join('flamegraph.svg')))).read()
+    assert 'wf.node (11 samples, 100.0%)' in svg
+    assert 'helper (10 samples' in svg
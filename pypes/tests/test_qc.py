@@ -0,0 +1,48 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from pypes.qc import MotionQCStore, save_motion_qc, read_motion_qc
+
+
+def test_motion_qc_store(tmpdir):
+    store = MotionQCStore(str(tmpdir.join('qc.sqlite')))
+    for idx in range(10):
+        args = OrderedDict([('subject_id', 's{}'.format(idx)), ('session', 'a')])
+        store.add(args, {'mean_fd_power': 10. if idx == 3 else 0.1, 'n_censored': idx})
+
+    # replacing the measures of a subject
+    store.add(OrderedDict([('subject_id', 's0'), ('session', 'a')]), {'mean_fd_power': 0.1})
+    assert len(store) == 10
+
+    summary = store.summary()
+    assert summary['mean_fd_power']['count'] == 10
+    assert summary['n_censored']['count'] == 9
+
+    outliers = store.outliers('mean_fd_power', n_std=2)
+    assert [args['subject_id'] for args, _ in outliers] == ['s3']
+
+    df = store.to_frame()
+    assert list(df.columns[:2]) == ['subject_id', 'session']
+    assert df.shape == (10, 4)
+
+
+def test_motion_qc_file(tmpdir):
+    fd = np.array([0., 0.1, 0.8, 0.2])
+    np.savetxt(str(tmpdir.join('FD.1D')), fd)
+
+    with tmpdir.as_cwd():
+        qc_file = save_motion_qc('s0', 'rest', str(tmpdir.join('FD.1D')), threshold=0.5)
+
+    args, measures = read_motion_qc(qc_file)
+    assert list(args.values()) == ['s0', 'rest']
+    assert measures['max_fd_power'] == 0.8
+    assert measures['n_fd_power_over_threshold'] == 1
+
+    # the store is only written when the file changes
+    store = MotionQCStore(str(tmpdir.join('qc.sqlite')))
+    crumb_args = OrderedDict([('subject_id', 's0'), ('session', 'a')])
+    assert store.add_qc_file(qc_file, args=crumb_args)
+    assert not store.add_qc_file(qc_file, args=crumb_args)
+    assert len(store) == 1
+    assert store.to_frame()['subject_id'][0] == 's0'
@@ -0,0 +1,43 @@
+from pypes.telemetry import NodeMeter, parse_parameterization, write_event, summarize
+
+
+def test_parse_parameterization():
+    params = ['_session_id_sess_1_subject_id_s1_year_2015']
+    args = parse_parameterization(params, ['subject_id', 'session_id', 'year'])
+    assert args == {'session_id': 'sess_1', 'subject_id': 's1', 'year': '2015'}
+
+    assert parse_parameterization(params, []) == {}
+
+
+def test_summarize(tmpdir):
+    log_file = str(tmpdir.join('log', 'telemetry.jsonl'))
+    for subject, wall in (('s1', 10.), ('s2', 30.)):
+        write_event(log_file, {'node': 'bias', 'workflow': 'anat', 'args': {'subject_id': subject},
+                               'status': 'ok', 'wall': wall, 'cpu': wall, 'peak_rss_mb': 100.,
+                               'bytes_read': None, 'bytes_written': None})
+
+    report = summarize(log_file, top=1)
+    assert '2 node runs' in report
+    assert 'anat.bias [s2]' in report
+    assert 'anat.bias [s1]' not in report
+
+    # the logs of the shards of one run
+    shard_file = str(tmpdir.join('log', 'telemetry_shard1of2.jsonl'))
+    write_event(shard_file, {'node': 'bias', 'workflow': 'anat', 'args': {'subject_id': 's3'},
+                             'status': 'ok', 'wall': 50., 'cpu': 50., 'peak_rss_mb': 100.,
+                             'bytes_read': None, 'bytes_written': None})
+
+    report = summarize([log_file, shard_file], top=1)
+    assert '3 node runs' in report
+    assert 'anat.bias [s3]' in report
+
+
+def test_node_meter(tmpdir):
+    meter = NodeMeter().start()
+    tmpdir.join('data.bin').write_binary(b'0' * 1024**2)
+    measures = meter.stop()
+
+    assert measures['wall'] >= 0
+    # the storage bytes, None without /proc/self/io, 0 if the write is still in the page cache
+    for name in ('bytes_read', 'bytes_written'):
+        assert measures[name] is None or measures[name] >= 0
@@ -9,7 +9,9 @@ from .files   import  (remove_ext,
                        get_data_dims,
                        get_vox_dims,
                        fetch_one_file,
-                       extension_duplicates,)
+                       extension_duplicates,
+                       save_nifti,
+                       gzip_file,)
 
 from .piping  import  (extend_trait_list,
                        selectindex,
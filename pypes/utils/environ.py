@@ -6,10 +6,24 @@ import os
 from os import path as op
 
 from nipype.interfaces import spm as spm
+from nipype.interfaces.base import isdefined
 
 from ..config import get_config_setting
 
 
+# environment variables that limit the threads of ITK, OpenMP and the BLAS libraries
+THREAD_ENV_VARS = ('OMP_NUM_THREADS',
+                   'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS',
+                   'MKL_NUM_THREADS',
+                   'OPENBLAS_NUM_THREADS',
+                   'NUMEXPR_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS',
+                  )
+
+# the number of threads of the node run by a worker process, see `node_threads`
+NODE_THREADS_VAR = 'PYPES_NODE_THREADS'
+
+
 def spm_tpm_priors_path(spm_dir=None):
     """ Return the path to the TPM.nii file from SPM.
 
@@ -90,3 +104,39 @@ def get_fsl_extension(default='NIFTI_GZ'):
 
     return otype_ext[outtype]
 
+
+
+def thread_environ(n_threads):
+    """ Return a dict with the environment variables that limit the threads
+    of the external tools and numerical libraries to `n_threads`."""
+    return {var: str(n_threads) for var in THREAD_ENV_VARS}
+
+
+def node_threads(default=1):
+    """ Return the number of threads of the node being run in this process,
+    set by `pypes.resources.run_node_job`, or `default` if it is not set.
+    The Python functions of the Function nodes use it to size their thread
+    pools, instead of a thread number input that would be in the node hash."""
+    return int(os.environ.get(NODE_THREADS_VAR, default))
+
+
+def set_node_threads(node, n_threads):
+    """ Limit the threads of the interface of `node` to `n_threads`.
+    This sets its `num_threads` input and the thread environment variables
+    of command line interfaces, both are excluded from the node hash.
+
+    Parameters
+    ----------
+    node: nipype Node or MapNode
+
+    n_threads: int
+    """
+    inputs = node._interface.inputs
+
+    if hasattr(inputs, 'num_threads'):
+        inputs.num_threads = n_threads
+
+    if hasattr(inputs, 'environ'):
+        environ = dict(inputs.environ) if isdefined(inputs.environ) else {}
+        environ.update(thread_environ(n_threads))
+        inputs.environ = environ
@@ -280,3 +280,91 @@ def save_object(obj, filename):
 
     with open(filename, 'wb') as output:
         pickle.dump(obj, output, pickle.HIGHEST_PROTOCOL)
+
+
+def save_nifti(img, file_path, compresslevel=None, n_threads=None):
+    """ Save the nibabel `img` in `file_path`, gzip compressed if it ends
+    with '.gz'.
+
+    Parameters
+    ----------
+    img: nibabel SpatialImage
+
+    file_path: str
+
+    compresslevel: int
+        The gzip compression level.
+        Default: the `compress_level` configuration setting.
+
+    n_threads: int
+        Number of compression threads, see `pypes.utils.pgzip`.
+        Default: the `compress_threads` configuration setting.
+
+    Returns
+    -------
+    file_path: str
+    """
+    from .pgzip import gzip_writer
+
+    if not file_path.endswith('.gz'):
+        img.to_filename(file_path)
+        return file_path
+
+    compresslevel, n_threads = _compression_settings(compresslevel, n_threads)
+    with gzip_writer(file_path, compresslevel=compresslevel, n_threads=n_threads) as f:
+        img.to_file_map(img.make_file_map({'image': f}))
+
+    return file_path
+
+
+def gzip_file(in_file, out_file='', compresslevel=None, n_threads=None, remove=False):
+    """ Compress `in_file` with gzip.
+
+    Parameters
+    ----------
+    in_file: str
+
+    out_file: str
+        Default: `in_file` with the '.gz' extension.
+
+    compresslevel: int
+        Default: the `compress_level` configuration setting.
+
+    n_threads: int
+        Number of compression threads, see `pypes.utils.pgzip`.
+        Default: the `compress_threads` configuration setting.
+
+    remove: bool
+        If True, `in_file` is removed afterwards.
+
+    Returns
+    -------
+    out_file: str
+    """
+    import shutil
+    from   .pgzip import gzip_writer, BLOCK_SIZE
+
+    if not out_file:
+        out_file = in_file + '.gz'
+
+    compresslevel, n_threads = _compression_settings(compresslevel, n_threads)
+    with open(in_file, 'rb') as f_in, gzip_writer(out_file, compresslevel=compresslevel,
+                                                  n_threads=n_threads) as f_out:
+        shutil.copyfileobj(f_in, f_out, BLOCK_SIZE)
+
+    if remove:
+        os.remove(in_file)
+
+    return out_file
+
+
+def _compression_settings(compresslevel=None, n_threads=None):
+    from ..config import compress_level, compress_threads
+
+    if compresslevel is None:
+        compresslevel = compress_level()
+
+    if n_threads is None:
+        n_threads = compress_threads()
+
+    return compresslevel, n_threads
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-threaded gzip compression.
+
+The data is split in blocks that are deflated independently by a pool of
+threads, as `pigz --independent` does. Each block ends on a byte boundary
+with a zlib sync flush, so the compressed blocks are joined in one standard
+gzip member that any gzip reader can decompress.
+zlib releases the GIL while it compresses, so the blocks are compressed in
+parallel.
+"""
+import io
+import time
+import zlib
+import struct
+from   collections import deque
+from   concurrent.futures import ThreadPoolExecutor
+
+
+# uncompressed size of the blocks
+BLOCK_SIZE = 1024 * 1024
+
+
+def _gzip_header():
+    # magic, deflate, no flags, modification time, no extra flags, unknown OS
+    return b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + b'\x00\xff'
+
+
+def _deflate_block(data, compresslevel):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """ A write-only gzip file whose blocks are compressed by `n_threads`
+    threads.
+
+    It can only seek forward, padding with zeros, like the gzip.GzipFile
+    in write mode.
+
+    Parameters
+    ----------
+    file_path: str
+
+    compresslevel: int
+        The gzip compression level, from 0 to 9.
+
+    n_threads: int
+        Number of compression threads.
+
+    block_size: int
+        Number of uncompressed bytes in each block.
+    """
+    def __init__(self, file_path, compresslevel=1, n_threads=1, block_size=BLOCK_SIZE):
+        super(ParallelGzipWriter, self).__init__()
+        self.name          = file_path
+        self.compresslevel = compresslevel
+        self.n_threads     = max(1, int(n_threads))
+        self.block_size    = block_size
+
+        self._file    = open(file_path, 'wb')
+        self._pool    = ThreadPoolExecutor(max_workers=self.n_threads)
+        self._pending = deque()
+        self._buffer  = bytearray()
+        self._crc     = 0
+        self._size    = 0
+
+        self._file.write(_gzip_header())
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self._size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._size
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('Can only seek from the start or the current position.')
+
+        if offset < self._size:
+            raise io.UnsupportedOperation('Can not seek backwards in a gzip file being written.')
+
+        self.write(bytes(offset - self._size))
+        return self._size
+
+    def _submit(self, block):
+        self._pending.append(self._pool.submit(_deflate_block, block, self.compresslevel))
+
+        # keep the compressed blocks in order and at most two per thread in memory
+        while len(self._pending) > 2 * self.n_threads or (self._pending and self._pending[0].done()):
+            self._file.write(self._pending.popleft().result())
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+
+        view = memoryview(data).cast('B')
+        self._crc   = zlib.crc32(view, self._crc)
+        self._size += len(view)
+
+        start = 0
+        if self._buffer:
+            start = min(len(view), self.block_size - len(self._buffer))
+            self._buffer += view[:start]
+            if len(self._buffer) < self.block_size:
+                return len(view)
+
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        while len(view) - start >= self.block_size:
+            self._submit(bytes(view[start:start + self.block_size]))
+            start += self.block_size
+
+        self._buffer += view[start:]
+        return len(view)
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+
+            # an empty final block and the trailer
+            self._file.write(zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+            self._file.write(struct.pack('<II', self._crc & 0xffffffff, self._size & 0xffffffff))
+        finally:
+            self._pool.shutdown()
+            self._file.close()
+            super(ParallelGzipWriter, self).close()
+
+
+def gzip_writer(file_path, compresslevel=1, n_threads=1):
+    """ Return a writable gzip file object for `file_path`, a
+    `ParallelGzipWriter` if `n_threads` is more than 1, otherwise a
+    gzip.GzipFile."""
+    if n_threads > 1:
+        return ParallelGzipWriter(file_path, compresslevel=compresslevel, n_threads=n_threads)
+
+    import gzip
+    return gzip.GzipFile(file_path, 'wb', compresslevel=compresslevel)
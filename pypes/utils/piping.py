@@ -9,7 +9,7 @@ from nipype import (Function, SelectFiles,
 from nipype.interfaces.base import (traits, isdefined)
 import nipype.interfaces.fsl as fsl
 
-from ..crumb  import DataCrumb
+from ..crumb  import DataCrumb, DataCrumbTable
 
 
 def get_trait_value(traitspec, value_name, default=None):
@@ -81,8 +81,8 @@ def get_datasink(wf, name=''):
 
 
 def get_input_node(wf, name=''):
-    """ Return the first node of type: (DataCrumb, SelectFiles, DataGrabber) in wf."""
-    return get_node(wf, (DataCrumb, SelectFiles, DataGrabber), name=name)
+    """ Return the first node of type: (DataCrumb, DataCrumbTable, SelectFiles, DataGrabber) in wf."""
+    return get_node(wf, (DataCrumb, DataCrumbTable, SelectFiles, DataGrabber), name=name)
 
 
 def get_interface_node(wf, name):
@@ -225,7 +225,7 @@ def get_input_file_name(input_node, fname_key):
     Parameters
     ----------
     input_node: nipype Node
-        a node with a file input interface (SelectFiles, DataCrumb), for now.
+        a node with a file input interface (SelectFiles, DataCrumb, DataCrumbTable), for now.
 
     fname_key: str
         The key that is used to access the file path using `input_node`.
@@ -247,7 +247,7 @@ def get_input_file_name(input_node, fname_key):
         else:
             return fname
 
-    if isinstance(input_node.interface, DataCrumb):
+    if isinstance(input_node.interface, (DataCrumb, DataCrumbTable)):
         try:
             crumb_args = input_node.interface._templates[fname_key]
             incrumb    = input_node.interface._crumb.replace(**dict(crumb_args))
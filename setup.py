@@ -58,6 +58,8 @@ setup_dict = dict(
 
     scripts=[],
 
+    entry_points={'console_scripts': ['pypes = pypes.cli:main']},
+
     long_description=read('README.md', 'CHANGES.md'),
 
     platforms='Linux/MacOSX',